@@ -1,10 +1,12 @@
 import os, vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging, subprocess, shutil
-import importlib.metadata, glob
+import importlib.metadata, importlib.util, glob
 import platform
-import vtkmodules.all as vtk
 import numpy as np
+import json, hashlib, socket, time, threading
+import collections, contextlib, re
+import sys, functools, cProfile, pstats
 
 
 
@@ -14,6 +16,1284 @@ class It(object):
   def __enter__(self): return self.node
   def __exit__(self, type, value, traceback): return False
 
+# helper class for a sampling profiler: a thread records the Python stacks of the other
+# threads every interval seconds, dumped as collapsed stacks ("outer;inner count" lines)
+# as read by flame graph tools (flamegraph.pl, speedscope). Thread exclude (an ident) is
+# not sampled.
+class StackSampler(object):
+  def __init__(self, interval=0.005, exclude=None):
+    self.interval = interval
+    self.exclude = exclude
+    self.counts = collections.Counter()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def _sample(self):
+    own = threading.get_ident()
+    while not self._stop.wait(self.interval):
+      for ident, frame in sys._current_frames().items():
+        if ident in (own, self.exclude):
+          continue
+        stack = []
+        while frame is not None:
+          stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+          frame = frame.f_back
+        self.counts[";".join(reversed(stack))] += 1
+
+  def enable(self):
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._sample, daemon=True)
+    self._thread.start()
+
+  def disable(self):
+    self._stop.set()
+    self._thread.join()
+
+  def dump(self, filename):
+    with open(filename, "w") as f:
+      for stack, count in self.counts.most_common():
+        f.write(f"{stack} {count}\n")
+
+# helper decorator running a logic method under the opt-in profiler (see
+# AnatomicalTractParcellationLogic.profiled), named after the method.
+def profiledMethod(method):
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self.profiled(method.__name__):
+      return method(self, *args, **kwargs)
+  return wrapper
+
+# Settings keys and environment variables used to locate the ORG atlas.
+# The environment variables take precedence so that cluster jobs can point
+# every Slicer instance on a node at the same store and cache.
+ATLAS_STORE_SETTING = "AnatomicalTractParcellation/AtlasStore"
+ATLAS_CACHE_SETTING = "AnatomicalTractParcellation/AtlasCache"
+ATLAS_VERSION_SETTING = "AnatomicalTractParcellation/AtlasVersion"
+ATLAS_STORE_ENV = "SLICERWMA_ATLAS_STORE"
+ATLAS_CACHE_ENV = "SLICERWMA_ATLAS_CACHE"
+ATLAS_VERSION_ENV = "SLICERWMA_ATLAS_VERSION"
+ATLAS_PREFIX = "ORG-Atlases"
+ATLAS_MANIFEST = ".atlas_manifest.json"
+
+# Point array holding, for every point, the index of its fiber in the input
+# tractography; written by the pre-processing stage to restore original fibers
+FIBER_INDEX_ARRAY = "FiberIndex"
+# Input tractography formats; .trk and .tck are read natively and converted to binary
+# .vtk (as are ASCII .vtk files) only when the WMA scripts have to read them
+TRACTOGRAPHY_EXTENSIONS = (".vtk", ".vtp", ".trk", ".tck")
+CONVERTED_FOLDER = "Converted"
+
+# Per-folder index of the fiber files written by a pipeline stage
+OUTPUT_INDEX = "index.json"
+
+# Hemisphere labels of fibers, stored per fiber in the HEMISPHERE_ARRAY cell array of
+# separated clusters, and the folder each label is written to.
+HEMISPHERE_RIGHT, HEMISPHERE_LEFT, HEMISPHERE_COMMISSURAL = 1, 2, 3
+HEMISPHERE_ARRAY = "HemisphereLocation"
+HEMISPHERE_FOLDERS = {
+  HEMISPHERE_COMMISSURAL: "tracts_commissural",
+  HEMISPHERE_LEFT: "tracts_left_hemisphere",
+  HEMISPHERE_RIGHT: "tracts_right_hemisphere",
+  }
+# Fraction of its points a fiber needs in one hemisphere not to be commissural
+HEMISPHERE_THRESHOLD = 0.6
+
+# Anatomical tracts crossing the midline; every other atlas tract is written
+# once per hemisphere as <tract>_left.vtp and <tract>_right.vtp.
+COMMISSURAL_TRACTS = ("T_CC1", "T_CC2", "T_CC3", "T_CC4", "T_CC5", "T_CC6", "T_CC7", "T_MCP")
+
+# Leading columns of the diffusion measurement CSVs (FiberTractMeasurements layout).
+# They are followed by <array>.Max, <array>.Mean, <array>.Min for every point scalar
+# array and <array>.<measure> ones for the TENSOR_MEASURES of every tensor array,
+# sorted by name. The extra Min_Length and Max_Length columns are only written on
+# request (lengthRange of computeDiffusionMeasurements).
+MEASUREMENT_COLUMNS = ["Name", "Num_Points", "Num_Fibers", "Mean_Length"]
+MEASUREMENT_EXTRA_COLUMNS = ["Min_Length", "Max_Length"]
+# Measures of the tensor arrays reported by FiberTractMeasurements
+TENSOR_MEASURES = ("FractionalAnisotropy", "LinearMeasure", "MaxEigenvalue", "MeanDiffusivity", "MidEigenvalue", "MinEigenvalue",
+                   "ParallelDiffusivity", "PerpendicularDiffusivity", "PlanarMeasure", "RelativeAnisotropy", "SphericalMeasure", "Trace")
+
+# Registration presets, mapped to wm_register_to_atlas_new.py arguments: the -mode of
+# the affine-only registration and of the first step of affine + nonlinear, the number
+# of fibers sampled (-f) and the fiber length range (-l, -lmax, mm). The iterations are
+# set by the script for each mode. "standard" is the former fixed behaviour.
+REGISTRATION_PRESETS = {
+  "fast QC": {"affineMode": "rigid_affine_fast", "initialMode": "rigid_affine_fast", "fibers": 10000, "lengthMin": 40, "lengthMax": 260},
+  "standard": {"affineMode": "rigid_affine_fast", "initialMode": "affine", "fibers": 20000, "lengthMin": 40, "lengthMax": 260},
+  "accurate": {"affineMode": "affine", "initialMode": "affine", "fibers": 40000, "lengthMin": 30, "lengthMax": 260},
+  }
+DEFAULT_REGISTRATION_PRESET = "standard"
+
+# Out-of-core mode: fibers of the whole-brain sample used to register chunked inputs
+CHUNK_REGISTRATION_FIBERS = 100000
+
+# Dry-run planner: stages that use NumThreads, and the cost model used until run
+# reports are available (rough figures for a whole-brain subject, one thread):
+# stage -> (seconds, seconds per million fibers); memory and disk are linear in the
+# input points and bytes
+PLANNER_THREADED_STAGES = ("clustering", "chunked_clustering", "atlas_embedding", "outlier_removal", "separation", "append",
+                           "restore_geometry", "measurements", "spatial_index")
+PLANNER_DEFAULT_STAGES = {
+  "registration": (600.0, 0.0),
+  "clustering": (60.0, 1500.0),
+  "outlier_removal": (30.0, 600.0),
+  "harden_transform": (10.0, 60.0),
+  "separation": (5.0, 60.0),
+  "append": (5.0, 60.0),
+  "measurements": (5.0, 60.0),
+  "spatial_index": (5.0, 60.0),
+  }
+PLANNER_DEFAULT_MEMORY = (1.0e9, 200.0)
+PLANNER_DEFAULT_DISK = (0.0, 4.0)
+
+# Colors of the anatomical tracts, in file name order
+TRACT_COLORS = [
+  "#ff0029", "#ff0029", "#ffa400", "#ffa400", "#241155", "#58137c", "#9a2c7f", "#da4669",
+  "#fa825e", "#fec589", "#fdefb1", "#460d5f", "#460d5f", "#10256c", "#10256c", "#225ea8",
+  "#225ea8", "#2a9dc0", "#2a9dc0", "#ff0fee", "#ff0fee", "#6000ff", "#6000ff", "#3b518a",
+  "#3b518a", "#00ff05", "#00ff05", "#1c978a", "#1c978a", "#82d34c", "#82d34c", "#00fffd",
+  "#00fffd", "#efe51b", "#00aaff", "#00aaff", "#9ed8b7", "#9ed8b7", "#ff7984", "#ff7984",
+  "#0012ff", "#0012ff", "#ffea00", "#ffea00", "#c200ff", "#c200ff", "#ffaf4e", "#ffaf4e",
+  "#ffed11", "#ffed11", "#e41a1b", "#e41a1b", "#377eb7", "#377eb7", "#4daf4a", "#4daf4a",
+  "#984ea3", "#984ea3", "#ff7f00", "#ff7f00", "#feff33", "#feff33", "#f880bf", "#f880bf",
+  "#999999", "#999999", "#c7e9b4", "#c7e9b4", "#f0f9b7", "#f0f9b7", "#feffd9", "#feffd9",
+  "#ff00bf", "#ff00bf",
+  ]
+
+# Single-file bundle of the anatomical tracts in the subject output folder, with a
+# TractId array indexing the tract names, colors and measurements of its field data
+RESULT_BUNDLE = "anatomical_tracts.vtp"
+TRACT_ID_ARRAY = "TractId"
+
+# Label-only output: the input fibers with per-fiber cell arrays, and the names of the
+# labels (written last, it also marks the labeling as done)
+FIBER_LABELS = "fiber_labels.vtk"
+FIBER_LABELS_INDEX = "fiber_labels.json"
+CLUSTER_ID_ARRAY = "ClusterId"
+OUTLIER_ARRAY = "Outlier"
+# Arrays added by this module, left out of the diffusion measurements
+MEASUREMENT_SKIPPED_ARRAYS = (FIBER_INDEX_ARRAY, HEMISPHERE_ARRAY, TRACT_ID_ARRAY, CLUSTER_ID_ARRAY, OUTLIER_ARRAY)
+
+# Per-fiber atlas embedding of a subject, cached by the in-process clustering in the
+# subject output folder so that cluster assignment and outlier removal can be redone
+# (e.g. with another outlier threshold) without computing the fiber affinities again
+EMBEDDING_CACHE = "atlas_embedding.npz"
+EMBEDDING_THRESHOLD = "outlier_threshold.json"
+# Method that made the initial clusters of a subject ("embedding" or "wm_cluster_from_atlas"),
+# recorded in their folder; clusters of the other method do not match the cached embedding
+CLUSTERING_METHOD = "clustering_method.json"
+EMBEDDING_MIN_LENGTH = 40.0
+EMBEDDING_POINTS = 15
+# Outliers: fibers whose mean affinity exp(-d^2/sigma^2) to the fibers of their atlas
+# cluster is OUTLIER_STD standard deviations below that of the atlas fibers themselves
+OUTLIER_SIGMA = 20.0
+OUTLIER_STD = 2.0
+OUTLIER_REFERENCE_FIBERS = 500
+
+# Subjects added to a cohort store before its segments are merged into cohort.npz
+COHORT_COMPACT_SEGMENTS = 20
+
+# Watch-folder ingestion: the input folder is listed every WATCH_POLL_SECONDS and a file
+# is enqueued once its size and modification time are WATCH_SETTLE_SECONDS old; a file
+# named WATCH_STOP_FILE in the queue folder stops the watcher
+WATCH_POLL_SECONDS = 30
+WATCH_SETTLE_SECONDS = 60
+WATCH_STOP_FILE = "STOP"
+
+# Voxel hash of the parcellated fibers for ROI queries, in the subject output folder
+SPATIAL_INDEX = "spatial_index.npz"
+SPATIAL_INDEX_VOXEL_SIZE = 2.0
+
+# Stage subprocess output goes to <output>/Logs/<stage>.log; the console only gets
+# a progress line every LOG_UPDATE_SECONDS and, on failure, the error lines
+LOG_FOLDER = "Logs"
+LOG_UPDATE_SECONDS = 5.0
+LOG_TAIL_LINES = 200
+# Per-stage timings and results of a subject run, in the subject output folder
+RUN_REPORT = "run_report.json"
+# Opt-in profiling of module code (panel option, or this environment variable, e.g. for
+# queue workers): "cprofile" (deterministic for the calling thread, other threads
+# sampled) or "sample" (stacks of all threads every PROFILE_SAMPLE_INTERVAL seconds);
+# dumps go to <output>/Profiles next to the run report
+PROFILE_ENV = "SLICERWMA_PROFILE"
+PROFILE_MODES = ("cprofile", "sample")
+PROFILE_FOLDER = "Profiles"
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP_FUNCTIONS = 40
+
+# Fibers read at a time by the resampling pre-processing stage
+PREPROCESS_BLOCK_FIBERS = 500000
+
+# Time budget for building the module panel, exceeding it is reported as a warning.
+STARTUP_BUDGET_SECONDS = 0.5
+# whitematteranalysis scripts run by the pipeline, resolved once by the environment probe
+WMA_SCRIPTS = [
+  "wm_register_to_atlas_new.py",
+  "wm_cluster_from_atlas.py",
+  "wm_cluster_remove_outliers.py",
+  "wm_download_anatomically_curated_atlas.py",
+  ]
+
+# helper class for a lock shared by several processes, possibly on several hosts.
+class FileLock(object):
+  def __init__(self, path, timeout=3600, stale=6*3600):
+    self.path = path
+    self.timeout = timeout
+    self.stale = stale
+
+  def __enter__(self):
+    start = time.time()
+    while True:
+      try:
+        fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(fd, f"{socket.gethostname()} {os.getpid()}\n".encode())
+        os.close(fd)
+        return self
+      except FileExistsError:
+        try:
+          # A lock left behind by a killed process is broken after `stale` seconds
+          if time.time() - os.path.getmtime(self.path) > self.stale:
+            os.remove(self.path)
+            continue
+        except OSError:
+          continue
+      if time.time() - start > self.timeout:
+        raise RuntimeError(f"Timed out waiting for lock {self.path}")
+      time.sleep(1)
+
+  def __exit__(self, type, value, traceback):
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+    return False
+
+# helper class holding the fibers (polylines) of a tractography polydata as flat
+# NumPy arrays: fiber i is points[offsets[i]:offsets[i+1]], pointData arrays have
+# one row per point and cellData arrays one row per fiber.
+class FiberArrays(object):
+  def __init__(self, points, offsets, pointData=None, cellData=None, activeArrays=None):
+    self.points = points
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.pointData = pointData if pointData is not None else {}
+    self.cellData = cellData if cellData is not None else {}
+    # names of the active point data attributes, e.g. {"Tensors": "tensors"}
+    self.activeArrays = activeArrays if activeArrays is not None else {}
+
+  @property
+  def numberOfFibers(self):
+    return len(self.offsets) - 1
+
+  @property
+  def numberOfPoints(self):
+    return len(self.points)
+
+  def pointCounts(self):
+    return np.diff(self.offsets)
+
+  def fiberIds(self):
+    # index of the fiber each point belongs to
+    return np.repeat(np.arange(self.numberOfFibers), self.pointCounts())
+
+  def arcLengths(self):
+    # cumulative length along the fibers at every point; segments joining two
+    # fibers are excluded by the mask, so it is constant across fiber ends
+    segments = np.linalg.norm(np.diff(self.points.astype(np.float64), axis=0), axis=1)
+    sameFiber = np.ones(len(segments), dtype=bool)
+    joins = self.offsets[1:-1] - 1
+    sameFiber[joins[(joins >= 0) & (joins < len(segments))]] = False
+    return np.concatenate([[0.0], np.cumsum(np.where(sameFiber, segments, 0.0))])
+
+  def fiberLengths(self):
+    # length of each fiber in mm
+    if not len(self.points):
+      return np.zeros(self.numberOfFibers)
+    cumulative = self.arcLengths()
+    ends = np.maximum(self.offsets[1:] - 1, self.offsets[:-1])
+    return cumulative[ends] - cumulative[self.offsets[:-1]]
+
+  def resample(self, numberOfPoints=0, spacing=0.0, maximumPoints=1000, dtype=np.float32):
+    """New FiberArrays with every fiber resampled at equal arc length steps.
+
+    Fibers get numberOfPoints points, or with spacing (mm) a number of points
+    adapted to their length. Floating point data are linearly interpolated and
+    stored as dtype, other data take the value of the nearest point. The whole
+    polydata is resampled at once, without a loop over fibers.
+    """
+    numberOfFibers = self.numberOfFibers
+    lengths = self.fiberLengths()
+    if spacing:
+      counts = np.clip(np.round(lengths / spacing).astype(np.int64) + 1, 2, maximumPoints)
+    else:
+      counts = np.full(numberOfFibers, int(numberOfPoints), np.int64)
+    counts[self.pointCounts() == 0] = 0
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    fiber = np.repeat(np.arange(numberOfFibers), counts)
+    step = np.arange(offsets[-1]) - offsets[:-1][fiber]
+    fraction = step / np.maximum(counts[fiber] - 1, 1)
+    cumulative = self.arcLengths() if len(self.points) else np.zeros(1)
+    starts = self.offsets[:-1][fiber]
+    ends = self.offsets[1:][fiber] - 1
+    target = cumulative[starts] + fraction * lengths[fiber]
+    # segment [j, j + 1] of the original fiber holding each new point
+    j = np.clip(np.searchsorted(cumulative, target, side="right") - 1, starts, np.maximum(ends - 1, starts))
+    j1 = np.minimum(j + 1, ends)
+    span = cumulative[j1] - cumulative[j]
+    weight = np.clip((target - cumulative[j]) / np.where(span > 0, span, 1.0), 0.0, 1.0)
+
+    def interpolate(values):
+      w = weight.reshape((-1,) + (1,) * (values.ndim - 1))
+      if np.issubdtype(values.dtype, np.floating):
+        return (values[j] * (1.0 - w) + values[j1] * w).astype(dtype)
+      return np.where(w < 0.5, values[j], values[j1])
+
+    return FiberArrays(interpolate(self.points), offsets,
+                       {name: interpolate(values) for name, values in self.pointData.items()},
+                       dict(self.cellData), dict(self.activeArrays))
+
+  def duplicateKeys(self, tolerance, numberOfPoints=8):
+    """64-bit key of every fiber, equal for fibers matching within tolerance (mm).
+
+    Fibers are resampled to numberOfPoints points and quantized on a tolerance
+    grid, reversed when their last point is lexicographically smaller than the
+    first (a fiber and its reverse are the same streamline), and hashed (FNV-1a
+    over the coordinates), all at once. Near-identical fibers that straddle a
+    grid boundary get different keys. Fibers without points have no geometry to
+    compare and get the key 0.
+    """
+    nonEmpty = np.flatnonzero(self.pointCounts() > 0)
+    fibers = FiberArrays(self.points, self.offsets).subset(nonEmpty)
+    points = np.floor(fibers.resample(numberOfPoints, dtype=np.float64).points / tolerance).astype(np.int64)
+    points = points.reshape(len(nonEmpty), numberOfPoints, 3)
+    difference = points[:, -1] - points[:, 0]
+    # sign of the first non-zero coordinate of last - first
+    first = np.argmax(difference != 0, axis=1)
+    reverse = difference[np.arange(len(nonEmpty)), first] < 0
+    points[reverse] = points[reverse, ::-1]
+    points = points.reshape(len(nonEmpty), -1).astype(np.uint64)
+    hashes = np.full(len(nonEmpty), 1469598103934665603, np.uint64)
+    with np.errstate(over="ignore"):
+      for column in points.T:
+        hashes = (hashes ^ column) * np.uint64(1099511628211)
+    keys = np.zeros(self.numberOfFibers, np.uint64)
+    keys[nonEmpty] = hashes
+    return keys
+
+  def fiberSums(self, values):
+    # sum of a point array over each fiber
+    counts = self.pointCounts()
+    sums = np.zeros((self.numberOfFibers,) + values.shape[1:])
+    nonEmpty = counts > 0
+    if nonEmpty.any():
+      sums[nonEmpty] = np.add.reduceat(values.astype(np.float64), self.offsets[:-1][nonEmpty], axis=0)
+    return sums
+
+  def fiberMeans(self, values):
+    # mean of a point array over each fiber (NaN for empty fibers)
+    counts = self.pointCounts()
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return self.fiberSums(values) / counts.reshape((-1,) + (1,) * (values.ndim - 1))
+
+  @staticmethod
+  def fromPolyData(polydata):
+    from vtk.util import numpy_support
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()) if polydata.GetPoints() else np.zeros((0, 3), np.float32)
+    lines = polydata.GetLines()
+    offsets = numpy_support.vtk_to_numpy(lines.GetOffsetsArray()).astype(np.int64)
+    connectivity = numpy_support.vtk_to_numpy(lines.GetConnectivityArray())
+    if len(offsets) == 0:
+      offsets = np.zeros(1, np.int64)
+    # Fibers usually own consecutive points; otherwise gather them in fiber order
+    pointIds = None if np.array_equal(connectivity, np.arange(len(points))) else connectivity
+    pointData = {}
+    activeArrays = {}
+    pd = polydata.GetPointData()
+    for i in range(pd.GetNumberOfArrays()):
+      array = pd.GetArray(i)
+      if array is None or not array.GetName():
+        continue
+      values = numpy_support.vtk_to_numpy(array)
+      pointData[array.GetName()] = values if pointIds is None else values[pointIds]
+    for attribute, active in (("Scalars", pd.GetScalars()), ("Tensors", pd.GetTensors()), ("Vectors", pd.GetVectors())):
+      if active is not None and active.GetName():
+        activeArrays[attribute] = active.GetName()
+    cellData = {}
+    cd = polydata.GetCellData()
+    if polydata.GetNumberOfCells() == len(offsets) - 1:
+      for i in range(cd.GetNumberOfArrays()):
+        array = cd.GetArray(i)
+        if array is not None and array.GetName():
+          cellData[array.GetName()] = numpy_support.vtk_to_numpy(array)
+    return FiberArrays(points if pointIds is None else points[pointIds], offsets, pointData, cellData, activeArrays)
+
+  @staticmethod
+  def concatenate(parts):
+    # Append several FiberArrays; every output array is allocated once at its final
+    # size. Only arrays present in all non-empty parts are kept.
+    nonEmpty = [part for part in parts if part.numberOfFibers > 0] or parts[:1]
+    if not nonEmpty:
+      return FiberArrays(np.zeros((0, 3), np.float32), np.zeros(1, np.int64))
+    first = nonEmpty[0]
+    numberOfPoints = sum(part.numberOfPoints for part in nonEmpty)
+    numberOfFibers = sum(part.numberOfFibers for part in nonEmpty)
+    pointData = {name: np.empty((numberOfPoints,) + a.shape[1:], a.dtype) for name, a in first.pointData.items()
+                 if all(name in part.pointData for part in nonEmpty)}
+    cellData = {name: np.empty((numberOfFibers,) + a.shape[1:], a.dtype) for name, a in first.cellData.items()
+                if all(name in part.cellData for part in nonEmpty)}
+    points = np.empty((numberOfPoints, 3), first.points.dtype)
+    offsets = np.empty(numberOfFibers + 1, np.int64)
+    offsets[0] = 0
+    p = c = 0
+    for part in nonEmpty:
+      n, m = part.numberOfPoints, part.numberOfFibers
+      points[p:p + n] = part.points
+      offsets[c + 1:c + m + 1] = part.offsets[1:] + p
+      for name in pointData:
+        pointData[name][p:p + n] = part.pointData[name]
+      for name in cellData:
+        cellData[name][c:c + m] = part.cellData[name]
+      p += n
+      c += m
+    return FiberArrays(points, offsets, pointData, cellData, dict(first.activeArrays))
+
+  def toPolyData(self):
+    from vtk.util import numpy_support
+    polydata = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(self.points), deep=1))
+    polydata.SetPoints(points)
+    lines = vtk.vtkCellArray()
+    idType = np.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else np.int32
+    lines.SetData(numpy_support.numpy_to_vtkIdTypeArray(self.offsets.astype(idType), deep=1),
+                  numpy_support.numpy_to_vtkIdTypeArray(np.arange(self.numberOfPoints, dtype=idType), deep=1))
+    polydata.SetLines(lines)
+    for data, arrays in ((polydata.GetPointData(), self.pointData), (polydata.GetCellData(), self.cellData)):
+      for name, values in arrays.items():
+        array = numpy_support.numpy_to_vtk(np.ascontiguousarray(values), deep=1)
+        array.SetName(name)
+        data.AddArray(array)
+    pd = polydata.GetPointData()
+    for attribute, name in self.activeArrays.items():
+      if name in self.pointData:
+        getattr(pd, "SetActive" + attribute)(name)
+    return polydata
+
+  def subset(self, fiberIndices):
+    # new FiberArrays with the given fibers, in the given order
+    fiberIndices = np.asarray(fiberIndices)
+    if fiberIndices.dtype == bool:
+      fiberIndices = np.flatnonzero(fiberIndices)
+    counts = self.pointCounts()[fiberIndices]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    # point index of every point of the selected fibers, without a Python loop
+    pointIndex = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[fiberIndices], counts)
+    return FiberArrays(self.points[pointIndex], offsets,
+                       {name: values[pointIndex] for name, values in self.pointData.items()},
+                       {name: values[fiberIndices] for name, values in self.cellData.items()},
+                       dict(self.activeArrays))
+
+# helper class reading a binary legacy VTK (.vtk) polydata file of fibers in blocks.
+# The file is memory-mapped and only parsed for the position of its sections, so
+# that a block of fibers, with their point and cell data, can be read without
+# loading the whole file. Both the 4.x (counts interleaved with the point ids)
+# and the 5.x (OFFSETS and CONNECTIVITY) layouts of the lines are supported.
+class LegacyFiberFile(object):
+  TYPES = {"bit": "u1", "unsigned_char": "u1", "char": "i1", "unsigned_short": ">u2", "short": ">i2",
+           "unsigned_int": ">u4", "int": ">i4", "unsigned_long": ">u8", "long": ">i8", "vtkidtype": ">i4",
+           "vtktypeint64": ">i8", "vtktypeuint64": ">u8", "float": ">f4", "double": ">f8"}
+  COMPONENTS = {"VECTORS": 3, "NORMALS": 3, "TENSORS": 9, "TENSORS6": 6}
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.points = None
+    self.lines = None
+    self.pointData = {}
+    self.cellData = {}
+    self.activeArrays = {}
+    with open(filename, "rb") as f:
+      f.readline()
+      f.readline()
+      if f.readline().strip().upper() != b"BINARY":
+        raise ValueError(f"{filename} is not a binary legacy VTK file")
+      if f.readline().split()[-1].upper() != b"POLYDATA":
+        raise ValueError(f"{filename} is not a polydata file")
+      self._parse(f)
+    if self.points is None or self.lines is None:
+      raise ValueError(f"{filename} has no fibers")
+    self._offsets = None
+
+  def _array(self, f, dtype, shape):
+    # memory-map the binary data at the current position and skip it
+    dtype = np.dtype(self.TYPES[dtype.lower()])
+    array = np.memmap(self.filename, dtype=dtype, mode="r", offset=f.tell(), shape=shape)
+    f.seek(dtype.itemsize * int(np.prod(shape)), 1)
+    return array
+
+  def _parse(self, f):
+    target = None
+    while True:
+      line = f.readline()
+      if not line:
+        break
+      words = line.decode("ascii", "replace").split()
+      if not words:
+        continue
+      keyword = words[0].upper()
+      if keyword == "POINTS":
+        self.points = self._array(f, words[2], (int(words[1]), 3))
+      elif keyword in ("LINES", "VERTICES", "POLYGONS", "TRIANGLE_STRIPS"):
+        position = f.tell()
+        following = f.readline().split()
+        if following and following[0].upper() == b"OFFSETS":
+          offsets = self._array(f, following[1].decode(), (int(words[1]),))
+          f.readline()
+          connectivity = self._array(f, f.readline().split()[1].decode(), (int(words[2]),))
+          cells = ("5", offsets, connectivity)
+        else:
+          f.seek(position)
+          cells = ("4", int(words[1]), self._array(f, "int", (int(words[2]),)))
+        if keyword == "LINES":
+          self.lines = cells
+      elif keyword in ("POINT_DATA", "CELL_DATA"):
+        target = self.pointData if keyword == "POINT_DATA" else self.cellData
+        count = int(words[1])
+      elif keyword == "FIELD":
+        for i in range(int(words[2])):
+          header = f.readline().split()
+          while not header:
+            header = f.readline().split()
+          name, components, tuples, dtype = header[0].decode(), int(header[1]), int(header[2]), header[3].decode()
+          target[name] = self._array(f, dtype, (tuples, components))
+      elif keyword == "SCALARS":
+        components = int(words[3]) if len(words) > 3 else 1
+        f.readline()  # LOOKUP_TABLE
+        target[words[1]] = self._array(f, words[2], (count, components))
+        if target is self.pointData:
+          self.activeArrays.setdefault("Scalars", words[1])
+      elif keyword in self.COMPONENTS:
+        target[words[1]] = self._array(f, words[2], (count, self.COMPONENTS[keyword]))
+        if target is self.pointData:
+          self.activeArrays.setdefault(keyword.rstrip("6").capitalize(), words[1])
+      elif keyword == "LOOKUP_TABLE":
+        f.seek(4 * int(words[2]), 1)
+      elif keyword == "METADATA":
+        while f.readline().strip():
+          pass
+      else:
+        raise ValueError(f"Unsupported section {keyword} in {self.filename}")
+
+  @property
+  def offsets(self):
+    # first point of every fiber in the point id list, for the 4.x layout computed
+    # on first use by walking the counts window by window
+    if self._offsets is not None:
+      return self._offsets
+    if self.lines[0] == "5":
+      self._offsets = np.asarray(self.lines[1], dtype=np.int64)
+      return self._offsets
+    numberOfFibers, cells = self.lines[1], self.lines[2]
+    offsets = np.zeros(numberOfFibers + 1, np.int64)
+    position = start = 0
+    counts = []
+    for fiber in range(numberOfFibers):
+      if position - start >= len(counts):
+        start = position
+        counts = cells[start:start + (1 << 22)].tolist()
+      count = counts[position - start]
+      offsets[fiber + 1] = offsets[fiber] + count
+      position += count + 1
+    self._offsets = offsets
+    return offsets
+
+  @property
+  def numberOfFibers(self):
+    return len(self.lines[1]) - 1 if self.lines[0] == "5" else self.lines[1]
+
+  def read(self, first, last):
+    # FiberArrays of fibers first to last - 1
+    offsets = self.offsets[first:last + 1] - self.offsets[first]
+    if self.lines[0] == "5":
+      pointIds = self.lines[2][self.offsets[first]:self.offsets[last]]
+    else:
+      # ids of the block follow its counts in the cell array
+      cells = np.asarray(self.lines[2][self.offsets[first] + first:self.offsets[last] + last])
+      isCount = np.zeros(len(cells), bool)
+      isCount[offsets[:-1] + np.arange(last - first)] = True
+      pointIds = cells[~isCount]
+    pointIds = np.asarray(pointIds, dtype=np.int64)
+    return FiberArrays(self._values(self.points, pointIds), offsets,
+                       {name: self._values(a, pointIds) for name, a in self.pointData.items()},
+                       {name: self._values(a, slice(first, last)) for name, a in self.cellData.items()},
+                       dict(self.activeArrays))
+
+  def take(self, fiberIndices):
+    # FiberArrays of the given fibers, in the given order
+    fiberIndices = np.asarray(fiberIndices, dtype=np.int64)
+    starts = self.offsets[fiberIndices]
+    counts = self.offsets[fiberIndices + 1] - starts
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)
+    if self.lines[0] != "5":
+      # skip the count preceding each fiber in the cell array
+      positions += np.repeat(fiberIndices + 1, counts)
+    pointIds = np.asarray(self.lines[2][positions], dtype=np.int64)
+    return FiberArrays(self._values(self.points, pointIds), offsets,
+                       {name: self._values(a, pointIds) for name, a in self.pointData.items()},
+                       {name: self._values(a, fiberIndices) for name, a in self.cellData.items()},
+                       dict(self.activeArrays))
+
+  @staticmethod
+  def _values(array, index):
+    # rows of a memory-mapped array in native byte order, single components flattened
+    values = array[index]
+    values = values.astype(values.dtype.newbyteorder("="))
+    return values[:, 0] if values.shape[1] == 1 else values
+
+  def blocks(self, blockSize):
+    for first in range(0, self.numberOfFibers, blockSize):
+      yield self.read(first, min(first + blockSize, self.numberOfFibers))
+
+# helper class writing fibers to a binary legacy VTK (.vtk) polydata file block by
+# block, in the 5.1 layout with 64-bit offsets, so that no point id overflows. The
+# points, the line offsets and each data array are spooled to their own file next
+# to the output and joined on close, so only the current block is held in memory.
+# Arrays are taken from the first block; active point data attributes are written
+# as such.
+class LegacyFiberWriter(object):
+  TYPES = {"u1": "unsigned_char", "i1": "char", "u2": "unsigned_short", "i2": "short", "u4": "unsigned_int",
+           "i4": "int", "u8": "vtktypeuint64", "i8": "vtktypeint64", "f4": "float", "f8": "double"}
+  COMPONENTS = {"Vectors": 3, "Tensors": 9}
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.folder = filename + ".sections"
+    self.numberOfFibers = 0
+    self.numberOfPoints = 0
+    # (type, components) of the points and of every array, from the first block
+    self.arrays = None
+    self.activeArrays = {}
+    self.sections = {}
+    os.makedirs(self.folder, exist_ok=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    if type is None:
+      self.close()
+    else:
+      for section in self.sections.values():
+        section.close()
+      shutil.rmtree(self.folder, ignore_errors=True)
+    return False
+
+  @staticmethod
+  def _type(values):
+    # big-endian storage type of an array (booleans as unsigned_char) and its components
+    dtype = np.dtype(np.uint8) if values.dtype == bool else values.dtype
+    return dtype.newbyteorder(">"), int(np.prod(values.shape[1:]))
+
+  def _append(self, key, values):
+    if key not in self.sections:
+      self.sections[key] = open(os.path.join(self.folder, f"{len(self.sections)}.bin"), "wb")
+    self.sections[key].write(np.ascontiguousarray(values, dtype=self.arrays[key][0]).tobytes())
+
+  def write(self, fibers):
+    if self.arrays is None:
+      self.arrays = {"points": self._type(fibers.points), "offsets": (np.dtype(">i8"), 1)}
+      self.arrays.update({("point", name): self._type(values) for name, values in fibers.pointData.items()})
+      self.arrays.update({("cell", name): self._type(values) for name, values in fibers.cellData.items()})
+      self.activeArrays = dict(fibers.activeArrays)
+    # 5.x layout with 64-bit ids: the end offset of every fiber (the leading 0 is
+    # written on close); the points are in fiber order, so the connectivity is 0..n-1
+    self._append("points", fibers.points)
+    self._append("offsets", self.numberOfPoints + np.asarray(fibers.offsets[1:], np.int64))
+    for key in self.arrays:
+      if isinstance(key, tuple):
+        self._append(key, (fibers.pointData if key[0] == "point" else fibers.cellData)[key[1]])
+    self.numberOfFibers += fibers.numberOfFibers
+    self.numberOfPoints += fibers.numberOfPoints
+
+  def _copy(self, output, key):
+    if key in self.sections:
+      self.sections[key].close()
+      with open(self.sections[key].name, "rb") as section:
+        shutil.copyfileobj(section, output, 1 << 24)
+    output.write(b"\n")
+
+  def close(self):
+    arrays = self.arrays or {"points": (np.dtype(">f4"), 3)}
+    typeName = lambda key: self.TYPES[arrays[key][0].str[1:]]
+    attributes = {name: attribute for attribute, name in self.activeArrays.items()}
+    with open(self.filename, "wb") as output:
+      output.write(b"# vtk DataFile Version 5.1\nvtk output\nBINARY\nDATASET POLYDATA\n")
+      output.write(f"POINTS {self.numberOfPoints} {typeName('points')}\n".encode())
+      self._copy(output, "points")
+      if self.numberOfFibers:
+        output.write(f"LINES {self.numberOfFibers + 1} {self.numberOfPoints}\nOFFSETS vtktypeint64\n".encode())
+        output.write(np.zeros(1, ">i8").tobytes())
+        self._copy(output, "offsets")
+        output.write(b"CONNECTIVITY vtktypeint64\n")
+        for start in range(0, self.numberOfPoints, 1 << 22):
+          output.write(np.arange(start, min(start + (1 << 22), self.numberOfPoints), dtype=">i8").tobytes())
+        output.write(b"\n")
+      for location, keyword, count in (("point", "POINT_DATA", self.numberOfPoints), ("cell", "CELL_DATA", self.numberOfFibers)):
+        keys = [key for key in arrays if isinstance(key, tuple) and key[0] == location]
+        if not keys:
+          continue
+        output.write(f"{keyword} {count}\n".encode())
+        fields = []
+        for key in keys:
+          name, components = key[1], arrays[key][1]
+          attribute = attributes.get(name) if location == "point" else None
+          if attribute == "Scalars" and components <= 4:
+            output.write(f"SCALARS {name} {typeName(key)} {components}\nLOOKUP_TABLE default\n".encode())
+          elif attribute in self.COMPONENTS and components == self.COMPONENTS[attribute]:
+            output.write(f"{attribute.upper()} {name} {typeName(key)}\n".encode())
+          else:
+            fields.append(key)
+            continue
+          self._copy(output, key)
+        if fields:
+          output.write(f"FIELD FieldData {len(fields)}\n".encode())
+          for key in fields:
+            output.write(f"{key[1]} {arrays[key][1]} {count} {typeName(key)}\n".encode())
+            self._copy(output, key)
+    shutil.rmtree(self.folder, ignore_errors=True)
+
+# helper class streaming the fibers of a TrackVis (.trk) file in blocks. The body is
+# memory-mapped; as every item of a track record is 4 bytes, a block is gathered
+# with one fancy index once the record positions are known. Points are converted
+# from TrackVis voxmm coordinates to RAS with the vox_to_ras matrix of the header;
+# per-point scalars become point data and per-track properties cell data.
+class TrkFiberFile(object):
+  HEADER_SIZE = 1000
+
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, "rb") as f:
+      raw = f.read(self.HEADER_SIZE)
+    if len(raw) < self.HEADER_SIZE or raw[:5] != b"TRACK":
+      raise ValueError(f"{filename} is not a TrackVis file")
+    e = "<" if np.frombuffer(raw[996:1000], "<i4")[0] == self.HEADER_SIZE else ">"
+    header = np.frombuffer(raw, np.dtype([
+      ("id_string", "S6"), ("dim", e + "i2", 3), ("voxel_size", e + "f4", 3), ("origin", e + "f4", 3),
+      ("n_scalars", e + "i2"), ("scalar_name", "V20", 10), ("n_properties", e + "i2"), ("property_name", "V20", 10),
+      ("vox_to_ras", e + "f4", (4, 4)), ("reserved", "S444"), ("voxel_order", "S4"), ("pad2", "S4"),
+      ("image_orientation_patient", e + "f4", 6), ("pad1", "S2"), ("flags", "u1", 6),
+      ("n_count", e + "i4"), ("version", e + "i4"), ("hdr_size", e + "i4")]))[0]
+    self.header = header
+    self.voxelSize = header["voxel_size"].astype(np.float64)
+    self.affine = header["vox_to_ras"].astype(np.float64)
+    if self.affine[3, 3] == 0:
+      # version 1 files have no vox_to_ras; voxmm coordinates are taken as RAS
+      self.affine = np.diag(list(self.voxelSize) + [1.0])
+    self.scalarNames = self._names(header["scalar_name"], int(header["n_scalars"]), "Scalars", header["version"])
+    self.propertyNames = self._names(header["property_name"], int(header["n_properties"]), "Property", header["version"])
+    self.stride = 3 + int(header["n_scalars"])
+    self.body = np.memmap(filename, dtype=e + "f4", mode="r", offset=self.HEADER_SIZE)
+    self.counts = self.body.view(e + "i4")
+    self.numberOfFibers = int(header["n_count"]) or sum(len(starts) for starts, counts in self._records(1 << 20))
+    # every record is the point count, the points and the properties, 4 bytes each
+    self.numberOfPoints = (len(self.body) - self.numberOfFibers * (1 + int(header["n_properties"]))) // self.stride
+
+  @staticmethod
+  def _names(raw, count, default, version):
+    # (name, components) of the scalars or properties; from version 2 the last byte
+    # of a name holds its number of components
+    names = []
+    for i in range(10):
+      if sum(c for n, c in names) >= count:
+        break
+      data = bytes(raw[i])
+      components = data[-1] if version >= 2 and data[-1] else 1
+      name = data[:-1].split(b"\0")[0].decode("latin-1").strip() if version >= 2 else data.split(b"\0")[0].decode("latin-1").strip()
+      names.append((name or f"{default}{i}", components))
+    if sum(c for n, c in names) != count:
+      names = [(f"{default}{i}", 1) for i in range(count)]
+    return names
+
+  def _records(self, blockSize):
+    # (first value, point count) of the records, blockSize records at a time
+    position, end = 0, len(self.body)
+    properties = int(self.header["n_properties"])
+    while position < end:
+      starts, counts = [], []
+      while position < end and len(starts) < blockSize:
+        count = int(self.counts[position])
+        starts.append(position + 1)
+        counts.append(count)
+        position += 1 + count * self.stride + properties
+      yield np.array(starts, np.int64), np.array(counts, np.int64)
+
+  def _split(self, values, names):
+    data, column = {}, 0
+    for name, components in names:
+      data[name] = values[:, column] if components == 1 else values[:, column:column + components]
+      column += components
+    return data
+
+  def blocks(self, blockSize):
+    for starts, counts in self._records(blockSize):
+      offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+      positions = np.repeat(starts, counts) + (np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)) * self.stride
+      values = np.asarray(self.body[positions[:, None] + np.arange(self.stride)], dtype=np.float32)
+      voxels = values[:, :3] / self.voxelSize - 0.5
+      points = (voxels @ self.affine[:3, :3].T + self.affine[:3, 3]).astype(np.float32)
+      cellData = {}
+      if self.propertyNames:
+        ends = starts + counts * self.stride
+        cellData = self._split(np.asarray(self.body[ends[:, None] + np.arange(len(self.propertyNames))], dtype=np.float32), self.propertyNames)
+      yield FiberArrays(points, offsets, self._split(values[:, 3:], self.scalarNames), cellData)
+
+# helper class streaming the fibers of an MRtrix (.tck) file in blocks. The points,
+# already in RAS scanner coordinates, follow the text header; fibers are separated
+# by a NaN point and the file ends with an Inf point. The memory-mapped data are
+# scanned window by window, a fiber crossing a window is carried to the next one.
+class TckFiberFile(object):
+  TYPES = {"float32le": "<f4", "float32be": ">f4", "float64le": "<f8", "float64be": ">f8"}
+
+  def __init__(self, filename, windowSize=1 << 22):
+    self.filename = filename
+    self.windowSize = windowSize
+    self.header = {}
+    with open(filename, "rb") as f:
+      if f.readline().strip() != b"mrtrix tracks":
+        raise ValueError(f"{filename} is not an MRtrix tracks file")
+      for line in f:
+        line = line.decode("latin-1").strip()
+        if line == "END":
+          break
+        key, _, value = line.partition(":")
+        self.header[key.strip()] = value.strip()
+    dtype = self.TYPES[self.header.get("datatype", "Float32LE").lower()]
+    data = np.memmap(filename, dtype=dtype, mode="r", offset=int(self.header["file"].split()[1]))
+    self.data = data[:len(data) // 3 * 3].reshape(-1, 3)
+    count = self.header.get("count", "").strip()
+    self.numberOfFibers = int(count) if count.isdigit() else sum(block.numberOfFibers for block in self.blocks(1 << 20))
+    # one separator after every fiber, and the end point
+    self.numberOfPoints = max(len(self.data) - self.numberOfFibers - 1, 0)
+
+  def blocks(self, blockSize):
+    pending = np.zeros((0, 3), np.float32)
+    points, counts = [], []
+    buffered = 0
+    for start in range(0, len(self.data), self.windowSize):
+      window = np.concatenate([pending, np.asarray(self.data[start:start + self.windowSize], dtype=np.float32)])
+      end = np.flatnonzero(np.isinf(window[:, 0]))
+      if len(end):
+        # the end marker follows the separator of the last fiber
+        window = window[:end[0]]
+      separators = np.flatnonzero(np.isnan(window[:, 0]))
+      last = separators[-1] + 1 if len(separators) else 0
+      pending = window[last:]
+      if len(separators):
+        starts = np.concatenate([[0], separators[:-1] + 1])
+        counts.append(separators - starts)
+        points.append(window[:last][~np.isnan(window[:last, 0])])
+        buffered += len(separators)
+      while buffered >= blockSize:
+        block, points, counts = self._take(points, counts, blockSize)
+        buffered -= blockSize
+        yield block
+      if len(end):
+        break
+    while buffered > 0:
+      block, points, counts = self._take(points, counts, min(blockSize, buffered))
+      buffered -= block.numberOfFibers
+      yield block
+
+  @staticmethod
+  def _take(points, counts, numberOfFibers):
+    # FiberArrays of the first numberOfFibers buffered fibers, and the rest of the buffer
+    points, counts = np.concatenate(points), np.concatenate(counts)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    used = offsets[numberOfFibers]
+    block = FiberArrays(points[:used], offsets[:numberOfFibers + 1])
+    return block, [points[used:]], [counts[numberOfFibers:]]
+
+# helper class for a voxel hash of fibers answering "what passes through this region"
+# queries. Every (voxel, fiber group) pair crossed by fiber segments is stored once,
+# sorted by voxel key, with the number of fibers of the group crossing the voxel;
+# a group is a fiber file such as an anatomical tract or a cluster.
+class SpatialIndex(object):
+  OFFSET = 1 << 20
+
+  def __init__(self, keys, groups, counts, names, voxelSize):
+    self.keys = keys
+    self.groups = groups
+    self.counts = counts
+    self.names = list(names)
+    self.voxelSize = float(voxelSize)
+
+  @classmethod
+  def voxelKeys(cls, voxels):
+    # pack integer voxel coordinates into one int64 key (21 bits per axis)
+    voxels = voxels.astype(np.int64) + cls.OFFSET
+    return (voxels[:, 0] << 42) | (voxels[:, 1] << 21) | voxels[:, 2]
+
+  @staticmethod
+  def fiberVoxels(fibers, voxelSize):
+    # (voxel key, fiber) pairs of the segments of a FiberArrays, segments are
+    # sampled at half the voxel size so that no crossed voxel is missed
+    if fibers.numberOfPoints == 0:
+      return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    points = fibers.points.astype(np.float64)
+    fiberIds = fibers.fiberIds()
+    sameFiber = fiberIds[1:] == fiberIds[:-1]
+    start, end = points[:-1][sameFiber], points[1:][sameFiber]
+    steps = np.maximum(np.ceil(np.linalg.norm(end - start, axis=1) / (voxelSize / 2.0)).astype(np.int64), 1)
+    segment = np.repeat(np.arange(len(start)), steps)
+    t = (np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+    samples = np.concatenate([points, start[segment] + (end - start)[segment] * t[:, None]])
+    sampleFibers = np.concatenate([fiberIds, fiberIds[:-1][sameFiber][segment]])
+    return SpatialIndex.voxelKeys(np.floor(samples / voxelSize)), sampleFibers
+
+  @classmethod
+  def groupVoxels(cls, fibers, voxelSize):
+    # voxel keys crossed by a FiberArrays and the number of its fibers crossing each
+    voxelKeys, fiberIds = cls.fiberVoxels(fibers, voxelSize)
+    if not len(voxelKeys):
+      return np.zeros(0, np.int64), np.zeros(0, np.int32)
+    order = np.lexsort((fiberIds, voxelKeys))
+    voxelKeys, fiberIds = voxelKeys[order], fiberIds[order]
+    # keep each (voxel, fiber) pair once, then count fibers per voxel
+    newPair = np.ones(len(voxelKeys), bool)
+    newPair[1:] = (voxelKeys[1:] != voxelKeys[:-1]) | (fiberIds[1:] != fiberIds[:-1])
+    voxelKeys = voxelKeys[newPair]
+    starts = np.flatnonzero(np.concatenate([[True], voxelKeys[1:] != voxelKeys[:-1]]))
+    return voxelKeys[starts], np.diff(np.append(starts, len(voxelKeys))).astype(np.int32)
+
+  @classmethod
+  def build(cls, groups, voxelSize=2.0, numberOfJobs=1):
+    # index of {name: FiberArrays}
+    from concurrent.futures import ThreadPoolExecutor
+    names = list(groups)
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      voxels = list(executor.map(lambda name: cls.groupVoxels(groups[name], voxelSize), names))
+    keys = np.concatenate([np.zeros(0, np.int64)] + [k for k, c in voxels])
+    counts = np.concatenate([np.zeros(0, np.int32)] + [c for k, c in voxels])
+    groupIds = np.repeat(np.arange(len(names), dtype=np.int32), [len(k) for k, c in voxels])
+    order = np.argsort(keys, kind="stable")
+    return cls(keys[order], groupIds[order], counts[order], names, voxelSize)
+
+  def save(self, filename):
+    partial = filename + ".partial.npz"
+    np.savez_compressed(partial, keys=self.keys, groups=self.groups, counts=self.counts,
+                        names=np.array(self.names), voxelSize=self.voxelSize)
+    os.replace(partial, filename)
+
+  @classmethod
+  def load(cls, filename):
+    with np.load(filename) as data:
+      return cls(data["keys"], data["groups"], data["counts"], data["names"].tolist(), data["voxelSize"])
+
+  def _query(self, voxelKeys):
+    # {group name: (voxels, largest fiber count in one voxel)} of the given voxel keys
+    voxelKeys = np.unique(voxelKeys)
+    first = np.searchsorted(self.keys, voxelKeys, side="left")
+    last = np.searchsorted(self.keys, voxelKeys, side="right")
+    lengths = last - first
+    rows = np.repeat(first - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+    groups = self.groups[rows]
+    voxels = np.bincount(groups, minlength=len(self.names))
+    fibers = np.zeros(len(self.names), np.int64)
+    np.maximum.at(fibers, groups, self.counts[rows])
+    return {self.names[group]: (int(voxels[group]), int(fibers[group])) for group in np.flatnonzero(voxels)}
+
+  def queryBox(self, lower, upper):
+    # groups crossing an axis aligned box
+    low = np.floor(np.asarray(lower, float) / self.voxelSize).astype(np.int64)
+    high = np.floor(np.asarray(upper, float) / self.voxelSize).astype(np.int64)
+    grid = np.stack(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(low, high)], indexing="ij"), axis=-1).reshape(-1, 3)
+    return self._query(self.voxelKeys(grid))
+
+  def querySpheres(self, centers, radius):
+    # groups crossing any of the spheres, voxels whose center is within radius
+    centers = np.atleast_2d(np.asarray(centers, float))
+    reach = int(np.ceil(radius / self.voxelSize))
+    steps = np.arange(-reach, reach + 1)
+    neighbors = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"), axis=-1).reshape(-1, 3)
+    voxels = (np.floor(centers / self.voxelSize).astype(np.int64)[:, None, :] + neighbors[None]).reshape(-1, 3)
+    voxelCenters = (voxels + 0.5) * self.voxelSize
+    distances = np.linalg.norm(voxelCenters - np.repeat(centers, len(neighbors), axis=0), axis=1)
+    return self._query(self.voxelKeys(voxels[distances <= radius + self.voxelSize * 0.87]))
+
+# helper class for a cohort table of diffusion measurements (subject x bundle x metric)
+# maintained incrementally. Each finished subject is written as a small segment file,
+# and segments are merged into the columnar cohort.npz by compact(), under a FileLock
+# so that workers on several hosts can add subjects to the same store. A subject
+# added again replaces its previous rows.
+class CohortStore(object):
+  def __init__(self, folder):
+    self.folder = os.path.abspath(folder)
+    self.segmentsFolder = os.path.join(self.folder, "segments")
+    os.makedirs(self.segmentsFolder, exist_ok=True)
+    self.path = os.path.join(self.folder, "cohort.npz")
+
+  def add(self, subject, groups):
+    # groups: {group: {bundle: {metric: value}}}, e.g. as read by read_measurement_csv
+    rows = [(group, bundle, measurements) for group in sorted(groups) for bundle, measurements in sorted(groups[group].items())]
+    metrics = sorted(set(metric for group, bundle, measurements in rows for metric in measurements))
+    values = np.array([[measurements.get(metric, np.nan) for metric in metrics] for group, bundle, measurements in rows],
+                      dtype=np.float64).reshape(len(rows), len(metrics))
+    table = {"subject": np.array([subject] * len(rows), dtype=str), "group": np.array([r[0] for r in rows], dtype=str),
+             "bundle": np.array([r[1] for r in rows], dtype=str), "metrics": np.array(metrics, dtype=str), "values": values}
+    segment = os.path.join(self.segmentsFolder, f"{subject}.{time.time_ns()}.npz")
+    self._save(table, segment)
+    return segment
+
+  @staticmethod
+  def _save(table, filename):
+    partial = filename + ".partial.npz"
+    np.savez(partial, **table)
+    os.replace(partial, filename)
+
+  @staticmethod
+  def _load(filename):
+    with np.load(filename) as data:
+      return {name: data[name] for name in data.files}
+
+  def _segments(self):
+    # segment files in the order they were added
+    names = [n for n in os.listdir(self.segmentsFolder) if n.endswith(".npz") and not n.endswith(".partial.npz")]
+    return [os.path.join(self.segmentsFolder, n) for n in sorted(names, key=lambda n: int(n.split(".")[-2]))]
+
+  @staticmethod
+  def _merge(tables):
+    # one table sorted by subject, group and bundle; later tables replace the subjects they hold
+    metrics = sorted(set(metric for table in tables for metric in table["metrics"].tolist()))
+    kept = []
+    replaced = set()
+    for table in reversed(tables):
+      subjects = set(table["subject"].tolist())
+      keep = ~np.isin(table["subject"], list(replaced)) if replaced else np.ones(len(table["subject"]), bool)
+      replaced |= subjects
+      kept.append((table, keep))
+    columns = {name: [] for name in ("subject", "group", "bundle")}
+    values = []
+    for table, keep in reversed(kept):
+      for name in columns:
+        columns[name].append(table[name][keep].astype(str))
+      block = np.full((int(keep.sum()), len(metrics)), np.nan)
+      positions = [metrics.index(metric) for metric in table["metrics"].tolist()]
+      if positions:
+        block[:, positions] = table["values"][keep]
+      values.append(block)
+    merged = {name: np.concatenate(parts) if parts else np.zeros(0, str) for name, parts in columns.items()}
+    merged["values"] = np.concatenate(values) if values else np.zeros((0, len(metrics)))
+    merged["metrics"] = np.array(metrics, dtype=str)
+    order = np.lexsort((merged["bundle"], merged["group"], merged["subject"]))
+    for name in ("subject", "group", "bundle", "values"):
+      merged[name] = merged[name][order]
+    return merged
+
+  def compact(self):
+    # Merge the segments into cohort.npz and remove them
+    with FileLock(os.path.join(self.folder, ".lock")):
+      segments = self._segments()
+      if not segments:
+        return
+      tables = ([self._load(self.path)] if os.path.isfile(self.path) else []) + [self._load(f) for f in segments]
+      self._save(self._merge(tables), self.path)
+      for segment in segments:
+        os.remove(segment)
+
+  def table(self):
+    # The whole cohort, including subjects not compacted yet
+    tables = ([self._load(self.path)] if os.path.isfile(self.path) else []) + [self._load(f) for f in self._segments()]
+    return self._merge(tables)
+
+  def subjects(self):
+    return sorted(set(self.table()["subject"].tolist()))
+
+  def subject(self, subject, table=None):
+    # {(group, bundle): {metric: value}} of one subject
+    table = table if table is not None else self.table()
+    first = np.searchsorted(table["subject"], subject, side="left")
+    last = np.searchsorted(table["subject"], subject, side="right")
+    metrics = table["metrics"].tolist()
+    return {(str(table["group"][i]), str(table["bundle"][i])): dict(zip(metrics, table["values"][i].tolist())) for i in range(first, last)}
+
+  def bundle(self, bundle, metric, group=None, table=None):
+    # {subject: value} of one metric of a bundle (tract or cluster) across the cohort
+    table = table if table is not None else self.table()
+    mask = table["bundle"] == bundle
+    if group is not None:
+      mask &= table["group"] == group
+    column = table["metrics"].tolist().index(metric)
+    return dict(zip(table["subject"][mask].tolist(), table["values"][mask, column].tolist()))
+
+# helper class for a queue of subjects shared by worker processes on one or several
+# hosts. The queue is a folder on a shared filesystem with one JSON file per subject,
+# moved between the pending, leased, done and failed subfolders by atomic renames,
+# so that exactly one worker leases a subject. A leased subject has a .lease file
+# touched by its worker as a heartbeat; leases not renewed for leaseTimeout seconds
+# are put back in the queue by any worker. Every lease has a random token, stored in
+# the .lease file and the task: heartbeat, complete and fail only act for the
+# current token, so a worker whose lease expired cannot touch the next lease.
+class SubjectWorkQueue(object):
+  STATES = ("pending", "leased", "done", "failed")
+
+  def __init__(self, folder, leaseTimeout=600, maxAttempts=3):
+    self.folder = os.path.abspath(folder)
+    self.leaseTimeout = leaseTimeout
+    self.maxAttempts = maxAttempts
+    for state in self.STATES:
+      os.makedirs(os.path.join(self.folder, state), exist_ok=True)
+
+  def _path(self, state, subjectID, suffix=".json"):
+    return os.path.join(self.folder, state, subjectID + suffix)
+
+  def _write(self, path, task):
+    temporary = f"{path}.{socket.gethostname()}-{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+      json.dump(task, f, indent=1)
+    os.replace(temporary, path)
+
+  def _read(self, path):
+    with open(path) as f:
+      return json.load(f)
+
+  def state(self, subjectID):
+    for state in self.STATES:
+      if os.path.isfile(self._path(state, subjectID)):
+        return state
+    return None
+
+  def task(self, subjectID):
+    state = self.state(subjectID)
+    try:
+      return None if state is None else self._read(self._path(state, subjectID))
+    except (OSError, ValueError):
+      return None  # moved by a worker meanwhile
+
+  def enqueue(self, subjectID, task, force=False):
+    # Add a subject unless it is already queued, running or finished
+    current = self.state(subjectID)
+    if current is not None and not (force and current in ("done", "failed")):
+      return False
+    if current is not None:
+      os.remove(self._path(current, subjectID))
+    task = dict(task, subject=subjectID, attempts=0, enqueued=time.time())
+    self._write(self._path("pending", subjectID), task)
+    return True
+
+  def lease(self, workerID):
+    # Take the next pending subject, or return None if there is none
+    self.requeueExpired()
+    for name in sorted(os.listdir(os.path.join(self.folder, "pending"))):
+      if not name.endswith(".json"):
+        continue
+      subjectID = name[:-len(".json")]
+      try:
+        os.rename(self._path("pending", subjectID), self._path("leased", subjectID))
+      except OSError:
+        continue  # leased by another worker
+      lease = os.urandom(8).hex()
+      with open(self._path("leased", subjectID, ".lease"), "w") as f:
+        f.write(f"{lease} {workerID}")
+      task = self._read(self._path("leased", subjectID))
+      task.update(worker=workerID, leased=time.time(), lease=lease)
+      self._write(self._path("leased", subjectID), task)
+      return task
+    return None
+
+  def owns(self, subjectID, lease):
+    # Whether the lease token (task["lease"] of lease()) still holds the subject
+    try:
+      with open(self._path("leased", subjectID, ".lease")) as f:
+        return f.read().split()[:1] == [lease]
+    except OSError:
+      return False
+
+  def heartbeat(self, subjectID, lease):
+    # Renew a lease; False if it is not held anymore (it expired and was requeued)
+    if not self.owns(subjectID, lease):
+      return False
+    os.utime(self._path("leased", subjectID, ".lease"))
+    return True
+
+  def _release(self, subjectID, lease, update):
+    # Move a subject out of leased, to the state returned by update(task), if the lease
+    # still holds it; returns whether it did
+    if not self.owns(subjectID, lease):
+      return False
+    claimed = self._path("leased", subjectID, f".json.release-{lease}")
+    try:
+      os.rename(self._path("leased", subjectID), claimed)
+    except OSError:
+      return False  # requeued meanwhile
+    task = self._read(claimed)
+    if task.get("lease") != lease:
+      # requeued and leased again between the checks: not ours to release
+      os.rename(claimed, self._path("leased", subjectID))
+      return False
+    state = update(task)
+    try:
+      os.remove(self._path("leased", subjectID, ".lease"))
+    except OSError:
+      pass
+    self._write(claimed, task)
+    os.rename(claimed, self._path(state, subjectID))
+    return True
+
+  def complete(self, subjectID, lease, result=None):
+    def update(task):
+      task.update(finished=time.time(), result=result)
+      return "done"
+    return self._release(subjectID, lease, update)
+
+  def fail(self, subjectID, lease, error):
+    def update(task):
+      task["attempts"] = task.get("attempts", 0) + 1
+      task["error"] = str(error)
+      return "pending" if task["attempts"] < self.maxAttempts else "failed"
+    return self._release(subjectID, lease, update)
+
+  def requeueExpired(self):
+    now = time.time()
+    for name in os.listdir(os.path.join(self.folder, "leased")):
+      if not name.endswith(".json"):
+        continue
+      subjectID = name[:-len(".json")]
+      try:
+        # the lease file is written right after leasing; until then the rename time counts
+        heartbeat = os.path.getmtime(self._path("leased", subjectID, ".lease"))
+      except OSError:
+        try:
+          heartbeat = os.path.getctime(self._path("leased", subjectID))
+        except OSError:
+          continue
+      if now - heartbeat < self.leaseTimeout:
+        continue
+      claimed = self._path("leased", subjectID, f".json.requeue-{socket.gethostname()}-{os.getpid()}")
+      try:
+        os.rename(self._path("leased", subjectID), claimed)
+      except OSError:
+        continue  # requeued by another worker
+      # the lease file goes first: once the subject is pending, a new lease writes its own
+      try:
+        os.remove(self._path("leased", subjectID, ".lease"))
+      except OSError:
+        pass
+      task = self._read(claimed)
+      task["attempts"] = task.get("attempts", 0) + 1
+      task["error"] = f"lease of worker {task.get('worker')} expired"
+      logging.warning(f"Subject {subjectID}: {task['error']}, requeued")
+      self._write(claimed, task)
+      os.rename(claimed, self._path("pending" if task["attempts"] < self.maxAttempts else "failed", subjectID))
+
+  def counts(self):
+    return {state: len([n for n in os.listdir(os.path.join(self.folder, state)) if n.endswith(".json")])
+            for state in self.STATES}
+
+# raised in the stages of a subject whose processing is aborted, e.g. by a queue
+# worker that lost its lease. A BaseException, so that the stages that log errors and
+# go on do not catch it.
+class SubjectAborted(BaseException):
+  pass
+
 #
 # AnatomicalTractParcellation
 #
@@ -40,13 +1320,17 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
 
   def __init__(self, parent=None):
         super(AnatomicalTractParcellationWidget, self).__init__(parent)
+        self.watchStopEvent = None
 
 
   def setup(self):
 
+    startTime = time.perf_counter()
     ScriptedLoadableModuleWidget.setup(self)
 
     self.logic = AnatomicalTractParcellationLogic()
+    # Use the cached environment probe to build the panel, it is refreshed in the background
+    self.environment = self.logic.getEnvironment()
 
     #
     # Message Area: check if WMA and ORG Atlas exist
@@ -65,18 +1349,10 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
     self.installCollapsibleButton.text = "Installation"
     self.installCollapsibleButton.collapsed = self.wmaInstalled and self.atlasExisted
     self.layout.addWidget(self.installCollapsibleButton)
-    parametersFormLayout = qt.QFormLayout(self.installCollapsibleButton)
-
-    self.installWMAButton = qt.QPushButton("Install WMA")
-    self.installWMAButton.toolTip = "Install whitematteranalysis software package"
-    self.installWMAButton.enabled = not self.wmaInstalled
-    parametersFormLayout.addRow(self.installWMAButton)
-    self.installWMAButton.connect('clicked(bool)', self.onInstallWMA)
-
-    self.downloadAtlasButton = qt.QPushButton("Download WM atlas")
-    self.downloadAtlasButton.toolTip = "Download the ORG white matter atlas"
-    self.downloadAtlasButton.enabled = not self.atlasExisted
-    parametersFormLayout.addRow(self.downloadAtlasButton)
+    self.installCollapsibleButton.connect('contentsCollapsed(bool)', self.onInstallationCollapsed)
+    self.installationWidgetsCreated = False
+    if not self.installCollapsibleButton.collapsed:
+      self.setupInstallationWidgets()
 
     #
     # Input parameters area
@@ -85,7 +1361,6 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
     self.inputsCollapsibleButton.text = "IO"
     self.layout.addWidget(self.inputsCollapsibleButton)
     parametersFormLayout = qt.QFormLayout(self.inputsCollapsibleButton)
-    self.downloadAtlasButton.connect('clicked(bool)', self.onDownloadAtlas)
 
     self.loadmode = None  # Initialize self.loadmode
 
@@ -319,6 +1594,45 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
         w.setToolTip("Choose the type of the regmode")
         parametersFormLayout.addRow("Registration mode: ", self.regModeSelector)
 
+    #
+    # Registration preset and its parameters
+    #
+
+    with It(qt.QComboBox()) as w:
+        self.regPresetSelector = w
+        for preset in REGISTRATION_PRESETS:
+          w.addItem(preset)
+        w.currentText = DEFAULT_REGISTRATION_PRESET
+        w.setToolTip("fast QC: fewer fibers and the fast affine mode. standard: default parameters. accurate: more fibers and full affine optimization.")
+        parametersFormLayout.addRow("Registration preset: ", self.regPresetSelector)
+
+    with It(qt.QSpinBox()) as w:
+        self.regFibersSelector = w
+        w.minimum = 1000
+        w.maximum = 200000
+        w.singleStep = 1000
+        w.setToolTip("Number of fibers sampled for registration (-f)")
+        parametersFormLayout.addRow("Registration fibers: ", self.regFibersSelector)
+
+    with It(qt.QSpinBox()) as w:
+        self.regLengthMinSelector = w
+        w.minimum = 0
+        w.maximum = 500
+        w.suffix = " mm"
+        w.setToolTip("Minimum length of the fibers used for registration (-l)")
+        parametersFormLayout.addRow("Registration min fiber length: ", self.regLengthMinSelector)
+
+    with It(qt.QSpinBox()) as w:
+        self.regLengthMaxSelector = w
+        w.minimum = 10
+        w.maximum = 1000
+        w.suffix = " mm"
+        w.setToolTip("Maximum length of the fibers used for registration (-lmax)")
+        parametersFormLayout.addRow("Registration max fiber length: ", self.regLengthMaxSelector)
+
+    self.regPresetSelector.currentTextChanged.connect(self.onRegistrationPresetChanged)
+    self.onRegistrationPresetChanged(self.regPresetSelector.currentText)
+
     #
     # CleanMode selector
     #
@@ -335,26 +1649,352 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
 
     with It(ctk.ctkSliderWidget()) as w:
         self.NumThreadsSelector = w
-        if os.name == 'posix':
-          command = "sysctl -n hw.ncpu"
-          output = subprocess.check_output(command, shell=True)
-          # Decode the bytes output to string and get the available CPU core count
-          available_cores = int(output.decode().strip())
-        elif os.name == 'nt':
-          command = "wmic cpu get NumberOfCores"
-          output = subprocess.check_output(command, shell=True)
-          # Decode the bytes output to string and extract the available CPU core count
-          lines = output.decode().split("\n")
-          for line in lines:
-              if line.strip().isdigit():
-                  available_cores = int(line.strip())
-                  break
+        available_cores = self.environment.get("cores") or 1
         w.minimum = 1
         w.maximum = available_cores # Represents the maximum number of available processors
         w.singleStep = 1
         w.setToolTip("control the NumThreads value")
         parametersFormLayout.addRow("Number of threads: ",self.NumThreadsSelector)
+
+    #
+    # Preview (quick-look) mode
+    #
+
+    with It(qt.QSpinBox()) as w:
+        self.previewFibersSelector = w
+        w.minimum = 0
+        w.maximum = 10000000
+        w.singleStep = 1000
+        w.value = 0
+        w.specialValueText = "off"
+        w.setToolTip("Run the whole pipeline on this many subsampled fibers for a quick QC result (stored in a 'Preview' subfolder). 0 runs on all fibers.")
+        parametersFormLayout.addRow("Preview fibers: ", self.previewFibersSelector)
+
+    with It(qt.QComboBox()) as w:
+        self.previewMethodSelector = w
+        w.addItem("random")
+        w.addItem("stratified")
+        w.setToolTip("random: uniform fiber subsample. stratified: subsample evenly across brain regions.")
+        parametersFormLayout.addRow("Preview sampling: ", self.previewMethodSelector)
+
+    with It(qt.QCheckBox()) as w:
+        self.reusePreviewRegistrationSelector = w
+        w.checked = False
+        w.setToolTip("Full run: apply the registration transform of the earlier preview run instead of registering again")
+        parametersFormLayout.addRow("Reuse preview registration", self.reusePreviewRegistrationSelector)
+
+    with It(qt.QSpinBox()) as w:
+        self.chunkFibersSelector = w
+        w.minimum = 0
+        w.maximum = 100000000
+        w.singleStep = 100000
+        w.value = 0
+        w.specialValueText = "off"
+        w.setToolTip("Out-of-core mode for very large tractography: read, register and cluster the fibers in blocks of this size, with bounded memory. 0 processes the input at once.")
+        parametersFormLayout.addRow("Chunk size (fibers): ", self.chunkFibersSelector)
+
+    #
+    # Fiber resampling before registration
+    #
+
+    with It(qt.QSpinBox()) as w:
+        self.resamplePointsSelector = w
+        w.minimum = 0
+        w.maximum = 1000
+        w.value = 0
+        w.specialValueText = "off"
+        w.setToolTip("Resample every fiber to this number of points (stored as float32) before registration and clustering. 0 keeps the input points.")
+        parametersFormLayout.addRow("Resample to points: ", self.resamplePointsSelector)
+
+    with It(qt.QDoubleSpinBox()) as w:
+        self.resampleSpacingSelector = w
+        w.minimum = 0.0
+        w.maximum = 20.0
+        w.singleStep = 0.5
+        w.value = 0.0
+        w.specialValueText = "off"
+        w.suffix = " mm"
+        w.setToolTip("Resample every fiber with this point spacing, i.e. a number of points adapted to its length. Used when no number of points is set.")
+        parametersFormLayout.addRow("Resample spacing: ", self.resampleSpacingSelector)
+
+    with It(qt.QDoubleSpinBox()) as w:
+        self.filterMinLengthSelector = w
+        w.minimum = 0.0
+        w.maximum = 200.0
+        w.singleStep = 5.0
+        w.value = 0.0
+        w.specialValueText = "off"
+        w.suffix = " mm"
+        w.setToolTip("Remove fibers shorter than this length before registration")
+        parametersFormLayout.addRow("Minimum fiber length: ", self.filterMinLengthSelector)
+
+    with It(qt.QDoubleSpinBox()) as w:
+        self.duplicateToleranceSelector = w
+        w.minimum = 0.0
+        w.maximum = 5.0
+        w.singleStep = 0.1
+        w.value = 0.0
+        w.specialValueText = "off"
+        w.suffix = " mm"
+        w.setToolTip("Remove fibers matching an earlier fiber within this distance (quantized resampled points)")
+        parametersFormLayout.addRow("Duplicate tolerance: ", self.duplicateToleranceSelector)
+
+    with It(qt.QCheckBox()) as w:
+        self.restoreGeometrySelector = w
+        w.checked = True
+        w.setToolTip("Write the anatomical tracts with the original (not resampled) fibers of the input")
+        parametersFormLayout.addRow("Restore original fibers", self.restoreGeometrySelector)
+
+    with It(qt.QCheckBox()) as w:
+        self.backProjectSelector = w
+        w.checked = False
+        w.setToolTip("Take the subject-space fibers of the clusters from the input through their fiber indices, instead of hardening the registration transforms")
+        parametersFormLayout.addRow("Skip transform hardening", self.backProjectSelector)
+
+    with It(qt.QCheckBox()) as w:
+        self.embeddingCacheSelector = w
+        w.checked = False
+        w.setToolTip("Cluster the fibers in a Slicer process that caches their atlas embedding and cluster affinities, so that outlier removal with another threshold is redone in seconds")
+        parametersFormLayout.addRow("Cache atlas embedding", self.embeddingCacheSelector)
+
+    with It(qt.QDoubleSpinBox()) as w:
+        self.outlierStdSelector = w
+        w.minimum = 0.5
+        w.maximum = 10.0
+        w.singleStep = 0.5
+        w.value = OUTLIER_STD
+        w.setToolTip("With the cached atlas embedding: fibers whose affinity to their atlas cluster is this many standard deviations below that of the atlas fibers are removed as outliers")
+        parametersFormLayout.addRow("Outlier threshold (std): ", self.outlierStdSelector)
+
+    with It(qt.QCheckBox()) as w:
+        self.dryRunSelector = w
+        w.checked = False
+        w.setToolTip("Only print the predicted runtime, peak memory and disk of the inputs, calibrated from the run reports in the output folder")
+        parametersFormLayout.addRow("Dry run (estimate only)", self.dryRunSelector)
+
+    with It(qt.QCheckBox()) as w:
+        self.labelOnlySelector = w
+        w.checked = False
+        w.setToolTip("Only write the input tractography with per-fiber cluster, hemisphere, tract and outlier labels, instead of cluster and tract files")
+        parametersFormLayout.addRow("Label-only output", self.labelOnlySelector)
+
+    with It(qt.QComboBox()) as w:
+        self.profileSelector = w
+        w.addItems(["off"] + list(PROFILE_MODES))
+        w.setToolTip("Profile the in-process stages, transform hardening and scene loading (cprofile: every call, sample: stack samples for flame graphs). "
+                     f"Profiles are written to the {PROFILE_FOLDER} folder next to the run report; the {PROFILE_ENV} environment variable does the same for queue workers")
+        parametersFormLayout.addRow("Profiling: ", self.profileSelector)
+
+    #
+    # Work queue for "From Directory" batches on several processes or hosts
+    #
+
+    with It(qt.QLineEdit()) as w:
+        self.queueFolderSelector = w
+        w.setToolTip("From Directory mode: add the subjects to this work queue folder (on a filesystem shared by all worker hosts) instead of processing them here")
+
+    def selectQueueFolder():
+      folder = qt.QFileDialog.getExistingDirectory(self.parent, "Select work queue folder")
+      if folder:
+        self.queueFolderSelector.setText(folder)
+
+    with It(qt.QPushButton("Browse")) as queuebrowsebutton:
+        queuebrowsebutton.clicked.connect(selectQueueFolder)
+
+    layout = qt.QHBoxLayout()
+    layout.addWidget(self.queueFolderSelector)
+    layout.addWidget(queuebrowsebutton)
+    parametersFormLayout.addRow("Work queue folder:", layout)
+
+    with It(qt.QSpinBox()) as w:
+        self.queueWorkersSelector = w
+        w.minimum = 0
+        w.maximum = 64
+        w.value = 1
+        w.setToolTip("Number of worker processes started on this computer for the work queue")
+        parametersFormLayout.addRow("Local queue workers: ", self.queueWorkersSelector)
+
+    with It(qt.QCheckBox()) as w:
+        self.watchSelector = w
+        w.checked = False
+        w.setToolTip("From Directory mode: keep watching the input folder and process the new tractography files once they are fully written, with at most the local queue workers at a time (uncheck to stop)")
+        w.toggled.connect(self.onWatchToggled)
+        parametersFormLayout.addRow("Watch input folder", self.watchSelector)
+
+    #
+    # Cohort store of the diffusion measurements
+    #
+
+    with It(qt.QLineEdit()) as w:
+        self.cohortFolderSelector = w
+        w.setToolTip("Add the diffusion measurements of every processed subject to the cohort table in this folder")
+
+    def selectCohortFolder():
+      folder = qt.QFileDialog.getExistingDirectory(self.parent, "Select cohort store folder")
+      if folder:
+        self.cohortFolderSelector.setText(folder)
+
+    with It(qt.QPushButton("Browse")) as cohortbrowsebutton:
+        cohortbrowsebutton.clicked.connect(selectCohortFolder)
+
+    layout = qt.QHBoxLayout()
+    layout.addWidget(self.cohortFolderSelector)
+    layout.addWidget(cohortbrowsebutton)
+    parametersFormLayout.addRow("Cohort store folder:", layout)
+
+    #
+    # Scratch folder on fast local storage for the intermediate results
+    #
+
+    with It(qt.QLineEdit()) as w:
+        self.scratchFolderSelector = w
+        w.setToolTip("Run every stage in this folder (e.g. a local SSD or /dev/shm) and copy only the results to the output folder")
+
+    def selectScratchFolder():
+      folder = qt.QFileDialog.getExistingDirectory(self.parent, "Select scratch folder")
+      if folder:
+        self.scratchFolderSelector.setText(folder)
+
+    with It(qt.QPushButton("Browse")) as scratchbrowsebutton:
+        scratchbrowsebutton.clicked.connect(selectScratchFolder)
+
+    layout = qt.QHBoxLayout()
+    layout.addWidget(self.scratchFolderSelector)
+    layout.addWidget(scratchbrowsebutton)
+    parametersFormLayout.addRow("Scratch folder:", layout)
+
+    #
+    # ROI query area
+    #
+
+    roiCollapsibleButton = ctk.ctkCollapsibleButton()
+    roiCollapsibleButton.text = "ROI query"
+    roiCollapsibleButton.collapsed = True
+    self.layout.addWidget(roiCollapsibleButton)
+    roiFormLayout = qt.QFormLayout(roiCollapsibleButton)
+
+    self.roiSelector = slicer.qMRMLNodeComboBox()
+    self.roiSelector.nodeTypes = ["vtkMRMLMarkupsROINode", "vtkMRMLMarkupsFiducialNode"]
+    self.roiSelector.addEnabled = False
+    self.roiSelector.removeEnabled = False
+    self.roiSelector.noneEnabled = True
+    self.roiSelector.setMRMLScene( slicer.mrmlScene )
+    self.roiSelector.setToolTip( "Markups ROI box, or point list whose points are the centers of spheres" )
+    roiFormLayout.addRow("Region: ", self.roiSelector)
+
+    with It(qt.QDoubleSpinBox()) as w:
+        self.roiRadiusSelector = w
+        w.minimum = 0.5
+        w.maximum = 100.0
+        w.value = 5.0
+        w.suffix = " mm"
+        w.setToolTip("Radius of the spheres around the points of a point list")
+        roiFormLayout.addRow("Sphere radius: ", self.roiRadiusSelector)
+
+    with It(qt.QPushButton("Query")) as w:
+        self.roiQueryButton = w
+        w.toolTip = "List the anatomical tracts and fiber clusters of the output folder passing through the region."
+        w.connect('clicked(bool)', self.onROIQuery)
+        roiFormLayout.addRow("", self.roiQueryButton)
+
+    with It(qt.QPlainTextEdit()) as w:
+        self.roiResults = w
+        w.readOnly = True
+        roiFormLayout.addRow(self.roiResults)
+
+    #
+    # Review of finished subjects from their result bundles
+    #
+
+    with It(qt.QPushButton("Load result bundle")) as w:
+        self.loadBundleButton = w
+        w.toolTip = f"Load the {RESULT_BUNDLE} of a subject output folder in a single read, replacing the bundle loaded before."
+        w.connect('clicked(bool)', self.onLoadResultBundle)
+        roiFormLayout.addRow("Review: ", self.loadBundleButton)
+
+    qt.QTimer.singleShot(0, self.revalidateEnvironment)
+
+    elapsed = time.perf_counter() - startTime
+    if elapsed > STARTUP_BUDGET_SECONDS:
+      logging.warning(f"AnatomicalTractParcellation setup took {elapsed:.3f}s (budget {STARTUP_BUDGET_SECONDS}s)")
+    else:
+      logging.info(f"AnatomicalTractParcellation setup took {elapsed:.3f}s")
   
+  def onRegistrationPresetChanged(self, preset):
+    # Fill in the parameters of the preset, they can then be tuned
+    parameters = REGISTRATION_PRESETS[preset]
+    self.regFibersSelector.value = parameters["fibers"]
+    self.regLengthMinSelector.value = parameters["lengthMin"]
+    self.regLengthMaxSelector.value = parameters["lengthMax"]
+
+  def onLoadResultBundle(self):
+    bundlePath = qt.QFileDialog.getOpenFileName(self.parent, "Select result bundle", self.outputFolderSelector.text, f"Result bundle ({RESULT_BUNDLE})")
+    if bundlePath:
+      self.logic.loadResultBundle(bundlePath, replace=True)
+
+  def onROIQuery(self):
+    node = self.roiSelector.currentNode()
+    if node is None:
+      self.roiResults.setPlainText("Select a markups ROI or point list.")
+      return
+    startTime = time.perf_counter()
+    try:
+      rows = self.logic.queryMarkupsNode(self.outputFolderSelector.text, node, self.roiRadiusSelector.value)
+    except Exception as e:
+      self.roiResults.setPlainText(str(e))
+      return
+    elapsed = (time.perf_counter() - startTime) * 1000
+    lines = [f"{len(rows)} tracts and clusters ({elapsed:.1f} ms)", "name\tvoxels\tfibers"]
+    lines += [f"{name}\t{voxels}\t{fibers}" for name, voxels, fibers in rows]
+    self.roiResults.setPlainText("\n".join(lines))
+
+  def onInstallationCollapsed(self, collapsed):
+    if not collapsed and not self.installationWidgetsCreated:
+      self.setupInstallationWidgets()
+
+  def setupInstallationWidgets(self):
+    # Only needed until WMA and the atlas are installed, so it is built on first expansion
+    self.installationWidgetsCreated = True
+    parametersFormLayout = qt.QFormLayout(self.installCollapsibleButton)
+
+    self.installWMAButton = qt.QPushButton("Install WMA")
+    self.installWMAButton.toolTip = "Install whitematteranalysis software package"
+    self.installWMAButton.enabled = not self.wmaInstalled
+    parametersFormLayout.addRow(self.installWMAButton)
+    self.installWMAButton.connect('clicked(bool)', self.onInstallWMA)
+
+    self.downloadAtlasButton = qt.QPushButton("Download WM atlas")
+    self.downloadAtlasButton.toolTip = "Download the ORG white matter atlas"
+    self.downloadAtlasButton.enabled = not self.atlasExisted
+    parametersFormLayout.addRow(self.downloadAtlasButton)
+    self.downloadAtlasButton.connect('clicked(bool)', self.onDownloadAtlas)
+
+    #
+    # Atlas store and node-local atlas cache
+    #
+    def selectAtlasFolder(lineEdit):
+      folder = qt.QFileDialog.getExistingDirectory(self.parent, "Select folder", lineEdit.text)
+      if folder:
+        lineEdit.setText(folder)
+        self.onAtlasLocationsChanged()
+
+    for label, attribute, value, tip in [
+        ("Atlas store:", "atlasStoreSelector", self.logic.getAtlasStore(),
+         "Folder holding the ORG-Atlases-<version> folders. It can be a shared, read-only location."),
+        ("Local atlas cache:", "atlasCacheSelector", self.logic.getAtlasCache() or "",
+         "Optional node-local folder (e.g. on an SSD). The atlas is copied there from the store, verified, and read from there during processing.")]:
+      with It(qt.QLineEdit()) as w:
+        setattr(self, attribute, w)
+        w.setText(value)
+        w.setToolTip(tip)
+        w.connect('editingFinished()', self.onAtlasLocationsChanged)
+      with It(qt.QPushButton("Browse")) as b:
+        b.clicked.connect(lambda checked=False, w=w: selectAtlasFolder(w))
+      layout = qt.QHBoxLayout()
+      layout.addWidget(w)
+      layout.addWidget(b)
+      parametersFormLayout.addRow(label, layout)
+
   def onNodeSelectionChanged(self):
     self.selected_node = self.inputSelector.currentNode()
     if self.selected_node is not None:
@@ -365,40 +2005,59 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
 
 
   def updateMsgInformation(self):
-    
-  # Check Xcode Command Line Tools installation
-    if platform.system() == 'Darwin':
-      self.logic.check_install_xcode_cli()
 
-  #update the status of the wma and atlas
-    try:
-      self.wmaInstalled, msg = self.logic.checkWMAInstall()
-      self.ui.wmaInstallationInfo.text = msg
-    except Exception as e:
-      logging.error(str(e))
-      self.ui.wmaInstallationInfo.text = "unknown (corrupted installation?)"
+  #update the status of the wma and atlas from the environment probe
+    env = self.environment
+    self.wmaInstalled = env.get("wmaInstalled", False)
+    if self.wmaInstalled:
+      self.ui.wmaInstallationInfo.text = f"Installed (Version: {env.get('wmaVersion') or 'unknown'})"
+    else:
+      self.ui.wmaInstallationInfo.text = "Not installed"
 
-    try:
-      self.atlasExisted, msg = self.logic.checkAtlasExist()
-      # Get and display the ORG-Atlases version 
-      if self.atlasExisted:
-        atlasBasepath = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'Resources')
-        atlas_p_file = glob.glob(os.path.join(atlasBasepath, 'ORG-Atlases*'))[0]
-        if os.name == 'posix':
-          Versionpart = atlas_p_file.split("/")
-        elif os.name == 'nt':
-          Versionpart = atlas_p_file.split("\\")
-        version = Versionpart[-1].replace("ORG-Atlases-", "")
-        if version:
-            self.ui.atlasDownloadInfo.text = f"Installed (Version: {version})"
-        else:
-            self.ui.atlasDownloadInfo.text = "Installed (Version: unknown)"
-      else:
-        self.ui.atlasDownloadInfo.text = msg
-    except Exception as e:
-      logging.error(str(e))
-      self.ui.atlasDownloadInfo.text = "unknown (corrupted download process?)"
-    
+    self.atlasExisted = env.get("atlasFolder") is not None
+    # Display the ORG-Atlases version
+    if self.atlasExisted:
+      self.ui.atlasDownloadInfo.text = f"Installed (Version: {env.get('atlasVersion')})"
+      self.ui.atlasDownloadInfo.toolTip = env.get("atlasFolder")
+    else:
+      self.ui.atlasDownloadInfo.text = "Not installed"
+
+  def revalidateEnvironment(self):
+    # Probe the environment in a worker thread and poll for the result, so that the
+    # (potentially slow) checks never block the GUI.
+    if getattr(self, "_probeThread", None) is not None:
+      return
+    result = {}
+    # Qt settings and application paths are read here, not in the thread
+    settings = self.logic.environmentSettings()
+    def probe():
+      try:
+        result.update(self.logic.probeEnvironment(settings))
+      except Exception as e:
+        logging.error(f"Environment probe failed: {e}")
+    self._probeThread = threading.Thread(target=probe, daemon=True)
+    self._probeThread.start()
+    def poll():
+      if self._probeThread.is_alive():
+        qt.QTimer.singleShot(200, poll)
+        return
+      self._probeThread = None
+      if result:
+        self.onEnvironmentProbed(result)
+    qt.QTimer.singleShot(200, poll)
+
+  def onEnvironmentProbed(self, environment):
+    self.environment = environment
+    self.updateMsgInformation()
+    self.NumThreadsSelector.maximum = environment.get("cores") or 1
+    if self.installationWidgetsCreated:
+      self.installWMAButton.enabled = not self.wmaInstalled
+      self.downloadAtlasButton.enabled = not self.atlasExisted
+    if not (self.wmaInstalled and self.atlasExisted):
+      self.installCollapsibleButton.collapsed = False
+    # Check Xcode Command Line Tools installation
+    if environment.get("xcodeInstalled") is False:
+      self.logic.check_install_xcode_cli()
 
   def onInstallWMA(self):
     self.ui.wmaInstallationInfo.text = "Installing WMA..."
@@ -408,22 +2067,22 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
 
     if install:
       self.logic.installWMA()
-    self.wmaInstalled, msg = self.logic.checkWMAInstall()
-    self.ui.wmaInstallationInfo.text = msg
-    self.installWMAButton.enabled = not self.wmaInstalled
+    self.onEnvironmentProbed(self.logic.probeEnvironment())
 
   def onDownloadAtlas(self):
     self.ui.atlasDownloadInfo.text = "Downloading atlas..."
 
     download = slicer.util.confirmYesNoDisplay("Atlas file size is ~4GB.  "+\
                       "Depending on your internet speed,  this download may take 1 hour.  "+\
-                      "\nNote: You can also move the atlas file to 'Resources' subfolder from local disk.\n"+\
+                      "\nNote: You can also move the atlas file to the atlas store folder from local disk.\n"+\
                       "Slicer will be freezing during downloading.  Confirm to start:")
     if download:
       self.logic.downloadAtlas()
-    self.atlasExisted, msg = self.logic.checkAtlasExist()
-    self.ui.atlasDownloadInfo.text = msg
-    self.downloadAtlasButton.enabled = not self.atlasExisted
+    self.onEnvironmentProbed(self.logic.probeEnvironment())
+
+  def onAtlasLocationsChanged(self):
+    self.logic.setAtlasLocations(self.atlasStoreSelector.text.strip(), self.atlasCacheSelector.text.strip())
+    self.onEnvironmentProbed(self.logic.probeEnvironment())
 
   def cleanup(self):
     pass
@@ -434,11 +2093,20 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
   def reset(self, _msg):
     self.statusLabel.setText("")
 
+  def onWatchToggled(self, checked):
+    if not checked and self.watchStopEvent is not None:
+      self.watchStopEvent.set()
+      self.watchStopEvent = None
+
   def onApplyButton(self):
     self.statusLabel.setText("")
     logic = AnatomicalTractParcellationLogic()
+    watch = self.watchSelector.checked and self.loadmode == "localdirectory"
+    if watch and self.watchStopEvent is not None:
+      # restart the watcher with the new settings
+      self.watchStopEvent.set()
 
-    logic.run(
+    result = logic.run(
               self.loadmode,
               self.inputFileGet.text,
               self.inputFolderSelector.text,
@@ -446,9 +2114,37 @@ class AnatomicalTractParcellationWidget(ScriptedLoadableModuleWidget):
               self.polydata,
               self.outputFolderSelector.text,
               RegMode = self.regModeSelector.currentText,
+              RegPreset = self.regPresetSelector.currentText,
+              RegFibers = self.regFibersSelector.value,
+              RegLengthMin = self.regLengthMinSelector.value,
+              RegLengthMax = self.regLengthMaxSelector.value,
               CleanMode = self.CleanFilesSelector.checked,
-              NumThreads = str(int(self.NumThreadsSelector.value))
+              NumThreads = str(int(self.NumThreadsSelector.value)),
+              PreviewFibers = self.previewFibersSelector.value,
+              PreviewMethod = self.previewMethodSelector.currentText,
+              ReusePreviewRegistration = self.reusePreviewRegistrationSelector.checked,
+              ChunkFibers = self.chunkFibersSelector.value,
+              ResamplePoints = self.resamplePointsSelector.value,
+              ResampleSpacing = self.resampleSpacingSelector.value,
+              RestoreGeometry = self.restoreGeometrySelector.checked,
+              FilterMinLength = self.filterMinLengthSelector.value,
+              DuplicateTolerance = self.duplicateToleranceSelector.value,
+              CohortFolder = self.cohortFolderSelector.text.strip(),
+              DryRun = self.dryRunSelector.checked,
+              LabelOnly = self.labelOnlySelector.checked,
+              BackProject = self.backProjectSelector.checked,
+              EmbeddingCache = self.embeddingCacheSelector.checked,
+              OutlierStd = self.outlierStdSelector.value,
+              ScratchFolder = self.scratchFolderSelector.text.strip(),
+              QueueFolder = self.queueFolderSelector.text.strip(),
+              QueueWorkers = self.queueWorkersSelector.value,
+              Watch = watch,
+              Profile = None if self.profileSelector.currentText == "off" else self.profileSelector.currentText,
           )
+    if watch and not self.dryRunSelector.checked:
+      self.watchStopEvent = result
+    elif result is False:
+      self.statusLabel.setText(f"Processing did not finish for every subject, see the {RUN_REPORT} files and the log.")
               
 #
 # AnatomicalTractParcellationLogic
@@ -477,45 +2173,293 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     
     
   @staticmethod
-  # check the wma installation
+  # check the wma installation without importing it (and its heavy dependencies)
   def checkWMAInstall():
 
     try:
-      importlib.metadata.files('whitematteranalysis')
+      importlib.metadata.version('whitematteranalysis')
     except importlib.metadata.PackageNotFoundError as e:
       installed = False
       wmamsg = 'Not Installed'
       logging.warning("WMA has not been installed in the Slicer python enviroment.")
       return installed, wmamsg
 
-    try:
-      import whitematteranalysis
+    if importlib.util.find_spec('whitematteranalysis') is not None:
       installed = True
       wmamsg = "Installed"
-    except ModuleNotFoundError:
+    else:
       installed = False
       wmamsg = "Not installed"
       logging.error("Fail to import whitematteranalysis. Try to install. ")
 
     return installed, wmamsg
 
+  _environment = None
+
+  @staticmethod
+  def _environmentCachePath(cachePath=None):
+    return os.path.join(cachePath or slicer.app.cachePath, "AnatomicalTractParcellation", "environment.json")
+
+  @staticmethod
+  def environmentSettings():
+    # Atlas settings and Slicer paths used by resolveAtlas and probeEnvironment; Qt
+    # settings and the application object are read here, on the main thread
+    return {"atlasStore": AnatomicalTractParcellationLogic.getAtlasStore(),
+            "atlasCache": AnatomicalTractParcellationLogic.getAtlasCache(),
+            "atlasVersion": os.environ.get(ATLAS_VERSION_ENV) or qt.QSettings().value(ATLAS_VERSION_SETTING, ""),
+            "cachePath": slicer.app.cachePath}
+
+  @staticmethod
+  def probeEnvironment(settings=None):
+    """Collect WMA version, atlas, script paths and core count, and cache them on disk.
+
+    Nothing is imported and no shell is spawned (except xcode-select on macOS).
+    Given settings (see environmentSettings, read on the main thread) no Qt or
+    application object is used, so this is safe to run from a worker thread.
+    """
+    settings = settings or AnatomicalTractParcellationLogic.environmentSettings()
+    env = {"timestamp": time.time(), "cores": os.cpu_count() or 1}
+    env["wmaInstalled"], msg = AnatomicalTractParcellationLogic.checkWMAInstall()
+    env["wmaVersion"] = importlib.metadata.version('whitematteranalysis') if env["wmaInstalled"] else None
+    env["atlasFolder"], env["atlasVersion"] = AnatomicalTractParcellationLogic.resolveAtlas(populateCache=False, settings=settings)
+    env["atlasStore"] = settings["atlasStore"]
+
+    env["scripts"] = {}
+    try:
+      pythonSlicerExecutablePath = AnatomicalTractParcellationLogic._executePythonModule()
+    except Exception as e:
+      logging.error(str(e))
+      pythonSlicerExecutablePath = None
+    env["pythonSlicer"] = pythonSlicerExecutablePath
+    if env["wmaInstalled"] and pythonSlicerExecutablePath:
+      location = 'Scripts' if os.name == 'nt' else 'bin'
+      installed = None
+      for name in WMA_SCRIPTS:
+        path = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, name)
+        if not os.path.isfile(path):
+          # Non-standard layout: look the script up in the package metadata (slow, done once)
+          if installed is None:
+            installed = importlib.metadata.files('whitematteranalysis') or []
+          found = [p.locate() for p in installed if str(p).endswith(name)]
+          path = str(found[0]) if found else path
+        env["scripts"][name] = os.path.normpath(path)
+
+    env["xcodeInstalled"] = None
+    if platform.system() == 'Darwin':
+      try:
+        env["xcodeInstalled"] = subprocess.run(['xcode-select', '--print-path'], capture_output=True).returncode == 0
+      except Exception as e:
+        logging.error(f"Error checking Xcode installation status: {e}")
+
+    AnatomicalTractParcellationLogic._environment = env
+    try:
+      cachePath = AnatomicalTractParcellationLogic._environmentCachePath(settings["cachePath"])
+      os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+      with open(cachePath, "w") as f:
+        json.dump(env, f, indent=1)
+    except OSError as e:
+      logging.warning(f"Can not write environment cache: {e}")
+    return env
+
+  @staticmethod
+  def getEnvironment():
+    # Last known environment: in memory, then on disk, then probed now (first start only)
+    if AnatomicalTractParcellationLogic._environment is None:
+      try:
+        with open(AnatomicalTractParcellationLogic._environmentCachePath()) as f:
+          AnatomicalTractParcellationLogic._environment = json.load(f)
+      except (OSError, ValueError):
+        AnatomicalTractParcellationLogic.probeEnvironment()
+    return AnatomicalTractParcellationLogic._environment
+
+  @staticmethod
+  def _wmaScriptPath(name):
+    path = AnatomicalTractParcellationLogic.getEnvironment().get("scripts", {}).get(name)
+    if not path or not os.path.isfile(path):
+      path = AnatomicalTractParcellationLogic.probeEnvironment()["scripts"].get(name)
+    if not path:
+      raise RuntimeError(f"Cannot find {name} script. Check WMA installation.")
+    return path
+
   @staticmethod
   # check the existence of the altas
   def checkAtlasExist():
-    
-    atlasBasepath = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'Resources')
 
-    try:
-      atlas_p_file = glob.glob(os.path.join(atlasBasepath, 'ORG-Atlases*', 'ORG-800FC-100HCP', 'atlas.p' ))[0]
+    AtlasBaseFolder, version = AnatomicalTractParcellationLogic.resolveAtlas(populateCache=False)
+    if AtlasBaseFolder is not None:
       exist = True
       atlasmsg = "Installed"
-    except Exception as e:
+    else:
       exist = False
       atlasmsg = "Not installed"
       logging.warning("Can not find ORG atlas. Try to download.")
 
     return exist, atlasmsg
 
+  @staticmethod
+  # directory holding the versioned ORG-Atlases-* folders (shared, possibly read-only)
+  def getAtlasStore():
+    store = os.environ.get(ATLAS_STORE_ENV) or qt.QSettings().value(ATLAS_STORE_SETTING, "")
+    if not store:
+      store = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'Resources')
+    return os.path.abspath(os.path.expanduser(store))
+
+  @staticmethod
+  # node-local directory the atlas is copied to before use, or None if caching is disabled
+  def getAtlasCache():
+    cache = os.environ.get(ATLAS_CACHE_ENV) or qt.QSettings().value(ATLAS_CACHE_SETTING, "")
+    if not cache:
+      return None
+    return os.path.abspath(os.path.expanduser(cache))
+
+  @staticmethod
+  def setAtlasLocations(store, cache):
+    settings = qt.QSettings()
+    settings.setValue(ATLAS_STORE_SETTING, store or "")
+    settings.setValue(ATLAS_CACHE_SETTING, cache or "")
+
+  @staticmethod
+  # map atlas version -> folder for every complete atlas found in the store
+  def listAtlasVersions(store=None):
+    if store is None:
+      store = AnatomicalTractParcellationLogic.getAtlasStore()
+    versions = {}
+    for folder in glob.glob(os.path.join(store, ATLAS_PREFIX + '*')):
+      if os.path.isfile(os.path.join(folder, 'ORG-800FC-100HCP', 'atlas.p')):
+        version = os.path.basename(folder).replace(ATLAS_PREFIX, "").lstrip("-")
+        versions[version or "unknown"] = folder
+    return versions
+
+  @staticmethod
+  def resolveAtlas(version=None, populateCache=True, settings=None):
+    """Return (atlas folder, version) for the atlas to use, or (None, None).
+
+    The newest version in the store is used unless a version is pinned in the
+    settings or passed explicitly. When a local cache is configured, the
+    verified cached copy is returned; with populateCache the cache is filled
+    from the store first. Any cache problem falls back to the shared store.
+    settings (see environmentSettings) are read now when not given.
+    """
+    settings = settings or AnatomicalTractParcellationLogic.environmentSettings()
+    versions = AnatomicalTractParcellationLogic.listAtlasVersions(settings["atlasStore"])
+    if version is None:
+      version = settings["atlasVersion"]
+    if not versions or (version and version not in versions):
+      if version:
+        logging.warning(f"ORG atlas version {version} not found in {settings['atlasStore']}")
+      return None, None
+    if not version:
+      version = sorted(versions, key=AnatomicalTractParcellationLogic._versionKey)[-1]
+    AtlasBaseFolder = versions[version]
+
+    cache = settings["atlasCache"]
+    if cache is None or os.path.abspath(cache) == os.path.dirname(AtlasBaseFolder):
+      return AtlasBaseFolder, version
+    cachedFolder = os.path.join(cache, os.path.basename(AtlasBaseFolder))
+    try:
+      if AnatomicalTractParcellationLogic.verifyAtlasCopy(AtlasBaseFolder, cachedFolder):
+        return cachedFolder, version
+      if populateCache:
+        AnatomicalTractParcellationLogic.cacheAtlas(AtlasBaseFolder, cachedFolder)
+        return cachedFolder, version
+    except Exception as e:
+      logging.error(f"Can not use the local atlas cache {cachedFolder}: {e}. Using the shared atlas store.")
+    return AtlasBaseFolder, version
+
+  @staticmethod
+  def _versionKey(version):
+    return [int(p) if p.isdigit() else -1 for p in version.replace("-", ".").split(".")]
+
+  @staticmethod
+  # relative path -> file size for every file of an atlas folder
+  def _atlasFileSizes(folder):
+    sizes = {}
+    for root, dirs, files in os.walk(folder):
+      for name in files:
+        if name == ATLAS_MANIFEST:
+          continue
+        path = os.path.join(root, name)
+        sizes[os.path.relpath(path, folder)] = os.path.getsize(path)
+    return sizes
+
+  @staticmethod
+  def _sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+  @staticmethod
+  def writeAtlasManifest(folder):
+    # Record size and checksum of every atlas file, used to verify cached copies
+    manifest = {rel: [size, AnatomicalTractParcellationLogic._sha256(os.path.join(folder, rel))]
+                for rel, size in AnatomicalTractParcellationLogic._atlasFileSizes(folder).items()}
+    with open(os.path.join(folder, ATLAS_MANIFEST), 'w') as f:
+      json.dump(manifest, f)
+    return manifest
+
+  @staticmethod
+  def verifyAtlasCopy(sourceFolder, cachedFolder, deep=False):
+    # A cached copy is valid when its manifest (written last) matches the shared
+    # store file by file; deep verification also recomputes the checksums.
+    manifestPath = os.path.join(cachedFolder, ATLAS_MANIFEST)
+    if not os.path.isfile(manifestPath):
+      return False
+    with open(manifestPath) as f:
+      manifest = json.load(f)
+    sourceSizes = AnatomicalTractParcellationLogic._atlasFileSizes(sourceFolder)
+    if set(sourceSizes) != set(manifest):
+      return False
+    for rel, (size, checksum) in manifest.items():
+      path = os.path.join(cachedFolder, rel)
+      if sourceSizes[rel] != size or not os.path.isfile(path) or os.path.getsize(path) != size:
+        return False
+      if deep and AnatomicalTractParcellationLogic._sha256(path) != checksum:
+        return False
+    return True
+
+  @staticmethod
+  def cacheAtlas(sourceFolder, cachedFolder):
+    # Copy the atlas from the shared store to the local cache. Every file is
+    # checksummed while it is read from the store and again after it is written,
+    # and compared with the store manifest if there is one. The copy is made in
+    # a temporary folder and renamed, so other processes never see a partial atlas.
+    cache = os.path.dirname(cachedFolder)
+    os.makedirs(cache, exist_ok=True)
+    with FileLock(cachedFolder + ".lock"):
+      if AnatomicalTractParcellationLogic.verifyAtlasCopy(sourceFolder, cachedFolder):
+        return
+      print("<wm_apply_ORG_atlas_to_subject> Copying atlas", sourceFolder, "to local cache", cache)
+      sourceManifest = {}
+      if os.path.isfile(os.path.join(sourceFolder, ATLAS_MANIFEST)):
+        with open(os.path.join(sourceFolder, ATLAS_MANIFEST)) as f:
+          sourceManifest = json.load(f)
+      partialFolder = f"{cachedFolder}.partial-{socket.gethostname()}-{os.getpid()}"
+      shutil.rmtree(partialFolder, ignore_errors=True)
+      manifest = {}
+      for rel, size in AnatomicalTractParcellationLogic._atlasFileSizes(sourceFolder).items():
+        target = os.path.join(partialFolder, rel)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        digest = hashlib.sha256()
+        with open(os.path.join(sourceFolder, rel), 'rb') as src, open(target, 'wb') as dst:
+          for block in iter(lambda: src.read(1 << 20), b''):
+            digest.update(block)
+            dst.write(block)
+        checksum = digest.hexdigest()
+        if rel in sourceManifest and sourceManifest[rel][1] != checksum:
+          shutil.rmtree(partialFolder, ignore_errors=True)
+          raise RuntimeError(f"{rel} in the atlas store does not match its manifest")
+        if AnatomicalTractParcellationLogic._sha256(target) != checksum:
+          shutil.rmtree(partialFolder, ignore_errors=True)
+          raise RuntimeError(f"{rel} was corrupted while copying to the atlas cache")
+        manifest[rel] = [size, checksum]
+      with open(os.path.join(partialFolder, ATLAS_MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+      shutil.rmtree(cachedFolder, ignore_errors=True)
+      os.rename(partialFolder, cachedFolder)
+      print(" - atlas cached at", cachedFolder)
+
   @staticmethod
   #install WMA package
   def installWMA():
@@ -533,18 +2477,27 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     pythonSlicerExecutablePath = AnatomicalTractParcellationLogic._executePythonModule()
 
     try:
-      wm_download_anatomically_curated_atlas = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_download_anatomically_curated_atlas.py" in str(p)][0]
-      wm_download_anatomically_curated_atlas = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_download_anatomically_curated_atlas.py')
+      wm_download_anatomically_curated_atlas = AnatomicalTractParcellationLogic._wmaScriptPath('wm_download_anatomically_curated_atlas.py')
     except Exception as e:
       logging.error(e)
       logging.error("Cannot find wm_download_anatomically_curated_atlas.py script. Check WMA installation.")
+      return
 
-    atlasBasepath = os.path.join(os.path.abspath(os.path.dirname(__file__)), "Resources")
+    atlasBasepath = AnatomicalTractParcellationLogic.getAtlasStore()
+    os.makedirs(atlasBasepath, exist_ok=True)
     commandLine = [pythonSlicerExecutablePath, wm_download_anatomically_curated_atlas, atlasBasepath, '-atlas', 'ORG-800FC-100HCP']
 
     proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=False)
     slicer.util.logProcessOutput(proc)
 
+    # Checksum the fresh download so that node-local caches can be verified against it
+    for version, folder in AnatomicalTractParcellationLogic.listAtlasVersions(atlasBasepath).items():
+      if not os.path.isfile(os.path.join(folder, ATLAS_MANIFEST)):
+        try:
+          AnatomicalTractParcellationLogic.writeAtlasManifest(folder)
+        except OSError as e:
+          logging.warning(f"Can not write the atlas manifest in {folder}: {e}")
+
   def _executePythonModule():
     import os, sys
     """ Updated based on: https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/util.py
@@ -579,15 +2532,50 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     input_pd_fnames = sorted(input_pd_fnames)
     return(input_pd_fnames)
 
-  def write_polydata(self, polydata, filename):
+  def list_tractography_files(self, input_dir):
+    # Input tractography files of a folder, in any supported format
+    return sorted(f for f in glob.glob(os.path.join(input_dir, "*")) if os.path.splitext(f)[1].lower() in TRACTOGRAPHY_EXTENSIONS)
+
+  @staticmethod
+  def openFiberFile(filename):
+    # Streaming reader of a .trk, .tck or binary legacy .vtk file; ValueError for other files
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".trk":
+      return TrkFiberFile(filename)
+    if extension == ".tck":
+      return TckFiberFile(filename)
+    return LegacyFiberFile(filename)
+
+  def read_polydata(self, filename):
+    # Read polydata in vtkPolyData (.vtk) or XML (.vtp) format, according to extension.
+    basename, extension = os.path.splitext(filename)
+    if extension.lower() in ('.trk', '.tck'):
+        fiberFile = self.openFiberFile(filename)
+        return FiberArrays.concatenate(list(fiberFile.blocks(max(fiberFile.numberOfFibers, 1)))).toPolyData()
+    if extension.lower() == '.vtk':
+        reader = vtk.vtkPolyDataReader()
+    else:
+        reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    if reader.GetErrorCode() != 0:
+        raise IOError(f"Could not read polydata file: {filename}")
+    return reader.GetOutput()
+
+  def write_polydata(self, polydata, filename, verbose=True):
     # Write polydata as vtkPolyData format, according to extension."""
 
-    print("Writing ", filename, "...")
+    if verbose:
+        print("Writing ", filename, "...")
 
     basename, extension = os.path.splitext(filename)
 
-    writer = vtk.vtkXMLPolyDataWriter()
-    writer.SetDataModeToBinary()
+    if extension.lower() == '.vtk':
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileTypeToBinary()
+    else:
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetDataModeToBinary()
 
     writer.SetFileName(filename)
     if (vtk.vtkVersion().GetVTKMajorVersion() >= 6.0):
@@ -598,7 +2586,8 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
 
     del writer
 
-    print("Done writing ", filename)
+    if verbose:
+        print("Done writing ", filename)
     
   def __init__(self):
       self.header = '<MRML  version="Slicer4" userTags="">\n'
@@ -607,7 +2596,8 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
       self.node_id = 0
       self.props_id = 0
       
-  def write(self, pd_filenames, colors, filename, ratio=1.0):
+  @profiledMethod
+  def write(self, pd_filenames, colors, filename, ratio=1.0, namePrefix=""):
       #print "converting colors to strings"
       f = open(filename, "w")
       f.write(self.header)
@@ -620,7 +2610,7 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
       f = open(filename, "w")
       f.write(self.header)
       for pidx in range(len(pd_filenames)):
-          name = os.path.splitext(os.path.split(pd_filenames[pidx])[1])[0]
+          name = namePrefix + os.path.splitext(os.path.split(pd_filenames[pidx])[1])[0]
           self.write_node(pd_filenames[pidx], color_list[pidx], name, f, ratio)
       f.write(self.footer)
       f.close()
@@ -726,6 +2716,7 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
       f.write("\n")
       
 
+  @profiledMethod
   def harden_transform(self, polydata, transform_node, inverse, outdir):
     # Apply harden transform with slicer
     polydata_base_path, polydata_name = os.path.split(polydata)
@@ -754,7 +2745,14 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     polydata_node.SetAndObserveTransformNodeID(t_node_id)
     logic.hardenTransform(polydata_node)
     slicer.util.saveNode(polydata_node, output_name)
-
+    # index the saved file from the node polydata: it is in RAS, the file is written in LPS
+    entry = self.fiber_file_entry(output_name, FiberArrays.fromPolyData(polydata_node.GetPolyData()))
+    if entry["bounds"] is not None:
+        low, high = entry["bounds"][:3], entry["bounds"][3:]
+        entry["bounds"] = [-high[0], -high[1], low[2], -low[0], -low[1], high[2]]
+    return entry
+
+  @profiledMethod
   def python_harden_transform(self, inputDirectory, outputDirectory, transform_file, numberOfJobs, inverse_transform=True):
     
     # set the initial settings and apply transform
@@ -805,15 +2803,1283 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
         print('Could not load transform file:', transform_path)
         return
 
+    entries = {}
     for polydata in input_polydatas:
         print('transforming', polydata)
-        self.harden_transform(polydata, transform_node, inverse, outdir)
+        entry = self.harden_transform(polydata, transform_node, inverse, outdir)
+        name = os.path.basename(polydata)
+        if entry is None and os.path.isfile(os.path.join(outdir, name)):
+            entry = self.fiber_file_entry(os.path.join(outdir, name))
+        if entry is not None:
+            entries[name] = entry
+    self.writeOutputIndex(outdir, "TransformedClusters", entries, len(entries) == number_of_polydatas)
 
     output_polydatas = self.list_vtk_files(outdir)
     number_of_results = len(output_polydatas)
     print("<wm_harden_transform_with_slicer> Transform were conducted for", number_of_results, "subjects.")
 
-  def loadVTPFile(self, file_path):
+  @staticmethod
+  def selectFiberSubsample(fibers, numberOfFibers, method="random", seed=0):
+    """Return sorted indices of numberOfFibers fibers of a FiberArrays.
+
+    "random" draws fibers uniformly. "stratified" bins the fiber centroids on a
+    regular grid and samples systematically along the fibers sorted by grid cell,
+    so that every region keeps its share of fibers.
+    """
+    total = fibers.numberOfFibers
+    if numberOfFibers >= total:
+      return np.arange(total)
+    rng = np.random.default_rng(seed)
+    if method == "random":
+      return np.sort(rng.choice(total, numberOfFibers, replace=False))
+    elif method != "stratified":
+      raise ValueError(f"Unknown subsampling method: {method}")
+    centroids = np.nan_to_num(fibers.fiberMeans(fibers.points))
+    low, high = centroids.min(axis=0), centroids.max(axis=0)
+    # grid with about 4 sampled fibers per occupied cell
+    cellSize = max(float(np.prod(np.maximum(high - low, 1.0)) / max(numberOfFibers / 4.0, 1.0)) ** (1.0 / 3.0), 1e-3)
+    cells = np.floor((centroids - low) / cellSize).astype(np.int64)
+    shape = cells.max(axis=0) + 1
+    cellKey = (cells[:, 0] * shape[1] + cells[:, 1]) * shape[2] + cells[:, 2]
+    order = np.lexsort((rng.random(total), cellKey))
+    picks = np.floor((np.arange(numberOfFibers) + rng.random()) * total / numberOfFibers).astype(np.int64)
+    return np.sort(order[np.minimum(picks, total - 1)])
+
+  @staticmethod
+  def inputStamp(inputPath, **parameters):
+    # Input file and parameters an intermediate result is computed from, stored next to it
+    return dict(parameters, input=os.path.abspath(inputPath), bytes=os.path.getsize(inputPath), mtime=os.path.getmtime(inputPath))
+
+  @staticmethod
+  def stampMatches(stampPath, stamp):
+    try:
+      with open(stampPath) as f:
+        return json.load(f) == stamp
+    except (OSError, ValueError):
+      return False
+
+  @staticmethod
+  def writeStamp(stampPath, stamp):
+    with open(stampPath + ".partial", "w") as f:
+      json.dump(stamp, f)
+    os.replace(stampPath + ".partial", stampPath)
+
+  def subsampleTractography(self, inputPath, outputPath, numberOfFibers, method="random", seed=0):
+    fibers = FiberArrays.fromPolyData(self.read_polydata(inputPath))
+    indices = self.selectFiberSubsample(fibers, numberOfFibers, method, seed)
+    print(f"<wm_apply_ORG_atlas_to_subject> Subsampled {len(indices)} of {fibers.numberOfFibers} fibers ({method}).")
+    self.write_polydata(fibers.subset(indices).toPolyData(), outputPath)
+
+  def harden_polydata_file(self, inputPath, transformPath, outputPath, inverse):
+    # Apply a transform file to a whole tractography file with slicer
+    check_load, polydata_node = slicer.util.loadModel(str(inputPath), 1)
+    if not check_load:
+        raise IOError(f"Could not load polydata file: {inputPath}")
+    check_load, transform_node = slicer.util.loadTransform(str(transformPath), 1)
+    if not check_load:
+        slicer.mrmlScene.RemoveNode(polydata_node)
+        raise IOError(f"Could not load transform file: {transformPath}")
+    if inverse:
+        transform_node.Inverse()
+    polydata_node.SetAndObserveTransformNodeID(transform_node.GetID())
+    slicer.vtkSlicerTransformLogic().hardenTransform(polydata_node)
+    os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+    slicer.util.saveNode(polydata_node, outputPath)
+    slicer.mrmlScene.RemoveNode(polydata_node)
+    slicer.mrmlScene.RemoveNode(transform_node)
+
+  def applyPreviewRegistration(self, caseID, input_tractography_path, RegistrationFolder, PreviewRegistrationFolder, RegMode):
+    # Register the full tractography with the transform(s) estimated on the preview
+    # subsample, writing the files registration would have written. The transforms
+    # map atlas space to subject space, so they are applied inverted.
+    steps = [(caseID, input_tractography_path)]
+    if RegMode == "affine + nonlinear":
+      steps.append((caseID + "_reg", os.path.join(RegistrationFolder, caseID, "output_tractography", caseID + "_reg.vtk")))
+    for stepID, stepInput in steps:
+      previewTransform = os.path.join(PreviewRegistrationFolder, stepID, "output_tractography", f"itk_txform_{stepID}.tfm")
+      if not os.path.isfile(previewTransform):
+        print(" - no preview registration transform found:", previewTransform)
+        return False
+    for stepID, stepInput in steps:
+      outputFolder = os.path.join(RegistrationFolder, stepID, "output_tractography")
+      os.makedirs(outputFolder, exist_ok=True)
+      shutil.copyfile(os.path.join(PreviewRegistrationFolder, stepID, "output_tractography", f"itk_txform_{stepID}.tfm"),
+                      os.path.join(outputFolder, f"itk_txform_{stepID}.tfm"))
+      print(" - applying preview registration transform to", stepInput)
+      self.harden_polydata_file(stepInput, os.path.join(outputFolder, f"itk_txform_{stepID}.tfm"),
+                                os.path.join(outputFolder, stepID + "_reg.vtk"), inverse=True)
+    return True
+
+  @staticmethod
+  def countFibers(filename):
+    # Number of fibers of a tractography file, from its header without reading the geometry
+    return AnatomicalTractParcellationLogic.tractographyHeader(filename)["fibers"]
+
+  @staticmethod
+  def tractographyHeader(filename):
+    # {"fibers", "points", "bytes"} of a tractography file, from its header without reading the geometry
+    header = {"fibers": 0, "points": 0, "bytes": os.path.getsize(filename)}
+    if os.path.splitext(filename)[1].lower() in (".trk", ".tck"):
+      fiberFile = AnatomicalTractParcellationLogic.openFiberFile(filename)
+      header.update(fibers=fiberFile.numberOfFibers, points=int(fiberFile.numberOfPoints))
+      return header
+    if os.path.splitext(filename)[1].lower() == ".vtk":
+      try:
+        fiberFile = LegacyFiberFile(filename)
+        header.update(fibers=fiberFile.numberOfFibers, points=len(fiberFile.points))
+        return header
+      except ValueError:
+        with open(filename, "rb") as f:
+          for line in f:
+            if line.startswith(b"POINTS"):
+              header["points"] = int(line.split()[1])
+            elif line.startswith(b"LINES"):
+              # the 5.x layout counts offsets, one more than lines
+              header["fibers"] = int(line.split()[1]) - (1 if f.readline().startswith(b"OFFSETS") else 0)
+              break
+        return header
+    # XML: the counts are attributes of the Piece element, before its data
+    data = b""
+    with open(filename, "rb") as f:
+      while True:
+        match = re.search(rb'<Piece[^>]*>', data)
+        block = f.read(1 << 16) if match is None else None
+        if not block:
+          break
+        data += block
+    if match:
+      for key, attribute in (("fibers", rb'NumberOfLines="(\d+)"'), ("points", rb'NumberOfPoints="(\d+)"')):
+        value = re.search(attribute, match.group(0))
+        header[key] = int(value.group(1)) if value else 0
+    return header
+
+  def iterateFiberBlocks(self, filename, blockSize):
+    # FiberArrays blocks of blockSize fibers; .trk, .tck and binary legacy .vtk files are
+    # streamed, other files have to be read at once
+    try:
+      fiberFile = self.openFiberFile(filename)
+    except ValueError as e:
+      logging.warning(f"{e}: reading the whole file, memory is not bounded by the chunk size.")
+      fibers = FiberArrays.fromPolyData(self.read_polydata(filename))
+      for first in range(0, max(fibers.numberOfFibers, 1), blockSize):
+        yield fibers.subset(np.arange(first, min(first + blockSize, fibers.numberOfFibers)))
+      return
+    print(f"<wm_apply_ORG_atlas_to_subject> {fiberFile.numberOfFibers} fibers in {filename}, read in blocks of {blockSize}.")
+    yield from fiberFile.blocks(blockSize)
+
+  def splitTractography(self, inputPath, ChunksFolder, blockSize, sampleSize=CHUNK_REGISTRATION_FIBERS, seed=0):
+    """Split a tractography file into blocks of blockSize fibers.
+
+    Blocks are written to ChunksFolder/Blocks; a random sample of about sampleSize
+    fibers, drawn from all blocks, is written to ChunksFolder/<caseID>.vtp for
+    registration. Returns the block file names and the sample file name. The split
+    is recorded in ChunksFolder/blocks.json, stamped with the input and the split
+    parameters, and not repeated; a split of another input or block size is
+    removed with the block registrations and clusters computed from it.
+    """
+    caseID = os.path.splitext(os.path.basename(inputPath))[0]
+    BlocksFolder = os.path.join(ChunksFolder, "Blocks")
+    samplePath = os.path.join(ChunksFolder, caseID + ".vtp")
+    recordPath = os.path.join(ChunksFolder, "blocks.json")
+    stamp = self.inputStamp(inputPath, blockSize=blockSize, sampleSize=sampleSize, seed=seed)
+    if os.path.isfile(recordPath):
+      try:
+        with open(recordPath) as f:
+          record = json.load(f)
+      except (OSError, ValueError):
+        record = {}
+      blocks = record.pop("blocks", [])
+      if record == stamp and all(os.path.isfile(block) for block in blocks) and os.path.isfile(samplePath):
+        print(" - input has been split into", len(blocks), "blocks.")
+        return blocks, samplePath
+      os.remove(recordPath)
+      for folder in ("Blocks", "Registered", "Clusters"):
+        shutil.rmtree(os.path.join(ChunksFolder, folder), ignore_errors=True)
+    os.makedirs(BlocksFolder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    total = self.countFibers(inputPath)
+    blocks = []
+    samples = []
+    for index, block in enumerate(self.iterateFiberBlocks(inputPath, blockSize)):
+      blockPath = os.path.join(BlocksFolder, f"{caseID}_block{index:05d}.vtp")
+      self.write_polydata(block.toPolyData(), blockPath, verbose=False)
+      blocks.append(blockPath)
+      fraction = min(sampleSize / max(total, 1), 1.0)
+      samples.append(block.subset(np.flatnonzero(rng.random(block.numberOfFibers) < fraction)))
+      print(f" - block {index}: {block.numberOfFibers} fibers")
+    self.write_polydata(FiberArrays.concatenate(samples).toPolyData(), samplePath, verbose=False)
+    self.writeStamp(recordPath, dict(stamp, blocks=blocks))
+    return blocks, samplePath
+
+  def clusterTractographyInChunks(self, blocks, transforms, FCAtlasFolder, ChunksFolder, outputFolder, NumThreads, names=None):
+    """Register and cluster tractography blocks, then merge their clusters.
+
+    Each block is registered with the transforms estimated on the whole-brain sample,
+    in order, and clustered on its own by wm_cluster_from_atlas: fibers are embedded
+    against the atlas fibers only, so the assignment of a fiber does not depend on
+    the other fibers of the subject. The clusters of all blocks are then appended,
+    cluster by cluster, into outputFolder (only the clusters in names, if given),
+    each written under a temporary name and renamed once complete.
+    """
+    pythonSlicerExecutablePath = AnatomicalTractParcellationLogic._executePythonModule()
+    wm_cluster_from_atlas = self._wmaScriptPath('wm_cluster_from_atlas.py')
+    RegisteredFolder = os.path.join(ChunksFolder, "Registered")
+    ClustersFolder = os.path.join(ChunksFolder, "Clusters")
+    blockClusterFolders = []
+    for block in blocks:
+      blockID = os.path.splitext(os.path.basename(block))[0]
+      blockClusterFolder = os.path.join(ClustersFolder, blockID + "_reg")
+      blockClusterFolders.append(blockClusterFolder)
+      if os.path.isfile(os.path.join(blockClusterFolder, "cluster_00800.vtp")):
+        continue
+      registered = block
+      for step, transform in enumerate(transforms):
+        output = os.path.join(RegisteredFolder, f"{blockID}_reg{step}.vtp")
+        self.harden_polydata_file(registered, transform, output, inverse=True)
+        if registered != block:
+          os.remove(registered)
+        registered = output
+      os.replace(registered, os.path.join(RegisteredFolder, blockID + "_reg.vtp"))
+      registered = os.path.join(RegisteredFolder, blockID + "_reg.vtp")
+      print("<wm_apply_ORG_atlas_to_subject> Fiber clustering of", blockID)
+      commandLine = [pythonSlicerExecutablePath, wm_cluster_from_atlas, '-j', NumThreads,
+                     registered, FCAtlasFolder, ClustersFolder, '-norender']
+      self._runStage("clustering_" + blockID, commandLine, os.path.join(os.path.dirname(ChunksFolder), LOG_FOLDER), block=blockID)
+      os.remove(registered)
+      if not os.path.isfile(os.path.join(blockClusterFolder, "cluster_00800.vtp")):
+        raise RuntimeError(f"Fiber clustering of {blockID} failed")
+
+    # merge: one cluster of all blocks in memory at a time
+    os.makedirs(outputFolder, exist_ok=True)
+    if names is None:
+      names = sorted(os.path.basename(f) for f in glob.glob(os.path.join(blockClusterFolders[0], "cluster_*.vtp")))
+    for name in names:
+      parts = [FiberArrays.fromPolyData(self.read_polydata(os.path.join(folder, name)))
+               for folder in blockClusterFolders if os.path.isfile(os.path.join(folder, name))]
+      partial = os.path.join(outputFolder, ".partial_" + name)
+      self.write_polydata(FiberArrays.concatenate(parts).toPolyData(), partial, verbose=False)
+      os.replace(partial, os.path.join(outputFolder, name))
+    print(f"<wm_apply_ORG_atlas_to_subject> Merged {len(names)} clusters of {len(blocks)} blocks into", outputFolder)
+
+  @staticmethod
+  def meanAffinity(fibers, reference, sigma=OUTLIER_SIGMA, maximumPairs=200000):
+    # Mean affinity exp(-d^2/sigma^2) of each fiber to the reference fibers, both given as
+    # (fibers, points, 3) arrays; d is the mean point distance in the closest orientation
+    affinity = np.zeros(len(fibers))
+    if not len(fibers) or not len(reference):
+      return affinity
+    flipped = reference[:, ::-1]
+    blockSize = max(maximumPairs // len(reference), 1)
+    for start in range(0, len(fibers), blockSize):
+      block = fibers[start:start + blockSize, None]
+      distance = np.minimum(np.linalg.norm(block - reference[None], axis=3).mean(axis=2),
+                            np.linalg.norm(block - flipped[None], axis=3).mean(axis=2))
+      affinity[start:start + blockSize] = np.exp(-distance ** 2 / sigma ** 2).mean(axis=1)
+    return affinity
+
+  @staticmethod
+  def embeddingStamp(inputPath, FCAtlasFolder):
+    # Input and atlas the cached embedding of a subject was computed from
+    atlasFile = os.path.join(FCAtlasFolder, "atlas.p")
+    return {"input": os.path.abspath(inputPath), "inputSize": os.path.getsize(inputPath),
+            "inputTime": os.path.getmtime(inputPath), "atlas": os.path.abspath(FCAtlasFolder),
+            "atlasTime": os.path.getmtime(atlasFile) if os.path.isfile(atlasFile) else None}
+
+  def readEmbeddingCache(self, cachePath, inputPath=None, FCAtlasFolder=None):
+    # Cached embedding as a dict of arrays, or None if missing or computed from other data
+    try:
+      with np.load(cachePath) as cache:
+        embedding = {name: cache[name] for name in cache.files}
+    except (OSError, ValueError):
+      return None
+    if inputPath is not None and json.loads(str(embedding["stamp"])) != self.embeddingStamp(inputPath, FCAtlasFolder):
+      return None
+    return embedding
+
+  def computeAtlasEmbedding(self, inputPath, FCAtlasFolder, cachePath, numberOfJobs=1):
+    """Embed the fibers of a registered tractography in the atlas and cache the result.
+
+    Run in a headless Slicer process (see embeddingCommandLine) as it imports
+    whitematteranalysis. Fibers of at least EMBEDDING_MIN_LENGTH mm are embedded
+    and labeled by wma.cluster.spectral_atlas_label; the mean affinity of every
+    fiber to the fibers of its atlas cluster, and its mean and standard deviation
+    among the atlas fibers of each cluster, are computed for outlier removal. The
+    cache stores these per-fiber arrays with the index of each fiber in the input.
+    """
+    import whitematteranalysis as wma
+    from concurrent.futures import ThreadPoolExecutor
+    start = time.time()
+    fibers = FiberArrays.fromPolyData(self.read_polydata(inputPath))
+    fiberIndex = np.flatnonzero(fibers.fiberLengths() >= EMBEDDING_MIN_LENGTH)
+    fibers = fibers.subset(fiberIndex)
+    atlas = wma.cluster.load_atlas(FCAtlasFolder, "atlas")
+    _, cluster, _, embedding = wma.cluster.spectral_atlas_label(fibers.toPolyData(), atlas, number_of_jobs=int(numberOfJobs))
+    cluster = np.asarray(cluster, dtype=np.int32)
+    print(f"<computeAtlasEmbedding> Embedded {len(fiberIndex)} fibers of {inputPath} in {time.time() - start:.1f} s")
+
+    names = sorted(os.path.basename(f) for f in glob.glob(os.path.join(FCAtlasFolder, "cluster_*.vtp")))
+    resampled = fibers.resample(EMBEDDING_POINTS).points.reshape(-1, EMBEDDING_POINTS, 3)
+    similarity = np.zeros(len(fiberIndex), np.float32)
+    referenceMean = np.zeros(len(names), np.float32)
+    referenceStd = np.zeros(len(names), np.float32)
+
+    def affinities(c):
+      reference = FiberArrays.fromPolyData(self.read_polydata(os.path.join(FCAtlasFolder, names[c])))
+      if reference.numberOfFibers > OUTLIER_REFERENCE_FIBERS:
+        reference = reference.subset(np.sort(np.random.default_rng(c).choice(reference.numberOfFibers, OUTLIER_REFERENCE_FIBERS, replace=False)))
+      reference = reference.resample(EMBEDDING_POINTS).points.reshape(-1, EMBEDDING_POINTS, 3)
+      members = np.flatnonzero(cluster == c)
+      similarity[members] = self.meanAffinity(resampled[members], reference)
+      m = len(reference)
+      if m > 1:
+        # affinities among the atlas fibers, without the affinity of a fiber to itself
+        own = (self.meanAffinity(reference, reference) * m - 1.0) / (m - 1)
+        referenceMean[c], referenceStd[c] = own.mean(), own.std()
+
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      list(executor.map(affinities, range(len(names))))
+
+    stamp = json.dumps(self.embeddingStamp(inputPath, FCAtlasFolder))
+    with open(cachePath + ".partial", "wb") as f:
+      np.savez(f, fiberIndex=fiberIndex.astype(np.int64), cluster=cluster, embedding=np.asarray(embedding, np.float32),
+               similarity=similarity, referenceMean=referenceMean, referenceStd=referenceStd,
+               clusterNames=np.array(names), stamp=np.array(stamp))
+    os.replace(cachePath + ".partial", cachePath)
+    print(f"<computeAtlasEmbedding> Cached the atlas embedding in {cachePath} ({time.time() - start:.1f} s)")
+
+  @staticmethod
+  def embeddingCommandLine(inputPath, FCAtlasFolder, cachePath, numberOfJobs):
+    # Command computing the atlas embedding in a headless Slicer process, exit code 1 on errors
+    arguments = ", ".join(repr(a) for a in (os.path.abspath(inputPath), os.path.abspath(FCAtlasFolder),
+                                            os.path.abspath(cachePath), numberOfJobs))
+    code = ("import slicer, traceback\n"
+            "from AnatomicalTractParcellation import AnatomicalTractParcellationLogic\n"
+            "try:\n"
+            f"  AnatomicalTractParcellationLogic().computeAtlasEmbedding({arguments})\n"
+            "  slicer.app.exit(0)\n"
+            "except Exception:\n"
+            "  traceback.print_exc()\n"
+            "  slicer.app.exit(1)\n")
+    return [slicer.app.applicationFilePath(), "--no-splash", "--no-main-window", "--python-code", code]
+
+  def clustersFromEmbedding(self, cachePath, inputPath, outputFolder, names=None):
+    # Write the clusters of the cached embedding (only those in names, if given), each
+    # under a temporary name renamed once complete; returns the number of clusters written
+    cache = self.readEmbeddingCache(cachePath)
+    fibers = FiberArrays.fromPolyData(self.read_polydata(inputPath))
+    allNames = [str(name) for name in cache["clusterNames"]]
+    os.makedirs(outputFolder, exist_ok=True)
+    written = 0
+    for c, name in enumerate(allNames):
+      if names is not None and name not in names:
+        continue
+      partial = os.path.join(outputFolder, ".partial_" + name)
+      self.write_polydata(fibers.subset(cache["fiberIndex"][cache["cluster"] == c]).toPolyData(), partial, verbose=False)
+      os.replace(partial, os.path.join(outputFolder, name))
+      written += 1
+    print(f"<clustersFromEmbedding> Wrote {written} clusters of the cached embedding to {outputFolder}")
+    return written
+
+  @staticmethod
+  def removeClusteringOutputs(outputFolderPath, initialClusters=False):
+    # Remove the outputs of outlier removal and of the stages after it (and the initial
+    # clusters), so that they are redone from the current clustering
+    folders = ["OutlierRemovedClusters", "TransformedClusters", "SeparatedClusters"]
+    for folder in (["InitialClusters"] if initialClusters else []) + folders:
+      shutil.rmtree(os.path.join(outputFolderPath, "FiberClustering", folder), ignore_errors=True)
+    shutil.rmtree(os.path.join(outputFolderPath, "AnatomicalTracts"), ignore_errors=True)
+    for name in (RESULT_BUNDLE, SPATIAL_INDEX, FIBER_LABELS, FIBER_LABELS_INDEX):
+      if os.path.isfile(os.path.join(outputFolderPath, name)):
+        os.remove(os.path.join(outputFolderPath, name))
+
+  def removeOutliersFromEmbedding(self, cachePath, InitialClustersFolder, outputFolder, outlierStd=OUTLIER_STD, names=None):
+    """Remove the outlier fibers of the clusters of a cached embedding.
+
+    A fiber is an outlier when its cached affinity to its atlas cluster is more
+    than outlierStd standard deviations below the mean of the atlas fibers. Only
+    the clusters in names are written (all if None), each renamed once complete;
+    the threshold is recorded in the EMBEDDING_THRESHOLD file of outputFolder.
+    """
+    cache = self.readEmbeddingCache(cachePath)
+    os.makedirs(outputFolder, exist_ok=True)
+    removed = 0
+    for c, name in enumerate(str(name) for name in cache["clusterNames"]):
+      if names is not None and name not in names:
+        continue
+      fibers = FiberArrays.fromPolyData(self.read_polydata(os.path.join(InitialClustersFolder, name)))
+      similarity = cache["similarity"][cache["cluster"] == c]
+      if len(similarity) != fibers.numberOfFibers:
+        raise ValueError(f"{name} has {fibers.numberOfFibers} fibers, the cached embedding {len(similarity)}")
+      keep = similarity >= cache["referenceMean"][c] - outlierStd * cache["referenceStd"][c]
+      removed += int(len(keep) - keep.sum())
+      partial = os.path.join(outputFolder, ".partial_" + name)
+      self.write_polydata(fibers.subset(keep).toPolyData(), partial, verbose=False)
+      os.replace(partial, os.path.join(outputFolder, name))
+    with open(os.path.join(outputFolder, EMBEDDING_THRESHOLD), "w") as f:
+      json.dump({"outlierStd": outlierStd, "sigma": OUTLIER_SIGMA}, f)
+    print(f"<removeOutliersFromEmbedding> Removed {removed} outlier fibers (threshold {outlierStd} std) into {outputFolder}")
+    return removed
+
+  def outlierSweep(self, outputFolderPath, thresholds=(1.0, 1.5, 2.0, 2.5, 3.0, 4.0)):
+    # Fibers kept by outlier removal for several thresholds, from the cached embedding only
+    cache = self.readEmbeddingCache(os.path.join(outputFolderPath, EMBEDDING_CACHE))
+    if cache is None:
+      logging.error(f"No atlas embedding cache in {outputFolderPath}")
+      return None
+    mean = cache["referenceMean"][cache["cluster"]]
+    std = cache["referenceStd"][cache["cluster"]]
+    sweep = {}
+    for threshold in thresholds:
+      kept = int((cache["similarity"] >= mean - threshold * std).sum())
+      sweep[threshold] = {"kept": kept, "fraction": kept / max(len(mean), 1)}
+      print(f"<outlierSweep> threshold {threshold} std: {kept} of {len(mean)} fibers kept ({100.0 * sweep[threshold]['fraction']:.1f}%)")
+    return sweep
+
+  def prepareTractography(self, inputPath, outputPath, numberOfPoints=0, spacing=0.0, blockSize=PREPROCESS_BLOCK_FIBERS,
+                          minimumLength=0.0, duplicateTolerance=0.0):
+    """Resample and filter the fibers of a tractography file; resampled points are float32.
+
+    The input is read in blocks; every fiber is resampled to numberOfPoints points,
+    or with spacing (mm) to a number of points adapted to its length (or kept as
+    is when both are 0), and gets a
+    FiberIndex point array with its index in the input, used by
+    restoreOriginalGeometry. The output is written block by block as binary
+    legacy .vtk, so memory is bounded by the block size.
+
+    Fibers shorter than minimumLength (mm) are dropped, and with a
+    duplicateTolerance (mm) so are fibers matching an earlier fiber within it
+    (see FiberArrays.duplicateKeys). Returns the numbers of input, short and
+    duplicate fibers.
+    """
+    first = 0
+    inputPoints = 0
+    seen = np.zeros(0, np.uint64)
+    removed = {"fibers": 0, "short": 0, "duplicates": 0}
+    os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+    partial = outputPath + ".partial.vtk"
+    with LegacyFiberWriter(partial) as writer:
+      for block in self.iterateFiberBlocks(inputPath, blockSize):
+        block.pointData[FIBER_INDEX_ARRAY] = np.repeat(np.arange(first, first + block.numberOfFibers, dtype=np.int32), block.pointCounts())
+        inputPoints += block.numberOfPoints
+        first += block.numberOfFibers
+        removed["fibers"] += block.numberOfFibers
+        keep = np.ones(block.numberOfFibers, bool)
+        if minimumLength or duplicateTolerance:
+          # fibers without points are dropped as short
+          keep &= block.pointCounts() > 0
+        if minimumLength:
+          keep &= block.fiberLengths() >= minimumLength
+        removed["short"] += int((~keep).sum())
+        if duplicateTolerance:
+          keys = block.duplicateKeys(duplicateTolerance)
+          # first kept fiber of every key of this block, not seen in earlier blocks:
+          # a dropped short fiber is never the occurrence a duplicate is kept for
+          candidates = np.flatnonzero(keep)
+          unique = np.zeros(block.numberOfFibers, bool)
+          unique[candidates[np.unique(keys[candidates], return_index=True)[1]]] = True
+          unique &= ~np.isin(keys, seen)
+          removed["duplicates"] += int((keep & ~unique).sum())
+          keep &= unique
+          seen = np.union1d(seen, keys[keep])
+        if not keep.all():
+          block = block.subset(keep)
+        writer.write(block.resample(numberOfPoints, spacing) if numberOfPoints or spacing else block)
+    os.replace(partial, outputPath)
+    if minimumLength or duplicateTolerance:
+      print(f"<prepareTractography> Removed {removed['short']} fibers shorter than {minimumLength} mm and {removed['duplicates']}"
+            f" duplicate fibers (tolerance {duplicateTolerance} mm) of {removed['fibers']}.")
+    if numberOfPoints or spacing:
+      print(f"<prepareTractography> Resampled {writer.numberOfFibers} fibers from {inputPoints} to {writer.numberOfPoints} float32 points:",
+            f"{os.path.getsize(inputPath) / 1e6:.1f} MB -> {os.path.getsize(outputPath) / 1e6:.1f} MB")
+    else:
+      print(f"<prepareTractography> Wrote {writer.numberOfFibers} fibers ({writer.numberOfPoints} points) with their fiber indices:",
+            f"{os.path.getsize(inputPath) / 1e6:.1f} MB -> {os.path.getsize(outputPath) / 1e6:.1f} MB")
+    return removed
+
+  def convertTractography(self, inputPath, ConvertedFolder, blockSize=PREPROCESS_BLOCK_FIBERS, convertXML=False):
+    """Return a binary .vtk version of a .trk, .tck or ASCII .vtk input, for the WMA scripts.
+
+    Other inputs are returned as they are; with convertXML, .vtp inputs are converted
+    too (read at once), so that later stages memory-map their fibers. The conversion
+    is streamed block by block and cached in ConvertedFolder with the size and time
+    of the input, so it is made once per input.
+    """
+    extension = os.path.splitext(inputPath)[1].lower()
+    if extension == ".vtk":
+      try:
+        LegacyFiberFile(inputPath)
+        return inputPath
+      except ValueError:
+        pass
+    elif extension not in (".trk", ".tck") and not (convertXML and extension == ".vtp"):
+      return inputPath
+    caseID = os.path.splitext(os.path.basename(inputPath))[0]
+    outputPath = os.path.join(ConvertedFolder, caseID + ".vtk")
+    stamp = self.inputStamp(inputPath)
+    if os.path.isfile(outputPath) and self.stampMatches(outputPath + ".json", stamp):
+      print(" - converted input found:", outputPath)
+      return outputPath
+    os.makedirs(ConvertedFolder, exist_ok=True)
+    partial = outputPath + ".partial.vtk"
+    with LegacyFiberWriter(partial) as writer:
+      for block in self.iterateFiberBlocks(inputPath, blockSize):
+        writer.write(block)
+    os.replace(partial, outputPath)
+    self.writeStamp(outputPath + ".json", stamp)
+    print(f"<convertTractography> Converted {writer.numberOfFibers} fibers of {inputPath} to binary", outputPath)
+    return outputPath
+
+  def restoreOriginalGeometry(self, AnatomicalTractsFolder, originalPath, numberOfJobs=1, tracts=None):
+    """Replace the resampled fibers of the anatomical tracts by the input fibers.
+
+    Fibers are matched through their FiberIndex point array; the cell data of the
+    tracts (e.g. the hemisphere location) are kept. Tracts are taken from `tracts`
+    ({file name: FiberArrays}) when given and read from the folder otherwise. The
+    input fibers are memory-mapped: other formats than binary .vtk are converted
+    once, next to the tracts folder, by convertTractography.
+    Returns the restored tracts as {file name: FiberArrays}.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    originalPath = self.convertTractography(originalPath, os.path.join(os.path.dirname(os.path.abspath(AnatomicalTractsFolder)), CONVERTED_FOLDER),
+                                            convertXML=True)
+    take = LegacyFiberFile(originalPath).take
+    filenames = sorted(tracts) if tracts is not None else [os.path.basename(f) for f in glob.glob(os.path.join(AnatomicalTractsFolder, "*.vtp"))]
+
+    def restore(filename):
+      path = os.path.join(AnatomicalTractsFolder, filename)
+      tract = tracts[filename] if tracts is not None else FiberArrays.fromPolyData(self.read_polydata(path))
+      if FIBER_INDEX_ARRAY not in tract.pointData:
+        raise RuntimeError(f"{filename} has no {FIBER_INDEX_ARRAY} array")
+      indices = tract.pointData[FIBER_INDEX_ARRAY][tract.offsets[:-1][tract.pointCounts() > 0]].astype(np.int64)
+      original = take(indices)
+      original.pointData[FIBER_INDEX_ARRAY] = np.repeat(indices.astype(np.int32), original.pointCounts())
+      original.cellData.update({name: values[tract.pointCounts() > 0] for name, values in tract.cellData.items()})
+      self.write_polydata(original.toPolyData(), path, verbose=False)
+      return original, self.fiber_file_entry(path, original)
+
+    restored = {}
+    entries = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      futures = [executor.submit(restore, filename) for filename in filenames]
+      with open(os.path.join(AnatomicalTractsFolder, "restore_original_geometry.log"), "w") as log:
+        for filename, future in zip(filenames, futures):
+          try:
+            restored[filename], entries[filename] = future.result()
+            log.write(f"{filename}\t{restored[filename].numberOfPoints}\n")
+          except Exception as e:
+            failed.append(filename)
+            logging.error(f"Restoring the original fibers of {filename} failed: {e}")
+        self.writeOutputIndex(AnatomicalTractsFolder, "AnatomicalTracts", entries, not failed)
+        if not failed:
+          log.write("<restoreOriginalGeometry> Done!!!\n")
+    print(f"<restoreOriginalGeometry> Restored the input fibers of {len(filenames) - len(failed)} anatomical tracts.")
+    return restored
+
+  def backProjectClusters(self, clusterFolder, sourcePath, outputFolder, numberOfJobs=1):
+    """Write subject-space clusters by taking their fibers from the subject tractography.
+
+    Replaces hardening the inverse registration transforms into the clusters:
+    fiber i of an output cluster is the fiber of sourcePath given by the
+    FiberIndex of fiber i of the atlas-space cluster, so the fibers still match
+    one to one for separation. The cell data of the atlas-space clusters are kept.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+      fiberFile = LegacyFiberFile(sourcePath)
+      fiberFile.offsets
+      take = fiberFile.take
+    except ValueError:
+      take = FiberArrays.fromPolyData(self.read_polydata(sourcePath)).subset
+    os.makedirs(outputFolder, exist_ok=True)
+
+    def project(cluster):
+      name = os.path.basename(cluster)
+      atlasFibers = FiberArrays.fromPolyData(self.read_polydata(cluster))
+      if FIBER_INDEX_ARRAY not in atlasFibers.pointData:
+        raise RuntimeError(f"{name} has no {FIBER_INDEX_ARRAY} array")
+      if (atlasFibers.pointCounts() == 0).any():
+        raise RuntimeError(f"{name} has fibers without points")
+      indices = atlasFibers.pointData[FIBER_INDEX_ARRAY][atlasFibers.offsets[:-1]].astype(np.int64)
+      fibers = take(indices)
+      fibers.pointData[FIBER_INDEX_ARRAY] = np.repeat(indices.astype(np.int32), fibers.pointCounts())
+      fibers.cellData.update(atlasFibers.cellData)
+      path = os.path.join(outputFolder, name)
+      self.write_polydata(fibers.toPolyData(), path, verbose=False)
+      return name, self.fiber_file_entry(path, fibers)
+
+    clusters = self.list_vtk_files(clusterFolder)
+    entries = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      futures = [executor.submit(project, cluster) for cluster in clusters]
+      for cluster, future in zip(clusters, futures):
+        try:
+          name, entries[name] = future.result()
+        except Exception as e:
+          failed.append(cluster)
+          logging.error(f"Back-projecting {cluster} failed: {e}")
+    self.writeOutputIndex(outputFolder, "TransformedClusters", entries, not failed)
+    print(f"<backProjectClusters> Wrote {len(entries)} clusters with the subject fibers of {sourcePath} to", outputFolder)
+
+  def labelTractography(self, originalPath, InitialClustersFolder, OutlierRemovedFolder, FCAtlasFolder, outputFolderPath, numberOfJobs=1,
+                        blockSize=PREPROCESS_BLOCK_FIBERS):
+    """Write the input fibers once, labeled with their cluster, hemisphere and tract.
+
+    Instead of per-cluster and per-tract geometry, every input fiber gets ClusterId,
+    HemisphereLocation, TractId (-1 when not assigned) and Outlier cell arrays,
+    from the FiberIndex point array of the atlas-space clusters. Fibers of the
+    initial clusters missing after outlier removal are flagged as outliers and
+    belong to no tract. The tract names are stored in FIBER_LABELS_INDEX. The
+    input is streamed in blocks of blockSize fibers to the labeled file.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    numberOfFibers = self.countFibers(originalPath)
+    clusterIds = np.full(numberOfFibers, -1, np.int16)
+    hemispheres = np.full(numberOfFibers, -1, np.int16)
+    tractIds = np.full(numberOfFibers, -1, np.int16)
+    outliers = np.zeros(numberOfFibers, np.uint8)
+    tractNames = []
+    tractOfCluster = {}
+    for tract, clusters in self.read_atlas_tracts(FCAtlasFolder).items():
+      tractNames += [tract] if tract in COMMISSURAL_TRACTS else [tract + "_left", tract + "_right"]
+      tractOfCluster.update((cluster, tract) for cluster in clusters)
+    locationFile = os.path.join(FCAtlasFolder, "cluster_hemisphere_location.txt")
+    locations = self.read_cluster_location_file(locationFile) if os.path.isfile(locationFile) else {}
+
+    def fiberIndices(fibers):
+      if FIBER_INDEX_ARRAY not in fibers.pointData:
+        raise RuntimeError(f"the clusters have no {FIBER_INDEX_ARRAY} array")
+      return fibers.pointData[FIBER_INDEX_ARRAY][fibers.offsets[:-1][fibers.pointCounts() > 0]].astype(np.int64)
+
+    def label(cluster):
+      name = os.path.basename(cluster)
+      kept = FiberArrays.fromPolyData(self.read_polydata(os.path.join(OutlierRemovedFolder, name)))
+      kept = kept.subset(kept.pointCounts() > 0)
+      initial = FiberArrays.fromPolyData(self.read_polydata(cluster))
+      return name, fiberIndices(initial), fiberIndices(kept), self.assess_fiber_hemisphere(kept, locations.get(name, "n"))
+
+    clusters = self.list_vtk_files(InitialClustersFolder)
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      for name, initial, kept, labels in executor.map(label, clusters):
+        clusterIds[initial] = int(re.search(r"\d+", name).group(0))
+        outliers[initial] = 1
+        outliers[kept] = 0
+        hemispheres[kept] = labels
+        tract = tractOfCluster.get(name)
+        if tract in COMMISSURAL_TRACTS:
+          tractIds[kept[labels == HEMISPHERE_COMMISSURAL]] = tractNames.index(tract)
+        elif tract is not None:
+          tractIds[kept[labels == HEMISPHERE_LEFT]] = tractNames.index(tract + "_left")
+          tractIds[kept[labels == HEMISPHERE_RIGHT]] = tractNames.index(tract + "_right")
+
+    # stream the input fibers with their slices of the labels as cell data
+    labeledPath = os.path.join(outputFolderPath, FIBER_LABELS)
+    partial = labeledPath + ".partial.vtk"
+    first = 0
+    with LegacyFiberWriter(partial) as writer:
+      for block in self.iterateFiberBlocks(originalPath, blockSize):
+        last = first + block.numberOfFibers
+        block.cellData.update({CLUSTER_ID_ARRAY: clusterIds[first:last], HEMISPHERE_ARRAY: hemispheres[first:last],
+                               TRACT_ID_ARRAY: tractIds[first:last], OUTLIER_ARRAY: outliers[first:last]})
+        writer.write(block)
+        first = last
+    os.replace(partial, labeledPath)
+    counts = np.bincount(tractIds[tractIds >= 0], minlength=len(tractNames))
+    labels = {"input": os.path.abspath(originalPath), "fibers": numberOfFibers, "tracts": tractNames,
+              "tractFibers": dict(zip(tractNames, counts.tolist())), "hemispheres": {str(k): v for k, v in HEMISPHERE_FOLDERS.items()},
+              "clustered": int((clusterIds >= 0).sum()), "outliers": int(outliers.sum())}
+    with open(os.path.join(outputFolderPath, FIBER_LABELS_INDEX + ".partial"), "w") as f:
+      json.dump(labels, f, indent=1)
+    os.replace(os.path.join(outputFolderPath, FIBER_LABELS_INDEX + ".partial"), os.path.join(outputFolderPath, FIBER_LABELS_INDEX))
+    print(f"<labelTractography> Labeled {labels['clustered']} of {numberOfFibers} fibers ({labels['outliers']} outliers,"
+          f" {int(counts.sum())} in anatomical tracts):", labeledPath)
+    return labels
+
+  def extractLabeledFibers(self, outputFolderPath, tract=None, cluster=None, hemisphere=None, outputPath=None):
+    """Materialize fibers of a labeled tractography written by labelTractography.
+
+    Fibers are selected by tract name, cluster number and/or hemisphere label and
+    read from the memory-mapped labeled file without loading the others. Returns
+    the FiberArrays, also written to outputPath if given.
+    """
+    with open(os.path.join(outputFolderPath, FIBER_LABELS_INDEX)) as f:
+      labels = json.load(f)
+    fiberFile = LegacyFiberFile(os.path.join(outputFolderPath, FIBER_LABELS))
+    selected = np.ones(fiberFile.numberOfFibers, bool)
+    if tract is not None:
+      if tract not in labels["tracts"]:
+        raise ValueError(f"Unknown anatomical tract {tract}")
+      selected &= LegacyFiberFile._values(fiberFile.cellData[TRACT_ID_ARRAY], slice(None)) == labels["tracts"].index(tract)
+    if cluster is not None:
+      selected &= LegacyFiberFile._values(fiberFile.cellData[CLUSTER_ID_ARRAY], slice(None)) == int(cluster)
+    if hemisphere is not None:
+      selected &= LegacyFiberFile._values(fiberFile.cellData[HEMISPHERE_ARRAY], slice(None)) == int(hemisphere)
+    fibers = fiberFile.take(np.flatnonzero(selected))
+    if outputPath:
+      self.write_polydata(fibers.toPolyData(), outputPath, verbose=False)
+    return fibers
+
+  @staticmethod
+  def read_cluster_location_file(filename):
+    # Read the atlas cluster location file: cluster name -> 'c' (commissural),
+    # 'h' (hemispheric) or 'n' (not given, decided per fiber)
+    locations = {}
+    with open(filename) as f:
+      for line in f:
+        tokens = line.split()
+        for i, token in enumerate(tokens[:-1]):
+          if token.startswith("cluster_"):
+            name = token if token.endswith(".vtp") else token + ".vtp"
+            locations[name] = tokens[i + 1].lower()[0]
+            break
+    return locations
+
+  @staticmethod
+  def assess_fiber_hemisphere(fibers, location="n", pthresh=HEMISPHERE_THRESHOLD):
+    """Label each fiber of a FiberArrays in atlas space as right, left or commissural.
+
+    Commissural clusters keep all their fibers commissural, fibers of hemispheric
+    clusters go to the side holding most of their points, other fibers are
+    commissural unless at least pthresh of their points lie in one hemisphere.
+    """
+    x = fibers.points[:, 0]
+    counts = np.maximum(fibers.pointCounts(), 1)
+    left = fibers.fiberSums(x < 0) / counts
+    right = fibers.fiberSums(x > 0) / counts
+    labels = np.full(fibers.numberOfFibers, HEMISPHERE_COMMISSURAL, dtype=np.int32)
+    if location == "c":
+      return labels
+    if location == "h":
+      return np.where(right >= left, HEMISPHERE_RIGHT, HEMISPHERE_LEFT).astype(np.int32)
+    labels[left >= pthresh] = HEMISPHERE_LEFT
+    labels[right >= pthresh] = HEMISPHERE_RIGHT
+    return labels
+
+  @staticmethod
+  def _logReportsDone(filename):
+    # stage logs end with a "Done!!!" line once every input was processed
+    if not os.path.isfile(filename):
+      return False
+    with open(filename) as f:
+      return "Done!!!" in f.read()
+
+  def fiber_file_entry(self, filename, fibers=None):
+    # Index entry of a fiber file: fiber and point counts, size and bounding box;
+    # checksums are added on demand by checksumOutputIndex
+    if fibers is None:
+      fibers = FiberArrays.fromPolyData(self.read_polydata(filename))
+    if fibers.numberOfPoints:
+      bounds = np.concatenate([fibers.points.min(axis=0), fibers.points.max(axis=0)]).tolist()
+    else:
+      bounds = None
+    return {"fibers": int(fibers.numberOfFibers), "points": int(fibers.numberOfPoints),
+            "bytes": os.path.getsize(filename), "bounds": bounds}
+
+  @staticmethod
+  def writeOutputIndex(folder, stage, entries, complete=True):
+    """Write the index of the fiber files of a stage output folder.
+
+    The index maps every file name to its fiber_file_entry and records the totals,
+    so that later stages and cohort QC get counts without opening the files.
+    """
+    index = {"stage": stage, "created": time.time(), "complete": complete,
+             "files": {name: entries[name] for name in sorted(entries)},
+             "fibers": sum(entry["fibers"] for entry in entries.values()),
+             "points": sum(entry["points"] for entry in entries.values())}
+    path = os.path.join(folder, OUTPUT_INDEX)
+    with open(path + ".partial", "w") as f:
+      json.dump(index, f, indent=1)
+    os.replace(path + ".partial", path)
+    return index
+
+  @staticmethod
+  def readOutputIndex(folder):
+    # Index of a stage output folder, or None if the stage did not write one
+    try:
+      with open(os.path.join(folder, OUTPUT_INDEX)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def checksumOutputIndex(self, folder, numberOfJobs=1):
+    """Add the sha256 of every indexed file of a stage output folder to its index.
+
+    Checksums are not computed while stages run, as hashing rereads every output;
+    this fills in the missing ones for QC or archiving and returns the index.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    index = self.readOutputIndex(folder)
+    if index is None:
+      return None
+    names = [name for name, entry in index["files"].items() if "sha256" not in entry]
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      checksums = list(executor.map(lambda name: self._sha256(os.path.join(folder, name)), names))
+    for name, checksum in zip(names, checksums):
+      index["files"][name]["sha256"] = checksum
+    return self.writeOutputIndex(folder, index["stage"], index["files"], index.get("complete", True))
+
+  def indexStageOutput(self, folder, stage, numberOfJobs=1):
+    # Index the fiber files of a folder written by an external (WMA script) stage
+    from concurrent.futures import ThreadPoolExecutor
+    if not os.path.isdir(folder):
+      return None
+    filenames = self.list_vtk_files(folder)
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      entries = list(executor.map(self.fiber_file_entry, filenames))
+    return self.writeOutputIndex(folder, stage, {os.path.basename(f): e for f, e in zip(filenames, entries)})
+
+  def stageFileCount(self, folder):
+    # Number of fiber files of a stage output, from its index when there is one
+    index = self.readOutputIndex(folder)
+    if index is not None:
+      return len(index["files"])
+    return len(self.list_vtk_files(folder)) if os.path.isdir(folder) else 0
+
+  @staticmethod
+  def completeFiberFile(filename):
+    # Whether a fiber file was written to its end: VTK XML files end with their closing tag
+    size = os.path.getsize(filename)
+    if os.path.splitext(filename)[1].lower() != ".vtp":
+      return size > 0
+    with open(filename, "rb") as f:
+      f.seek(max(size - 64, 0))
+      return b"</VTKFile>" in f.read()
+
+  def verifyClusters(self, folder, names, stage, numberOfJobs=1):
+    """Check the cluster files of a stage output folder, cluster by cluster.
+
+    Clusters listed in the folder index with their size are complete. Other
+    existing clusters, left by an interrupted stage, are kept and indexed if they
+    are whole readable files, and removed otherwise. The index is rewritten, marked
+    complete when no cluster is missing; returns the names of the missing clusters.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    index = self.readOutputIndex(folder) or {"files": {}}
+    entries = {}
+    unchecked = []
+    for name in names:
+      path = os.path.join(folder, name)
+      entry = index["files"].get(name)
+      if not os.path.isfile(path):
+        continue
+      if entry is not None and entry["bytes"] == os.path.getsize(path):
+        entries[name] = entry
+      else:
+        unchecked.append(name)
+
+    def check(name):
+      path = os.path.join(folder, name)
+      try:
+        return self.fiber_file_entry(path) if self.completeFiberFile(path) else None
+      except Exception:
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      for name, entry in zip(unchecked, executor.map(check, unchecked)):
+        if entry is None:
+          logging.warning(f"<verifyClusters> Removing the incomplete cluster {os.path.join(folder, name)}")
+          os.remove(os.path.join(folder, name))
+        else:
+          entries[name] = entry
+    missing = [name for name in names if name not in entries]
+    if os.path.isdir(folder):
+      self.writeOutputIndex(folder, stage, entries, complete=not missing)
+    return missing
+
+  def commitClusters(self, stagingFolder, folder, names):
+    """Move the complete clusters among names from a staging folder into a stage output.
+
+    Each cluster is committed by an atomic rename, so the output folder only ever
+    holds whole clusters; the other files of the staging folder (scenes) are moved
+    along. Returns the number of clusters committed.
+    """
+    os.makedirs(folder, exist_ok=True)
+    committed = 0
+    for name in names:
+      path = os.path.join(stagingFolder, name)
+      if os.path.isfile(path) and self.completeFiberFile(path):
+        os.replace(path, os.path.join(folder, name))
+        committed += 1
+    if os.path.isdir(stagingFolder):
+      for name in os.listdir(stagingFolder):
+        if not name.startswith("cluster_") and os.path.isfile(os.path.join(stagingFolder, name)):
+          os.replace(os.path.join(stagingFolder, name), os.path.join(folder, name))
+    return committed
+
+  @staticmethod
+  def linkFiles(sourceFolder, targetFolder, names):
+    # Hard links (or symbolic links, or copies) of the names of a folder in another folder
+    os.makedirs(targetFolder, exist_ok=True)
+    for name in names:
+      source = os.path.join(sourceFolder, name)
+      target = os.path.join(targetFolder, name)
+      if not os.path.exists(source) or os.path.lexists(target):
+        continue
+      try:
+        os.link(source, target)
+      except OSError:
+        try:
+          os.symlink(source, target, target_is_directory=os.path.isdir(source))
+        except OSError:
+          if os.path.isdir(source):
+            shutil.copytree(source, target)
+          else:
+            shutil.copy2(source, target)
+
+  def getSubjectIndex(self, outputFolderPath):
+    """Indexes of all stage outputs of a subject, as {folder relative to the output: index}."""
+    indexes = {}
+    for root, dirs, files in os.walk(outputFolderPath):
+      if OUTPUT_INDEX in files:
+        index = self.readOutputIndex(root)
+        if index is not None:
+          indexes[os.path.relpath(root, outputFolderPath).replace(os.sep, "/")] = index
+    return indexes
+
+  def getCohortIndex(self, outputFolderPaths, stageFolder="AnatomicalTracts", csvPath=None):
+    """Per-file counts of one stage output for several subjects, from their indexes only.
+
+    Returns rows of subject, file name, fiber and point counts, size and bounding
+    box, optionally written to csvPath; subjects without an index are reported
+    with an empty file name.
+    """
+    rows = []
+    for outputFolderPath in outputFolderPaths:
+      subject = os.path.basename(os.path.normpath(outputFolderPath))
+      index = self.readOutputIndex(os.path.join(outputFolderPath, stageFolder))
+      if index is None:
+        logging.warning(f"No output index in {os.path.join(outputFolderPath, stageFolder)}")
+        rows.append([subject, "", None, None, None, None])
+        continue
+      for name, entry in index["files"].items():
+        rows.append([subject, name, entry["fibers"], entry["points"], entry["bytes"], entry["bounds"]])
+    if csvPath:
+      with open(csvPath, "w") as f:
+        f.write("Subject,Name,Num_Fibers,Num_Points,Bytes,Bounds\n")
+        for row in rows:
+          f.write(",".join("" if value is None else (" ".join(f"{b:.2f}" for b in value) if isinstance(value, list) else str(value))
+                           for value in row) + "\n")
+    return rows
+
+  def separateClustersByHemisphere(self, atlasSpaceFolder, subjectSpaceFolder, clusterLocationFile, outputFolder, numberOfJobs=1, keepInMemory=False):
+    """Assess and separate clusters by hemisphere in one pass.
+
+    Hemisphere labels are computed per fiber from the atlas-space clusters, whose
+    fibers match one to one (same order) those of the subject-space clusters.
+    Each subject-space cluster is written, with the labels as a cell array, to
+    the commissural, left and right hemisphere folders. With keepInMemory the
+    separated clusters are also returned as {folder: {cluster name: FiberArrays}}.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    locations = self.read_cluster_location_file(clusterLocationFile) if os.path.isfile(clusterLocationFile) else {}
+    for folder in HEMISPHERE_FOLDERS.values():
+      os.makedirs(os.path.join(outputFolder, folder), exist_ok=True)
+    separated = {folder: {} for folder in HEMISPHERE_FOLDERS.values()}
+    entries = {folder: {} for folder in HEMISPHERE_FOLDERS.values()}
+
+    def separate(subjectSpaceCluster):
+      name = os.path.basename(subjectSpaceCluster)
+      fibers = FiberArrays.fromPolyData(self.read_polydata(subjectSpaceCluster))
+      atlasFibers = FiberArrays.fromPolyData(self.read_polydata(os.path.join(atlasSpaceFolder, name)))
+      if atlasFibers.numberOfFibers != fibers.numberOfFibers:
+        raise RuntimeError(f"{name}: {atlasFibers.numberOfFibers} fibers in atlas space but {fibers.numberOfFibers} in subject space")
+      labels = self.assess_fiber_hemisphere(atlasFibers, locations.get(name, "n"))
+      fibers.cellData[HEMISPHERE_ARRAY] = labels
+      counts = {}
+      for label, folder in HEMISPHERE_FOLDERS.items():
+        part = fibers.subset(labels == label)
+        filename = os.path.join(outputFolder, folder, name)
+        self.write_polydata(part.toPolyData(), filename, verbose=False)
+        entries[folder][name] = self.fiber_file_entry(filename, part)
+        if keepInMemory:
+          separated[folder][name] = part
+        counts[folder] = part.numberOfFibers
+      return name, counts
+
+    clusters = self.list_vtk_files(subjectSpaceFolder)
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      futures = [executor.submit(separate, cluster) for cluster in clusters]
+      with open(os.path.join(outputFolder, "cluster_location_by_hemisphere.log"), "w") as log:
+        log.write("cluster\t" + "\t".join(HEMISPHERE_FOLDERS.values()) + "\n")
+        for cluster, future in zip(clusters, futures):
+          try:
+            name, counts = future.result()
+            log.write(name + "\t" + "\t".join(str(counts[folder]) for folder in HEMISPHERE_FOLDERS.values()) + "\n")
+          except Exception as e:
+            failed.append(cluster)
+            logging.error(f"Separating {cluster} by hemisphere failed: {e}")
+        for folder in HEMISPHERE_FOLDERS.values():
+          self.writeOutputIndex(os.path.join(outputFolder, folder), "SeparatedClusters", entries[folder], not failed)
+        if not failed:
+          log.write("<separateClustersByHemisphere> Done!!!\n")
+    print(f"<separateClustersByHemisphere> Separated {len(clusters) - len(failed)} clusters into", outputFolder)
+    return separated if keepInMemory else None
+
+  @staticmethod
+  def read_atlas_tracts(FCAtlasFolder):
+    # anatomical tract name -> names of its atlas clusters, from the atlas T_*.mrml scenes
+    tracts = {}
+    for mrml in sorted(glob.glob(os.path.join(FCAtlasFolder, "T_*.mrml"))):
+      with open(mrml) as f:
+        clusters = re.findall(r"cluster_\d+\.vtp", f.read())
+      tracts[os.path.splitext(os.path.basename(mrml))[0]] = list(dict.fromkeys(clusters))
+    return tracts
+
+  def appendClustersToTracts(self, SeparatedClustersFolder, FCAtlasFolder, AnatomicalTractsFolder, numberOfJobs=1, separated=None, keepInMemory=False):
+    """Append the separated clusters of each atlas tract into anatomical tracts.
+
+    Clusters are taken from `separated` ({folder: {cluster name: FiberArrays}}, as
+    returned by separateClustersByHemisphere) when given, and read from
+    SeparatedClustersFolder otherwise. Tracts are built in parallel. With
+    keepInMemory the tracts are also returned as {file name: FiberArrays}.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    os.makedirs(AnatomicalTractsFolder, exist_ok=True)
+    jobs = []
+    for tract, clusters in self.read_atlas_tracts(FCAtlasFolder).items():
+      if tract in COMMISSURAL_TRACTS:
+        jobs.append((tract + ".vtp", HEMISPHERE_FOLDERS[HEMISPHERE_COMMISSURAL], clusters))
+      else:
+        jobs.append((tract + "_left.vtp", HEMISPHERE_FOLDERS[HEMISPHERE_LEFT], clusters))
+        jobs.append((tract + "_right.vtp", HEMISPHERE_FOLDERS[HEMISPHERE_RIGHT], clusters))
+
+    def append(job):
+      filename, folder, clusters = job
+      parts = []
+      for cluster in clusters:
+        if separated is not None and cluster in separated.get(folder, {}):
+          parts.append(separated[folder][cluster])
+        else:
+          parts.append(FiberArrays.fromPolyData(self.read_polydata(os.path.join(SeparatedClustersFolder, folder, cluster))))
+      tract = FiberArrays.concatenate(parts)
+      path = os.path.join(AnatomicalTractsFolder, filename)
+      self.write_polydata(tract.toPolyData(), path, verbose=False)
+      entries[filename] = self.fiber_file_entry(path, tract)
+      if keepInMemory:
+        tracts[filename] = tract
+      return tract.numberOfFibers
+
+    tracts = {}
+    entries = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      futures = [executor.submit(append, job) for job in jobs]
+      with open(os.path.join(AnatomicalTractsFolder, "append_clusters_to_anatomical_tracts.log"), "w") as log:
+        for job, future in zip(jobs, futures):
+          try:
+            log.write(f"{job[0]}\t{future.result()}\n")
+          except Exception as e:
+            failed.append(job[0])
+            logging.error(f"Appending clusters into {job[0]} failed: {e}")
+        self.writeOutputIndex(AnatomicalTractsFolder, "AnatomicalTracts", entries, not failed)
+        if not failed:
+          log.write("<appendClustersToTracts> Done!!!\n")
+    print(f"<appendClustersToTracts> Wrote {len(jobs) - len(failed)} anatomical tracts to", AnatomicalTractsFolder)
+    return tracts if keepInMemory else None
+
+  def writeResultBundle(self, AnatomicalTractsFolder, bundlePath, tracts=None):
+    """Write all anatomical tracts of a subject into one .vtp file.
+
+    Every fiber has a TractId (cell and point array, the latter for coloring)
+    indexing the TractNames, TractColors and per-tract measurement arrays of the
+    field data. Tracts are taken from `tracts` ({file name: FiberArrays}) when
+    given, and read from AnatomicalTractsFolder otherwise.
+    """
+    from vtk.util import numpy_support
+    names = sorted(os.path.basename(f) for f in glob.glob(os.path.join(AnatomicalTractsFolder, "*.vtp")))
+    parts = []
+    for tractId, name in enumerate(names):
+      tract = tracts[name] if tracts is not None and name in tracts else FiberArrays.fromPolyData(self.read_polydata(os.path.join(AnatomicalTractsFolder, name)))
+      tract = FiberArrays(tract.points, tract.offsets, dict(tract.pointData), dict(tract.cellData), tract.activeArrays)
+      tract.cellData[TRACT_ID_ARRAY] = np.full(tract.numberOfFibers, tractId, np.int16)
+      tract.pointData[TRACT_ID_ARRAY] = np.full(tract.numberOfPoints, tractId, np.int16)
+      parts.append(tract)
+    polydata = FiberArrays.concatenate(parts).toPolyData()
+    fieldData = polydata.GetFieldData()
+    tractNames = vtk.vtkStringArray()
+    tractNames.SetName("TractNames")
+    for name in names:
+      tractNames.InsertNextValue(os.path.splitext(name)[0])
+    fieldData.AddArray(tractNames)
+    colors = numpy_support.numpy_to_vtk(np.array([self.hex_to_rgb(TRACT_COLORS[i % len(TRACT_COLORS)]) for i in range(len(names))], np.uint8).reshape(-1, 3), deep=1)
+    colors.SetName("TractColors")
+    fieldData.AddArray(colors)
+    csv = os.path.join(AnatomicalTractsFolder, "diffusion_measurements_anatomical_tracts.csv")
+    measurements = self.read_measurement_csv(csv) if os.path.isfile(csv) else {}
+    for column in sorted(set(column for row in measurements.values() for column in row)):
+      array = numpy_support.numpy_to_vtk(np.array([measurements.get(os.path.splitext(name)[0], {}).get(column, np.nan) for name in names]), deep=1)
+      array.SetName(column)
+      fieldData.AddArray(array)
+    self.write_polydata(polydata, bundlePath, verbose=False)
+    print(f"<wm_apply_ORG_atlas_to_subject> Wrote {len(names)} anatomical tracts to the bundle", bundlePath)
+
+  @profiledMethod
+  def loadResultBundle(self, bundlePath, namePrefix="", replace=False):
+    """Load a bundle written by writeResultBundle as one fiber bundle node.
+
+    The fibers are colored by tract with a color table of the tract names and
+    colors. With replace, the previously loaded bundles are removed first, to
+    review subjects one after the other.
+    """
+    if replace:
+      for node in slicer.util.getNodesByClass("vtkMRMLFiberBundleNode"):
+        if node.GetAttribute("AnatomicalTractParcellation.Bundle"):
+          colorNode = slicer.mrmlScene.GetNodeByID(node.GetAttribute("AnatomicalTractParcellation.Bundle"))
+          if colorNode is not None:
+            slicer.mrmlScene.RemoveNode(colorNode)
+          slicer.mrmlScene.RemoveNode(node)
+    node = slicer.util.loadFiberBundle(bundlePath)
+    name = namePrefix + os.path.basename(os.path.dirname(os.path.abspath(bundlePath)))
+    node.SetName(name)
+    fieldData = node.GetPolyData().GetFieldData()
+    tractNames = fieldData.GetAbstractArray("TractNames")
+    tractColors = fieldData.GetArray("TractColors")
+    colorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLColorTableNode", name + "_tracts")
+    colorNode.SetTypeToUser()
+    colorNode.SetNumberOfColors(tractNames.GetNumberOfValues())
+    for i in range(tractNames.GetNumberOfValues()):
+      r, g, b = tractColors.GetTuple3(i)
+      colorNode.SetColor(i, tractNames.GetValue(i), r / 255.0, g / 255.0, b / 255.0, 1.0)
+    node.SetAttribute("AnatomicalTractParcellation.Bundle", colorNode.GetID())
+    for displayNode in (node.GetLineDisplayNode(), node.GetTubeDisplayNode()):
+      if displayNode is None:
+        continue
+      displayNode.SetColorModeToScalarData()
+      displayNode.SetActiveScalarName(TRACT_ID_ARRAY)
+      displayNode.SetAndObserveColorNodeID(colorNode.GetID())
+      displayNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseColorNodeScalarRange)
+      displayNode.SetScalarVisibility(True)
+    node.GetLineDisplayNode().SetVisibility(True)
+    return node
+
+  @staticmethod
+  def tensor_scalars(tensors):
+    # TENSOR_MEASURES of (N, 9) or (N, 6: xx xy xz yy yz zz) tensors, from their
+    # eigenvalues l1 >= l2 >= l3 (Westin measures normalized by l1)
+    tensors = tensors.astype(np.float64)
+    if tensors.shape[1] == 6:
+      tensors = tensors[:, [0, 1, 2, 1, 3, 4, 2, 4, 5]]
+    eigenvalues = np.linalg.eigvalsh(tensors.reshape(-1, 3, 3))[:, ::-1]
+    l1, l2, l3 = eigenvalues.T
+    trace = eigenvalues.sum(axis=1)
+    md = trace / 3.0
+    deviation = np.sqrt(((eigenvalues - md[:, None]) ** 2).sum(axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+      measures = {
+        "FractionalAnisotropy": np.sqrt(1.5) * deviation / np.sqrt((eigenvalues ** 2).sum(axis=1)),
+        "RelativeAnisotropy": deviation / (np.sqrt(3.0) * md),
+        "LinearMeasure": (l1 - l2) / l1,
+        "PlanarMeasure": (l2 - l3) / l1,
+        "SphericalMeasure": l3 / l1,
+        }
+    measures = {name: np.nan_to_num(values) for name, values in measures.items()}
+    measures.update({"MaxEigenvalue": l1, "MidEigenvalue": l2, "MinEigenvalue": l3, "MeanDiffusivity": md, "Trace": trace,
+                     "ParallelDiffusivity": l1, "PerpendicularDiffusivity": (l2 + l3) / 2.0})
+    return {name: measures[name] for name in TENSOR_MEASURES}
+
+  @staticmethod
+  def fiber_measurements(fibers, lengthRange=False):
+    # measurement column -> value for one fiber bundle, computed from its arrays; the
+    # fiber length range only with lengthRange
+    lengths = fibers.fiberLengths()
+    measurements = {
+      "Num_Points": fibers.numberOfPoints,
+      "Num_Fibers": fibers.numberOfFibers,
+      "Mean_Length": lengths.mean() if len(lengths) else np.nan,
+      }
+    if lengthRange:
+      measurements["Min_Length"] = lengths.min() if len(lengths) else np.nan
+      measurements["Max_Length"] = lengths.max() if len(lengths) else np.nan
+    for name, values in fibers.pointData.items():
+      if name in MEASUREMENT_SKIPPED_ARRAYS:
+        continue
+      if values.ndim == 1 or values.shape[1] == 1:
+        scalars = {name: values.reshape(-1)}
+      elif values.shape[1] in (6, 9):
+        scalars = {f"{name}.{measure}": v for measure, v in AnatomicalTractParcellationLogic.tensor_scalars(values).items()}
+      else:
+        continue
+      for scalarName, v in scalars.items():
+        empty = len(v) == 0
+        measurements[scalarName + ".Max"] = np.nan if empty else float(np.max(v))
+        measurements[scalarName + ".Mean"] = np.nan if empty else float(np.mean(v, dtype=np.float64))
+        measurements[scalarName + ".Min"] = np.nan if empty else float(np.min(v))
+    return measurements
+
+  @staticmethod
+  def write_measurement_csv(rows, filename):
+    # rows: bundle name -> measurements; columns missing from a row are written as NAN
+    columns = set(column for measurements in rows.values() for column in measurements)
+    arrays = sorted(columns - set(MEASUREMENT_COLUMNS) - set(MEASUREMENT_EXTRA_COLUMNS))
+    header = MEASUREMENT_COLUMNS + arrays + [column for column in MEASUREMENT_EXTRA_COLUMNS if column in columns]
+    def formatValue(value):
+      if isinstance(value, (int, np.integer)):
+        return str(value)
+      return "NAN" if value is None or np.isnan(value) else f"{value:.6g}"
+    with open(filename + ".partial", "w") as f:
+      f.write(",".join(header) + "\n")
+      for name in sorted(rows):
+        f.write(",".join([name] + [formatValue(rows[name].get(column)) for column in header[1:]]) + "\n")
+    os.replace(filename + ".partial", filename)
+
+  def computeDiffusionMeasurements(self, inputFolder, csvPath, numberOfJobs=1, fibers=None, lengthRange=False):
+    """Write per-bundle fiber count, length and point scalar statistics to a CSV.
+
+    Replaces wm_diffusion_measurements.py and the FiberTractMeasurements CLI, with
+    its columns (plus Min_Length and Max_Length with lengthRange). Every .vtp file
+    of inputFolder is measured (in parallel), using the FiberArrays in `fibers`
+    ({file name: FiberArrays}) instead of reading the file when present.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    filenames = sorted(glob.glob(os.path.join(inputFolder, "*.vtp")))
+    def measure(filename):
+      name = os.path.basename(filename)
+      bundle = fibers.get(name) if fibers is not None else None
+      if bundle is None:
+        bundle = FiberArrays.fromPolyData(self.read_polydata(filename))
+      return os.path.splitext(name)[0], self.fiber_measurements(bundle, lengthRange)
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      rows = dict(executor.map(measure, filenames))
+    self.write_measurement_csv(rows, csvPath)
+    print(f"<computeDiffusionMeasurements> Measured {len(rows)} fiber bundles:", csvPath)
+    return rows
+
+  @staticmethod
+  def read_measurement_csv(filename):
+    # bundle name -> {column: value} of a CSV written by write_measurement_csv
+    rows = {}
+    with open(filename) as f:
+      header = f.readline().strip().split(",")
+      for line in f:
+        fields = line.strip().split(",")
+        if len(fields) == len(header):
+          rows[fields[0]] = {column: float("nan") if value == "NAN" else float(value) for column, value in zip(header[1:], fields[1:])}
+    return rows
+
+  def addSubjectToCohort(self, CohortFolder, subject, outputFolderPath):
+    """Add the diffusion measurements of a finished subject to a cohort store.
+
+    The cluster CSVs (per hemisphere group) and the anatomical tract CSV are read
+    once and appended as one segment; the store is compacted every
+    COHORT_COMPACT_SEGMENTS subjects.
+    """
+    SeparatedClustersFolder = os.path.join(outputFolderPath, "FiberClustering", "SeparatedClusters")
+    csvs = {folder.replace("tracts_", ""): os.path.join(SeparatedClustersFolder, f"diffusion_measurements_{folder.replace('tracts_', '')}.csv")
+            for folder in HEMISPHERE_FOLDERS.values()}
+    csvs["anatomical_tracts"] = os.path.join(outputFolderPath, "AnatomicalTracts", "diffusion_measurements_anatomical_tracts.csv")
+    groups = {group: self.read_measurement_csv(csv) for group, csv in csvs.items() if os.path.isfile(csv)}
+    if not groups:
+      logging.error(f"No diffusion measurements of {subject} to add to the cohort store")
+      return
+    store = CohortStore(CohortFolder)
+    store.add(subject, groups)
+    if len(store._segments()) >= COHORT_COMPACT_SEGMENTS:
+      store.compact()
+    print(f"<wm_apply_ORG_atlas_to_subject> Added {subject} to the cohort store {CohortFolder}")
+
+  def loadVTPFile(self, file_path, namePrefix=""):
     scene = slicer.mrmlScene
 
     # Load the VTP file as a FiberBundle
@@ -821,6 +4087,8 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     if loaded_fiber_node is None:
         print(f"Failed to load VTP file: {file_path}")
         return
+    if namePrefix:
+        loaded_fiber_node.SetName(namePrefix + loaded_fiber_node.GetName())
 
     # Modify the display properties of the loaded FiberBundle
     display_node = loaded_fiber_node.GetDisplayNode()
@@ -835,6 +4103,7 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
+  @profiledMethod
   def load_and_color_vtp(self, filename, color):
     # Create a.vtp file reader
     reader = vtk.vtkXMLPolyDataReader()
@@ -895,14 +4164,511 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
         display_node.SetFiberColor(color[0], color[1], color[2])
 
 
-  def Mainoperation(self, loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads):
+  def buildSpatialIndex(self, outputFolderPath, numberOfJobs=1, tracts=None, separated=None, voxelSize=SPATIAL_INDEX_VOXEL_SIZE):
+    """Build the voxel hash of the anatomical tracts and of the separated clusters.
 
-    if os.name == 'posix':
-        # Execute code for Unix-like operating systems
-        location = 'bin'
-    elif os.name == 'nt':
-        # Execute code for Windows operating systems
-        location = 'Scripts'
+    Groups are named <folder>/<file>, e.g. AnatomicalTracts/T_AF_left.vtp or
+    tracts_left_hemisphere/cluster_00001.vtp. Fibers are taken from `tracts` and
+    `separated` when given (as returned by appendClustersToTracts and
+    separateClustersByHemisphere) and read from the output folders otherwise.
+    The index is saved as spatial_index.npz in outputFolderPath.
+    """
+    groups = {}
+    AnatomicalTractsFolder = os.path.join(outputFolderPath, "AnatomicalTracts")
+    folders = [("AnatomicalTracts", AnatomicalTractsFolder, tracts)]
+    for folder in HEMISPHERE_FOLDERS.values():
+      folders.append((folder, os.path.join(outputFolderPath, "FiberClustering", "SeparatedClusters", folder),
+                      separated.get(folder) if separated is not None else None))
+    for label, folder, fibers in folders:
+      if fibers is not None:
+        for name, part in fibers.items():
+          groups[f"{label}/{name}"] = part
+      else:
+        for filename in self.list_vtk_files(folder):
+          groups[f"{label}/{os.path.basename(filename)}"] = FiberArrays.fromPolyData(self.read_polydata(filename))
+    index = SpatialIndex.build(groups, voxelSize, numberOfJobs)
+    index.save(os.path.join(outputFolderPath, SPATIAL_INDEX))
+    print(f"<buildSpatialIndex> Indexed {len(groups)} tracts and clusters in {len(np.unique(index.keys))} voxels of {voxelSize} mm.")
+    return index
+
+  # loaded spatial indexes, by file name
+  _spatialIndexes = {}
+
+  def getSpatialIndex(self, outputFolderPath):
+    # spatial index of a subject, kept in memory until its file changes
+    filename = os.path.join(outputFolderPath, SPATIAL_INDEX)
+    if not os.path.isfile(filename):
+      return None
+    cached = self._spatialIndexes.get(filename)
+    if cached is None or cached[0] != os.path.getmtime(filename):
+      cached = (os.path.getmtime(filename), SpatialIndex.load(filename))
+      self._spatialIndexes[filename] = cached
+    return cached[1]
+
+  def querySpatialIndex(self, outputFolderPath, lower=None, upper=None, centers=None, radius=5.0):
+    """Tracts and clusters passing through a box (lower, upper) or spheres (centers, radius).
+
+    Coordinates are those of the output fiber files. Returns (name, voxels, fibers)
+    rows sorted by decreasing fibers, where fibers is the largest number of fibers
+    of the group crossing one voxel of the region.
+    """
+    index = self.getSpatialIndex(outputFolderPath)
+    if index is None:
+      raise RuntimeError(f"No spatial index in {outputFolderPath}, run the parcellation first.")
+    if centers is not None:
+      result = index.querySpheres(centers, radius)
+    else:
+      result = index.queryBox(lower, upper)
+    return sorted(((name, voxels, fibers) for name, (voxels, fibers) in result.items()), key=lambda row: (-row[2], row[0]))
+
+  def queryMarkupsNode(self, outputFolderPath, node, radius=5.0):
+    # query with a markups ROI (its box) or the control points of other markups (spheres)
+    if node.IsA("vtkMRMLMarkupsROINode"):
+      bounds = [0.0] * 6
+      node.GetRASBounds(bounds)
+      return self.querySpatialIndex(outputFolderPath, lower=bounds[0::2], upper=bounds[1::2])
+    points = slicer.util.arrayFromMarkupsControlPoints(node)
+    if points is None or len(points) == 0:
+      return []
+    return self.querySpatialIndex(outputFolderPath, centers=points, radius=radius)
+
+  @staticmethod
+  def registrationParameters(RegPreset=DEFAULT_REGISTRATION_PRESET, RegFibers=None, RegLengthMin=None, RegLengthMax=None):
+    # Parameters of a registration preset, with the given values taking precedence
+    parameters = dict(REGISTRATION_PRESETS[RegPreset or DEFAULT_REGISTRATION_PRESET], preset=RegPreset or DEFAULT_REGISTRATION_PRESET)
+    for key, value in (("fibers", RegFibers), ("lengthMin", RegLengthMin), ("lengthMax", RegLengthMax)):
+      if value is not None:
+        parameters[key] = int(value)
+    return parameters
+
+  @staticmethod
+  def registrationTimings(outputFolderPaths):
+    # Registration seconds per preset from the run reports of several subjects,
+    # as {preset: {"runs", "mean", "min", "max"}}
+    seconds = {}
+    for outputFolderPath in outputFolderPaths:
+      try:
+        with open(os.path.join(outputFolderPath, RUN_REPORT)) as f:
+          report = json.load(f)
+      except (OSError, ValueError):
+        continue
+      stages = [r for r in report["stages"] if r["stage"].startswith("registration") and "registration" in r and not r.get("error")]
+      if stages:
+        seconds.setdefault(stages[0]["registration"]["preset"], []).append(sum(r["seconds"] for r in stages))
+    return {preset: {"runs": len(values), "mean": float(np.mean(values)), "min": min(values), "max": max(values)}
+            for preset, values in seconds.items()}
+
+  @staticmethod
+  def _fitLinear(x, y):
+    # (intercept, slope) >= 0 of y ~ intercept + slope * x; proportional if x does not vary
+    x, y = np.asarray(x, float), np.asarray(y, float)
+    if len(x) >= 2 and np.ptp(x) > 0:
+      slope, intercept = np.polyfit(x, y, 1)
+      if slope >= 0 and intercept >= 0:
+        return float(intercept), float(slope)
+    if x.sum() > 0:
+      return 0.0, float(y.sum() / x.sum())
+    return float(y.mean()), 0.0
+
+  def costModel(self, reportPaths):
+    """Calibrate the cost model of the dry-run planner from run reports.
+
+    Stage seconds are fitted as linear in the million input fibers (divided by
+    NumThreads for PLANNER_THREADED_STAGES), peak memory as linear in the input
+    points and peak and final disk as linear in the input bytes. Stages or
+    quantities without data keep the PLANNER_DEFAULT_* figures. Peaks measured
+    over the process lifetime (where a stage peak is not available) carry the
+    peaks of earlier subjects of the process, and are only used for its first subject.
+    """
+    samples = {}
+    memory, disk, final = [], [], []
+    reports = 0
+    for reportPath in reportPaths:
+      try:
+        with open(reportPath) as f:
+          report = json.load(f)
+      except (OSError, ValueError):
+        continue
+      size = report["settings"].get("input")
+      # blocks of the out-of-core mode are part of the chunked_clustering stage, and
+      # resumed stages only redid some of the clusters
+      stages = [r for r in report["stages"] if not r.get("error") and "block" not in r and "resumed" not in r]
+      if not size or not size["fibers"] or not stages:
+        continue
+      reports += 1
+      threads = max(int(report["settings"].get("NumThreads") or 1), 1)
+      for record in stages:
+        stage = re.sub(r"_(affine|nonrigid|left_hemisphere|right_hemisphere|commissural|tracts)$", "", record["stage"])
+        x = size["fibers"] / 1e6 / (threads if stage.startswith(PLANNER_THREADED_STAGES) else 1)
+        samples.setdefault(reportPath, {}).setdefault(stage, [x, 0.0])[1] += record["seconds"]
+      peaks = [r["peakMemory"] for r in report["stages"] if r.get("peakMemory")
+               and (r.get("peakMemoryScope") == "stage" or report.get("processSubject", 1) == 1)]
+      if peaks:
+        memory.append((size["points"], max(peaks)))
+      sizes = [r["diskBytes"] for r in report["stages"] if r.get("diskBytes") is not None]
+      if sizes:
+        disk.append((size["bytes"], max(sizes)))
+        final.append((size["bytes"], report.get("diskBytes", sizes[-1])))
+    stages = {}
+    for case in samples.values():
+      for stage, sample in case.items():
+        stages.setdefault(stage, []).append(sample)
+    model = {"reports": reports, "stages": dict(PLANNER_DEFAULT_STAGES) if not stages else {},
+             "memory": PLANNER_DEFAULT_MEMORY, "disk": PLANNER_DEFAULT_DISK, "final": PLANNER_DEFAULT_DISK}
+    for stage, values in stages.items():
+      model["stages"][stage] = self._fitLinear(*zip(*values))
+    for key, values in (("memory", memory), ("disk", disk), ("final", final)):
+      if values:
+        model[key] = self._fitLinear(*zip(*values))
+    return model
+
+  def planRun(self, inputs, NumThreads, reportPaths, QueueWorkers=0):
+    """Dry run: predict the runtime, peak memory and disk of processing inputs.
+
+    inputs is a list of (caseID, tractographyHeader) pairs. Returns the plan as
+    {"subjects": [...], "batch": {...}, "model": ...} and prints it. Subjects of a
+    batch run one after the other, or QueueWorkers at a time.
+    """
+    model = self.costModel(reportPaths)
+    threads = max(int(NumThreads), 1)
+    subjects = []
+    for caseID, header in inputs:
+      fibers = header["fibers"] / 1e6
+      stages = {stage: intercept + slope * fibers / (threads if stage.startswith(PLANNER_THREADED_STAGES) else 1)
+                for stage, (intercept, slope) in model["stages"].items()}
+      subjects.append({"case": caseID, **header, "stages": stages, "seconds": sum(stages.values()),
+                       "peakMemory": model["memory"][0] + model["memory"][1] * header["points"],
+                       "peakDisk": model["disk"][0] + model["disk"][1] * header["bytes"],
+                       "finalDisk": model["final"][0] + model["final"][1] * header["bytes"]})
+    workers = max(int(QueueWorkers), 1)
+    finals = sorted(s["finalDisk"] for s in subjects)
+    batch = {"subjects": len(subjects), "seconds": sum(s["seconds"] for s in subjects) / min(workers, max(len(subjects), 1)),
+             "peakMemory": sum(sorted((s["peakMemory"] for s in subjects), reverse=True)[:workers]),
+             # the outputs of finished subjects stay, the running ones are at their peak
+             "peakDisk": sum(finals) + sum(sorted((s["peakDisk"] - s["finalDisk"] for s in subjects), reverse=True)[:workers])}
+    print(f"<wm_apply_ORG_atlas_to_subject> DRY RUN at NumThreads={threads}"
+          + (f" with {workers} queue workers" if QueueWorkers else "")
+          + (f", model calibrated from {model['reports']} run reports." if model["reports"] else ", default model (no run reports found)."))
+    for subject in subjects:
+      print(f" - {subject['case']}: {subject['fibers']} fibers, {subject['points']} points, {subject['bytes'] / 1e6:.1f} MB:"
+            f" {subject['seconds'] / 60:.1f} min, peak memory {subject['peakMemory'] / 1e9:.1f} GB, peak disk {subject['peakDisk'] / 1e9:.2f} GB")
+      for stage, seconds in sorted(subject["stages"].items(), key=lambda item: -item[1]):
+        print(f"     {stage}: {seconds:.0f} s")
+    print(f" - batch of {batch['subjects']} subjects: {batch['seconds'] / 3600:.2f} h, peak memory {batch['peakMemory'] / 1e9:.1f} GB,"
+          f" peak disk {batch['peakDisk'] / 1e9:.2f} GB")
+    return {"subjects": subjects, "batch": batch, "model": model}
+
+  @staticmethod
+  def peakMemory(children=False):
+    # High-water mark in bytes of the resident memory of this process, or of its largest
+    # finished child, over the process lifetime; None where the resource module is not
+    # available (Windows)
+    try:
+      import resource
+    except ImportError:
+      return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss if platform.system() == "Darwin" else rss * 1024
+
+  @staticmethod
+  def statusMemory(pid="self", field="VmHWM"):
+    # Memory field of /proc/<pid>/status in bytes; None where /proc is not available
+    try:
+      with open(f"/proc/{pid}/status") as f:
+        for line in f:
+          if line.startswith(field + ":"):
+            return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+      pass
+    return None
+
+  @staticmethod
+  def resetPeakMemory():
+    # Reset the resident memory high-water mark (VmHWM) of this process to its current
+    # size (Linux); False where it cannot be reset
+    try:
+      with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+      return True
+    except OSError:
+      return False
+
+  def processTreeMemory(self, pid):
+    # Resident memory in bytes of a process and all its descendants; None without /proc
+    total = None
+    pids = [pid]
+    while pids:
+      pid = pids.pop()
+      rss = self.statusMemory(pid, "VmRSS")
+      if rss is None:
+        continue
+      total = (total or 0) + rss
+      for children in glob.glob(f"/proc/{pid}/task/*/children"):
+        try:
+          with open(children) as f:
+            pids.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+          pass
+    return total
+
+  @staticmethod
+  def syncScratchOutputs(sourceFolder, targetFolder, numberOfJobs=1, patterns=None):
+    """Copy the results of a subject processed in a scratch folder to its output folder.
+
+    By default the anatomical tracts, separated clusters and measurement CSVs,
+    registration transforms, logs, profiles, run report and spatial index are copied (also
+    of a Preview subfolder), in parallel as small-file copies are latency bound
+    on network filesystems. Every file is written under a temporary name and
+    renamed; stage logs and index.json files are copied last, so that an
+    interrupted copy is not taken for a finished stage. Returns the number of
+    files copied.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if patterns is None:
+      patterns = ["AnatomicalTracts/**/*", "FiberClustering/SeparatedClusters/**/*", "TractRegistration/*/output_tractography/*.tfm",
+                  LOG_FOLDER + "/*", PROFILE_FOLDER + "/*", RUN_REPORT, SPATIAL_INDEX, RESULT_BUNDLE, FIBER_LABELS, FIBER_LABELS_INDEX, EMBEDDING_CACHE]
+      patterns += ["Preview/" + pattern for pattern in patterns]
+    files = set()
+    for pattern in patterns:
+      files.update(os.path.relpath(f, sourceFolder) for f in glob.glob(os.path.join(sourceFolder, pattern), recursive=True) if os.path.isfile(f))
+    def copy(rel):
+      target = os.path.join(targetFolder, rel)
+      os.makedirs(os.path.dirname(target), exist_ok=True)
+      shutil.copyfile(os.path.join(sourceFolder, rel), target + ".partial")
+      os.replace(target + ".partial", target)
+    markers = sorted(rel for rel in files if rel.endswith(".log") or os.path.basename(rel) == OUTPUT_INDEX)
+    with ThreadPoolExecutor(max_workers=max(int(numberOfJobs), 1)) as executor:
+      list(executor.map(copy, sorted(files - set(markers))))
+      list(executor.map(copy, markers))
+    print(f"<wm_apply_ORG_atlas_to_subject> Copied {len(files)} files from {sourceFolder} to {targetFolder}")
+    return len(files)
+
+  @staticmethod
+  def folderSize(folder):
+    size = 0
+    for root, dirs, files in os.walk(folder):
+      for name in files:
+        try:
+          size += os.path.getsize(os.path.join(root, name))
+        except OSError:
+          pass
+    return size
+
+  # report of the subject being processed, see startRunReport
+  _runReport = None
+  _runReportPath = None
+  # subjects started in this process, see costModel
+  _processSubjects = 0
+  # profiler mode set from the panel, see profiled
+  profileMode = None
+  # event aborting the subject being processed at its next stage, see checkAborted
+  abortEvent = None
+  _profileLock = threading.Lock()
+  _profileCount = 0
+
+  def startRunReport(self, outputFolderPath, caseID, **settings):
+    # Start the run report of a subject; stages are added as they finish
+    AnatomicalTractParcellationLogic._processSubjects += 1
+    self._runReport = {"case": caseID, "output": os.path.abspath(outputFolderPath), "host": socket.gethostname(),
+                       "started": time.time(), "processSubject": self._processSubjects, "settings": settings, "stages": []}
+    self._runReportPath = os.path.join(outputFolderPath, RUN_REPORT)
+    self._writeRunReport()
+
+  def _writeRunReport(self):
+    if self._runReport is None:
+      return
+    with open(self._runReportPath + ".partial", "w") as f:
+      json.dump(self._runReport, f, indent=1)
+    os.replace(self._runReportPath + ".partial", self._runReportPath)
+
+  def recordStage(self, record):
+    # Add a stage record to the run report and save it, so it survives a crash
+    if self._runReport is None:
+      return
+    record.setdefault("diskBytes", self.folderSize(self._runReport["output"]))
+    self._runReport["stages"].append(record)
+    self._writeRunReport()
+
+  def finishRunReport(self):
+    if self._runReport is None:
+      return
+    self._runReport["seconds"] = round(time.time() - self._runReport["started"], 3)
+    self._runReport["diskBytes"] = self.folderSize(self._runReport["output"])
+    self._runReport["failed"] = [r["stage"] for r in self._runReport["stages"] if r.get("error")]
+    self._writeRunReport()
+    print(f"<wm_apply_ORG_atlas_to_subject> Run report: {self._runReportPath} ({self._runReport['seconds']:.1f} s)")
+    failed = self._runReport["failed"]
+    self._runReport = None
+    return failed
+
+  def checkAborted(self):
+    # Raise SubjectAborted if the processing of the subject was aborted (abortEvent)
+    if self.abortEvent is not None and self.abortEvent.is_set():
+      raise SubjectAborted("processing of the subject was aborted")
+
+  @contextlib.contextmanager
+  def timedStage(self, stage):
+    # Time (and profile, if enabled) an in-process stage into the run report; errors are recorded and raised
+    self.checkAborted()
+    record = {"stage": stage}
+    profile = None
+    # the peak of this stage where the high-water mark can be reset, else of the process so far
+    scope = "stage" if self.resetPeakMemory() else "process"
+    start = time.time()
+    try:
+      with self.profiled(stage) as profile:
+        yield record
+    except Exception as e:
+      record["error"] = str(e)
+      raise
+    finally:
+      record["seconds"] = round(time.time() - start, 3)
+      record["peakMemory"] = self.statusMemory() if scope == "stage" else self.peakMemory()
+      record["peakMemoryScope"] = scope
+      if profile and profile.get("path"):
+        record["profile"] = profile["path"]
+        if profile.get("threads"):
+          record["threadProfile"] = profile["threads"]
+      self.recordStage(record)
+
+  def profilingMode(self):
+    # "cprofile", "sample" or None: the panel option, else the SLICERWMA_PROFILE environment variable
+    mode = (self.profileMode or os.environ.get(PROFILE_ENV, "")).strip().lower()
+    if mode in ("1", "true", "yes", "on"):
+      mode = "cprofile"
+    return mode if mode in PROFILE_MODES else None
+
+  def profileFolder(self):
+    # Profiles of a subject go next to its run report, others to the Slicer temporary folder
+    if self._runReportPath:
+      return os.path.join(os.path.dirname(self._runReportPath), PROFILE_FOLDER)
+    return os.path.join(slicer.app.temporaryPath, PROFILE_FOLDER)
+
+  @contextlib.contextmanager
+  def profiled(self, name):
+    """Profile a block of module code when profiling is enabled (see profilingMode).
+
+    With "cprofile" the calling thread is profiled deterministically and dumped as
+    a .prof file (for pstats or snakeviz) with a .txt summary of the top functions
+    by cumulative time; cProfile does not see other threads, so the thread pools of
+    the stages (separation, append, measurements, ...) are sampled meanwhile and
+    dumped as .threads.collapsed.txt. With "sample" the stacks of all threads are
+    sampled and dumped as collapsed stacks for flame graphs. One block is profiled
+    at a time: blocks nested in it, or running meanwhile in other threads, are part
+    of its profile. Yields a dict that gets the dump paths ("path", and "threads"
+    if other threads were sampled), or None when not profiling.
+    """
+    mode = self.profilingMode()
+    if mode is None or not self._profileLock.acquire(blocking=False):
+      yield None
+      return
+    try:
+      profile = {"mode": mode}
+      profiler = cProfile.Profile() if mode == "cprofile" else StackSampler(PROFILE_SAMPLE_INTERVAL)
+      threads = StackSampler(PROFILE_SAMPLE_INTERVAL, exclude=threading.get_ident()) if mode == "cprofile" else None
+      try:
+        profiler.enable()
+      except ValueError as e:
+        # another profiler (e.g. of a debugger) is active
+        logging.warning(f"<profiled> {name} is not profiled: {e}")
+        yield None
+        return
+      if threads:
+        threads.enable()
+      try:
+        yield profile
+      finally:
+        profiler.disable()
+        if threads:
+          threads.disable()
+        folder = self.profileFolder()
+        os.makedirs(folder, exist_ok=True)
+        AnatomicalTractParcellationLogic._profileCount += 1
+        path = os.path.join(folder, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._profileCount}")
+        if mode == "cprofile":
+          profile["path"] = path + ".prof"
+          profiler.dump_stats(profile["path"])
+          with open(path + ".txt", "w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+          if threads.counts:
+            profile["threads"] = path + ".threads.collapsed.txt"
+            threads.dump(profile["threads"])
+        else:
+          profile["path"] = path + ".collapsed.txt"
+          profiler.dump(profile["path"])
+        print(f"<profiled> {name} profile: {profile['path']}" + (f", other threads: {profile['threads']}" if "threads" in profile else ""))
+    finally:
+      self._profileLock.release()
+
+  @staticmethod
+  def extractErrors(lines, maximumLines=20):
+    # The last Python traceback of a log, or else its lines that report an error
+    for i in range(len(lines) - 1, -1, -1):
+      if lines[i].startswith("Traceback (most recent call last)"):
+        return lines[i:][-maximumLines:]
+    return [line for line in lines if re.search(r"error|exception|failed", line, re.IGNORECASE)][-maximumLines:]
+
+  def _runStage(self, stage, commandLine, logFolder, **info):
+    """Run a stage script with its output captured to <logFolder>/<stage>.log.
+
+    A background thread reads the output, so the console only gets a progress
+    line every LOG_UPDATE_SECONDS and the GUI stays responsive. On failure the
+    error lines of the output are printed and returned. The stage is added to
+    the run report, with the items of info; returns its record. Its peak memory
+    is the largest resident memory of the process tree of the script, sampled
+    while it runs (short spikes between samples are missed).
+    """
+    self.checkAborted()
+    os.makedirs(logFolder, exist_ok=True)
+    logPath = os.path.join(logFolder, stage + ".log")
+    tail = collections.deque(maxlen=LOG_TAIL_LINES)
+    counter = {"lines": 0}
+    start = time.time()
+    print(f"<{stage}> started, output is logged to {logPath}")
+    proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
+
+    def read():
+      with open(logPath, "w", buffering=1 << 16) as log:
+        log.write(" ".join(str(argument) for argument in commandLine) + "\n\n")
+        for line in proc.stdout:
+          log.write(line)
+          tail.append(line.rstrip())
+          counter["lines"] += 1
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    lastUpdate = start
+    peak = None
+    while reader.is_alive():
+      reader.join(0.1)
+      slicer.app.processEvents()
+      rss = self.processTreeMemory(proc.pid)
+      if rss is not None:
+        peak = max(peak or 0, rss)
+      if self.abortEvent is not None and self.abortEvent.is_set() and proc.poll() is None:
+        proc.kill()
+      if time.time() - lastUpdate >= LOG_UPDATE_SECONDS and tail:
+        lastUpdate = time.time()
+        print(f"<{stage}> {time.time() - start:.0f} s, {counter['lines']} lines: {tail[-1][:200]}")
+    returncode = proc.wait()
+    self.checkAborted()
+    record = {"stage": stage, "returncode": returncode, "seconds": round(time.time() - start, 3),
+              "lines": counter["lines"], "log": logPath, "peakMemory": peak if peak is not None else self.peakMemory(children=True),
+              "peakMemoryScope": "stage" if peak is not None else "process", **info}
+    if returncode != 0:
+      record["error"] = self.extractErrors(list(tail)) or [f"exit code {returncode}"]
+      logging.error(f"<{stage}> failed with exit code {returncode}, see {logPath}:\n" + "\n".join(record["error"]))
+    else:
+      print(f"<{stage}> finished in {record['seconds']:.1f} s ({counter['lines']} lines of output)")
+    self.recordStage(record)
+    return record
+
+  def Mainoperation(self, loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads,
+                    PreviewFibers=0, PreviewMethod="random", ReusePreviewRegistration=False, ChunkFibers=0,
+                    ResamplePoints=0, ResampleSpacing=0.0, RestoreGeometry=True, FilterMinLength=0.0, DuplicateTolerance=0.0,
+                    RegPreset=DEFAULT_REGISTRATION_PRESET, RegFibers=None, RegLengthMin=None, RegLengthMax=None,
+                    CohortFolder=None, ScratchFolder=None, LabelOnly=False, BackProject=False,
+                    EmbeddingCache=False, OutlierStd=OUTLIER_STD, isPreview=False):
 
     # Get CaseID 
     filename = os.path.basename(input_tractography_path)
@@ -914,7 +4680,7 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
       print(' - create an output folder and reload.')
       os.makedirs(outputFolderPath)
     else:
-        numfiles = len(glob.glob(os.path.join(outputFolderPath, 'AnatomicalTracts', 'T*.vtp')))
+        numfiles = self.stageFileCount(os.path.join(outputFolderPath, 'AnatomicalTracts'))
         if numfiles > 1:
             print("")
             print("** Anatomical tracts ({} tracts) are detected in the output folder. Manually remove all files to rerun.".format(numfiles))
@@ -923,32 +4689,146 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     print(' - output folder exists.')
     print("")
 
+    # Scratch staging: all stages run in a subject folder on fast local storage and only
+    # the results are copied to the output folder. A finished subject is not staged again.
+    previewRun = bool(PreviewFibers) and not isPreview
+    finalTractsFolder = os.path.join(outputFolderPath, "Preview" if previewRun else "", "AnatomicalTracts")
+    def subjectDone():
+      if LabelOnly and not previewRun:
+        return os.path.isfile(os.path.join(outputFolderPath, FIBER_LABELS_INDEX))
+      return self._logReportsDone(os.path.join(finalTractsFolder, "append_clusters_to_anatomical_tracts.log"))
+    if ScratchFolder and not isPreview and not subjectDone():
+      # keyed on the input file too, so that a changed input is not staged over stale results
+      stagingKey = f"{os.path.abspath(outputFolderPath)}|{os.path.getsize(input_tractography_path)}|{os.path.getmtime(input_tractography_path)}"
+      scratchOutput = os.path.join(ScratchFolder, f"{caseID}-{hashlib.sha1(stagingKey.encode()).hexdigest()[:8]}")
+      print("<wm_apply_ORG_atlas_to_subject> Intermediate results are staged at:", scratchOutput)
+      os.makedirs(scratchOutput, exist_ok=True)
+      if ReusePreviewRegistration:
+        self.syncScratchOutputs(os.path.join(outputFolderPath, "Preview"), os.path.join(scratchOutput, "Preview"), NumThreads,
+                                ["TractRegistration/*/output_tractography/*.tfm"])
+      # results are loaded from the output folder once they are copied; stages that
+      # failed in the staged run are reported through its return value
+      done = self.Mainoperation("localdirectory", input_tractography_path, scratchOutput, RegMode, CleanMode, NumThreads,
+                                PreviewFibers=PreviewFibers, PreviewMethod=PreviewMethod, ReusePreviewRegistration=ReusePreviewRegistration,
+                                ChunkFibers=ChunkFibers, ResamplePoints=ResamplePoints, ResampleSpacing=ResampleSpacing,
+                                RestoreGeometry=RestoreGeometry, FilterMinLength=FilterMinLength, DuplicateTolerance=DuplicateTolerance, RegPreset=RegPreset, RegFibers=RegFibers, RegLengthMin=RegLengthMin,
+                                RegLengthMax=RegLengthMax, CohortFolder=CohortFolder, LabelOnly=LabelOnly, BackProject=BackProject,
+                                EmbeddingCache=EmbeddingCache, OutlierStd=OutlierStd)
+      self.syncScratchOutputs(scratchOutput, outputFolderPath, NumThreads)
+      if not subjectDone():
+        logging.error(f"Processing {caseID} did not finish, its intermediate results are kept at {scratchOutput}")
+        return False
+      shutil.rmtree(scratchOutput, ignore_errors=True)
+      if loadmode != "localdirectory" and not (LabelOnly and not previewRun):
+        self.loadAnatomicalTracts(finalTractsFolder, "Preview_" if previewRun else "")
+      return done
+
+    # Quick-look mode: run the whole pipeline on a subsample of the fibers, in a Preview subfolder
+    if PreviewFibers and not isPreview:
+      PreviewFolder = os.path.join(outputFolderPath, "Preview")
+      previewInput = os.path.join(PreviewFolder, caseID + ".vtp")
+      print(f"<wm_apply_ORG_atlas_to_subject> PREVIEW run on {PreviewFibers} fibers, stored at:", PreviewFolder)
+      # the preview stages are cached on their outputs: another subsample starts a new preview
+      previewStamp = self.inputStamp(input_tractography_path, fibers=int(PreviewFibers), method=PreviewMethod, seed=0)
+      if not (os.path.isfile(previewInput) and self.stampMatches(previewInput + ".json", previewStamp)):
+        if os.path.isdir(PreviewFolder):
+          print(" - the preview settings or the input changed, the previous preview is removed.")
+          shutil.rmtree(PreviewFolder)
+        os.makedirs(PreviewFolder)
+        self.subsampleTractography(input_tractography_path, previewInput, int(PreviewFibers), PreviewMethod, seed=0)
+        self.writeStamp(previewInput + ".json", previewStamp)
+      return self.Mainoperation(loadmode, previewInput, PreviewFolder, RegMode, CleanMode, NumThreads,
+                                RegPreset=RegPreset, RegFibers=RegFibers, RegLengthMin=RegLengthMin, RegLengthMax=RegLengthMax, isPreview=True)
+    namePrefix = "Preview_" if isPreview else ""
+    LogFolder = os.path.join(outputFolderPath, LOG_FOLDER)
+    registration = self.registrationParameters(RegPreset, RegFibers, RegLengthMin, RegLengthMax)
+    self.startRunReport(outputFolderPath, caseID, RegMode=RegMode, NumThreads=NumThreads, isPreview=isPreview,
+                        ChunkFibers=ChunkFibers, ResamplePoints=ResamplePoints, ResampleSpacing=ResampleSpacing,
+                        FilterMinLength=FilterMinLength, DuplicateTolerance=DuplicateTolerance, registration=registration, input=self.tractographyHeader(input_tractography_path))
+
+    # Optional pre-processing: registration and clustering use resampled float32 fibers,
+    # without short and duplicate fibers (the label-only output and the back-projection of
+    # the clusters need the FiberIndex array added by this step)
+    originalInput = input_tractography_path
+    preprocess = bool(ResamplePoints or ResampleSpacing or LabelOnly or BackProject or FilterMinLength or DuplicateTolerance) and not isPreview
+    if preprocess and (RestoreGeometry or LabelOnly):
+      # the input fibers are taken back by index after clustering: keep a memory-mapped copy
+      with self.timedStage("convert_input"):
+        originalInput = self.convertTractography(originalInput, os.path.join(outputFolderPath, CONVERTED_FOLDER), convertXML=True)
+    if preprocess:
+      PreprocessedTractography = os.path.join(outputFolderPath, "Preprocessed", caseID + ".vtk")
+      print("<wm_apply_ORG_atlas_to_subject> Pre-process fibers:", f"resample to {ResamplePoints} points." if ResamplePoints else
+            f"resample every {ResampleSpacing} mm." if ResampleSpacing else "no resampling (filtering and fiber indices only).")
+      preprocessStamp = self.inputStamp(input_tractography_path, ResamplePoints=int(ResamplePoints), ResampleSpacing=float(ResampleSpacing),
+                                        FilterMinLength=float(FilterMinLength), DuplicateTolerance=float(DuplicateTolerance))
+      if not (os.path.isfile(PreprocessedTractography) and self.stampMatches(PreprocessedTractography + ".json", preprocessStamp)):
+        if os.path.isfile(PreprocessedTractography):
+          logging.warning(f"{PreprocessedTractography} was made from another input or parameters and is redone;"
+                          " later stages keep their existing results.")
+        with self.timedStage("preprocess") as record:
+          record["removed"] = self.prepareTractography(originalInput, PreprocessedTractography, int(ResamplePoints), float(ResampleSpacing),
+                                                       blockSize=int(ChunkFibers) or PREPROCESS_BLOCK_FIBERS,
+                                                       minimumLength=float(FilterMinLength), duplicateTolerance=float(DuplicateTolerance))
+        self.writeStamp(PreprocessedTractography + ".json", preprocessStamp)
+      else:
+        print(" - resampling has been done.")
+      input_tractography_path = PreprocessedTractography
+      print("")
+    elif not (ChunkFibers and not isPreview):
+      # the pre-processing and out-of-core modes stream any input format, registration needs binary VTK
+      with self.timedStage("convert_input"):
+        input_tractography_path = self.convertTractography(input_tractography_path, os.path.join(outputFolderPath, CONVERTED_FOLDER))
+    # Out-of-core mode: the input is split into blocks of fibers and registration
+    # runs on a sample drawn from all blocks
+    registrationInput = input_tractography_path
+    ChunksFolder = os.path.join(outputFolderPath, "Chunks")
+    if ChunkFibers and not isPreview:
+      print(f"<wm_apply_ORG_atlas_to_subject> Out-of-core processing in blocks of {ChunkFibers} fibers, stored at:", ChunksFolder)
+      with self.timedStage("split"):
+        blocks, registrationInput = self.splitTractography(input_tractography_path, ChunksFolder, int(ChunkFibers))
+      print("")
+
     # Setup white matter parcellation atlas
-    atlasBasepath = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'Resources')
-    AtlasBaseFolder = str(glob.glob(os.path.join(atlasBasepath, 'ORG-Atlases*'))[0])
-    
+    AtlasBaseFolder, atlasVersion = self.resolveAtlas()
+    if AtlasBaseFolder is None:
+      logging.error(f"ERROR: ORG atlas can not be found in the atlas store {self.getAtlasStore()}.")
+      self.recordStage({"stage": "atlas", "error": "ORG atlas not found"})
+      self.finishRunReport()
+      return False
+
     RegAtlasFolder = os.path.join(AtlasBaseFolder, 'ORG-RegAtlas-100HCP')
     FCAtlasFolder = os.path.join(AtlasBaseFolder, 'ORG-800FC-100HCP')
     pythonSlicerExecutablePath = AnatomicalTractParcellationLogic._executePythonModule()
-    print("<wm_apply_ORG_atlas_to_subject> White matter atlas: ", AtlasBaseFolder)
+    print("<wm_apply_ORG_atlas_to_subject> White matter atlas: ", AtlasBaseFolder, f"(Version: {atlasVersion})")
     print(" - tractography registration atlas:", RegAtlasFolder)
     print(" - fiber clustering atlas:", FCAtlasFolder)
     print("pythonSlicerExecutablePath:", pythonSlicerExecutablePath)
     print("")
-    print("<wm_apply_ORG_atlas_to_subject> Tractography registration with mode [", RegMode, "]")
+    print("<wm_apply_ORG_atlas_to_subject> Tractography registration with mode [", RegMode, "], preset [", registration["preset"], "]")
+    registrationArguments = ["-f", str(registration["fibers"]), "-l", str(registration["lengthMin"]), "-lmax", str(registration["lengthMax"])]
     RegistrationFolder = os.path.join(outputFolderPath, 'TractRegistration')
-    print("input_tractography_path:",input_tractography_path)
+    print("input_tractography_path:",registrationInput)
+
+    # Reuse the registration transform(s) of an earlier preview run of this subject
+    if ReusePreviewRegistration and not isPreview:
+      if RegMode == "affine":
+        RegTractography = os.path.join(RegistrationFolder, caseID, "output_tractography", caseID+"_reg.vtk")
+      else:
+        RegTractography = os.path.join(RegistrationFolder, caseID+"_reg", "output_tractography", caseID+"_reg_reg.vtk")
+      if not os.path.isfile(RegTractography):
+        print("<wm_apply_ORG_atlas_to_subject> Reusing the registration of the preview run.")
+        with self.timedStage("preview_registration"):
+          self.applyPreviewRegistration(caseID, registrationInput, RegistrationFolder,
+                                        os.path.join(outputFolderPath, "Preview", "TractRegistration"), RegMode)
 
     # Start registration  
-    wm_register_to_atlas_new = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_register_to_atlas_new.py" in str(p)][0]
-    wm_register_to_atlas_new = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_register_to_atlas_new.py')
+    wm_register_to_atlas_new = self._wmaScriptPath('wm_register_to_atlas_new.py')
     if RegMode == "affine":
         RegTractography = os.path.join(RegistrationFolder, caseID, "output_tractography", caseID+"_reg.vtk")
         if not os.path.isfile(RegTractography):
-            if input_tractography_path:
-                commandLine = [pythonSlicerExecutablePath, wm_register_to_atlas_new, "-mode", "rigid_affine_fast", input_tractography_path, os.path.join(RegAtlasFolder, "registration_atlas.vtk"), RegistrationFolder]
-                proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-                slicer.util.logProcessOutput(proc) 
+            if registrationInput:
+                commandLine = [pythonSlicerExecutablePath, wm_register_to_atlas_new, "-mode", registration["affineMode"], *registrationArguments, registrationInput, os.path.join(RegAtlasFolder, "registration_atlas.vtk"), RegistrationFolder]
+                self._runStage("registration", commandLine, LogFolder, registration=registration)
                 
         else:
             print(" - registration has been done.")
@@ -956,17 +4836,14 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     elif RegMode == "affine + nonlinear":
         RegTractography = os.path.join(RegistrationFolder, caseID+"_reg", "output_tractography", caseID+"_reg_reg.vtk")
         if not os.path.isfile(RegTractography):
-            if input_tractography_path:
-                commandLine = [pythonSlicerExecutablePath, wm_register_to_atlas_new, "-mode", "affine", input_tractography_path, os.path.join(RegAtlasFolder, "registration_atlas.vtk"), RegistrationFolder]
-                registration_output = run_registration(commandLine)
-                slicer.util.logText(registration_output)
+            if registrationInput:
+                commandLine = [pythonSlicerExecutablePath, wm_register_to_atlas_new, "-mode", registration["initialMode"], *registrationArguments, registrationInput, os.path.join(RegAtlasFolder, "registration_atlas.vtk"), RegistrationFolder]
+                self._runStage("registration_affine", commandLine, LogFolder, registration=registration)
                 affineRegTract = os.path.join(RegistrationFolder, caseID, "output_tractography", caseID+"_reg.vtk")
-                commandLine = [pythonSlicerExecutablePath, wm_register_to_atlas_new, "-mode", "nonrigid", affineRegTract, os.path.join(RegAtlasFolder, "registration_atlas.vtk"), RegistrationFolder]
-                proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-                slicer.util.logProcessOutput(proc) 
-                
-            else:
-                print(" - registration has been done.")
+                commandLine = [pythonSlicerExecutablePath, wm_register_to_atlas_new, "-mode", "nonrigid", *registrationArguments, affineRegTract, os.path.join(RegAtlasFolder, "registration_atlas.vtk"), RegistrationFolder]
+                self._runStage("registration_nonrigid", commandLine, LogFolder, registration=registration)
+        else:
+            print(" - registration has been done.")
             
     print("")
     if not os.path.isfile(RegTractography):
@@ -983,75 +4860,162 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     print("<wm_apply_ORG_atlas_to_subject> Fiber clustering for whole-brain 800 fiber cluster parcellation.")
     print(f"Number of processors: {NumThreads}")
     FiberClusteringInitialFolder = os.path.join(outputFolderPath, "FiberClustering/InitialClusters")
-    if not os.path.isfile(os.path.join(FiberClusteringInitialFolder, FCcaseID, "cluster_00800.vtp")):
-        wm_cluster_from_atlas = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_cluster_from_atlas.py" in str(p)][0]
-        wm_cluster_from_atlas = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_cluster_from_atlas.py')
-        commandLine = [
-                      pythonSlicerExecutablePath,
-                      wm_cluster_from_atlas,
-                      '-j', NumThreads,
-                      RegTractography,
-                      FCAtlasFolder,
-                      FiberClusteringInitialFolder,
-                      '-norender'
-                  ]                       
-        proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-        slicer.util.logProcessOutput(proc) 
+    InitialClustersFolder = os.path.join(FiberClusteringInitialFolder, FCcaseID)
+    # clusters are committed one by one, a restart only redoes the missing or incomplete ones
+    clusterNames = sorted(os.path.basename(f) for f in glob.glob(os.path.join(FCAtlasFolder, "cluster_*.vtp")))
+    # optional in-process clustering, its per-fiber embedding is cached for outlier removal
+    useEmbedding = EmbeddingCache and not (ChunkFibers and not isPreview)
+    EmbeddingCachePath = os.path.join(outputFolderPath, EMBEDDING_CACHE)
+    # clusters made by the other method: initial clustering and the stages after it are redone
+    # (clusters without a record were made by wm_cluster_from_atlas, the only method before)
+    clusteringMethod = "embedding" if useEmbedding else "wm_cluster_from_atlas"
+    try:
+        with open(os.path.join(InitialClustersFolder, CLUSTERING_METHOD)) as f:
+            previousMethod = json.load(f).get("method")
+    except (OSError, ValueError):
+        previousMethod = "wm_cluster_from_atlas"
+    if previousMethod != clusteringMethod and os.path.isdir(InitialClustersFolder) and self.list_vtk_files(InitialClustersFolder):
+        print(f" - the initial clusters were made by {previousMethod}, initial clustering and the later stages are redone with {clusteringMethod}.")
+        self.removeClusteringOutputs(outputFolderPath, initialClusters=True)
+    os.makedirs(InitialClustersFolder, exist_ok=True)
+    self.writeStamp(os.path.join(InitialClustersFolder, CLUSTERING_METHOD), {"method": clusteringMethod})
+    missing = self.verifyClusters(InitialClustersFolder, clusterNames, "InitialClusters", NumThreads)
+    if missing:
+        if len(missing) < len(clusterNames):
+            print(f" - {len(clusterNames) - len(missing)} clusters were done, clustering again for the {len(missing)} others.")
+        if ChunkFibers and not isPreview:
+            transforms = [os.path.join(RegistrationFolder, caseID, "output_tractography", f"itk_txform_{caseID}.tfm")]
+            if RegMode == "affine + nonlinear":
+                transforms.append(os.path.join(RegistrationFolder, f"{caseID}_reg", "output_tractography", f"itk_txform_{caseID}_reg.tfm"))
+            try:
+                with self.timedStage("chunked_clustering"):
+                    self.clusterTractographyInChunks(blocks, transforms, FCAtlasFolder, ChunksFolder,
+                                                     InitialClustersFolder, NumThreads, names=missing)
+            except Exception as e:
+                logging.error(f"Out-of-core fiber clustering failed: {e}")
+        elif useEmbedding:
+            if self.readEmbeddingCache(EmbeddingCachePath, RegTractography, FCAtlasFolder) is None:
+                commandLine = self.embeddingCommandLine(RegTractography, FCAtlasFolder, EmbeddingCachePath, NumThreads)
+                self._runStage("atlas_embedding", commandLine, LogFolder)
+            else:
+                print(" - the atlas embedding is cached.")
+            try:
+                with self.timedStage("clusters_from_embedding"):
+                    self.clustersFromEmbedding(EmbeddingCachePath, RegTractography, InitialClustersFolder, missing)
+            except Exception as e:
+                logging.error(f"Fiber clustering from the atlas embedding failed: {e}")
+        else:
+            # the script writes to a staging folder, its complete clusters are then committed
+            StagingFolder = os.path.join(FiberClusteringInitialFolder, ".staging")
+            shutil.rmtree(StagingFolder, ignore_errors=True)
+            wm_cluster_from_atlas = self._wmaScriptPath('wm_cluster_from_atlas.py')
+            commandLine = [
+                          pythonSlicerExecutablePath,
+                          wm_cluster_from_atlas,
+                          '-j', NumThreads,
+                          RegTractography,
+                          FCAtlasFolder,
+                          StagingFolder,
+                          '-norender'
+                      ]                       
+            self._runStage("clustering", commandLine, LogFolder,
+                           **({"resumed": len(missing)} if len(missing) < len(clusterNames) else {}))
+            self.commitClusters(os.path.join(StagingFolder, FCcaseID), InitialClustersFolder, missing)
+            shutil.rmtree(StagingFolder, ignore_errors=True)
+        missing = self.verifyClusters(InitialClustersFolder, clusterNames, "InitialClusters", NumThreads)
     else:
         print(" - initial fiber clustering has been done.")
     print("")
 
-    num_files = len(os.listdir(f"{FiberClusteringInitialFolder}/{FCcaseID}"))
-    if num_files < 800:
+    num_files = len(clusterNames) - len(missing)
+    if missing:
         print("")
         print(f"ERROR: Initial fiber clustering failed. There should be 800 resulting fiber clusters, but only {num_files} generated.")
         print("")
+        # the later stages would silently miss these clusters; a rerun only redoes them
+        raise RuntimeError(f"Initial fiber clustering is missing {len(missing)} clusters, run again to resume")
         
     print("<wm_apply_ORG_atlas_to_subject> Outlier fiber removal.")
 
     FiberClusteringOutlierRemFolder = os.path.join(outputFolderPath, "FiberClustering/OutlierRemovedClusters")
-    print(os.path.join(FiberClusteringOutlierRemFolder, f"{FCcaseID}_outlier_removed", "cluster_00800.vtp"))
+    OutlierRemovedFolder = os.path.join(FiberClusteringOutlierRemFolder, f"{FCcaseID}_outlier_removed")
+    print(OutlierRemovedFolder)
                                      
-    if not os.path.isfile(os.path.join(FiberClusteringOutlierRemFolder, f"{FCcaseID}_outlier_removed", "cluster_00800.vtp")):                                 
-        wm_cluster_remove_outliers = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_cluster_remove_outliers.py" in str(p)][0]
-        wm_cluster_remove_outliers = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_cluster_remove_outliers.py')
+    if useEmbedding and os.path.isdir(OutlierRemovedFolder):
+        # another threshold (or method): outlier removal and the stages after it are redone
+        try:
+            with open(os.path.join(OutlierRemovedFolder, EMBEDDING_THRESHOLD)) as f:
+                previousStd = json.load(f).get("outlierStd")
+        except (OSError, ValueError):
+            previousStd = None
+        if previousStd != OutlierStd:
+            print(f" - outlier threshold changed from {previousStd} to {OutlierStd} std, outlier removal and the later stages are redone.")
+            self.removeClusteringOutputs(outputFolderPath)
+    missing = self.verifyClusters(OutlierRemovedFolder, clusterNames, "OutlierRemovedClusters", NumThreads)
+    if missing and useEmbedding:
+        try:
+            with self.timedStage("outliers_from_embedding"):
+                self.removeOutliersFromEmbedding(EmbeddingCachePath, InitialClustersFolder, OutlierRemovedFolder, OutlierStd, missing)
+        except Exception as e:
+            logging.error(f"Outlier removal from the atlas embedding failed: {e}")
+        missing = self.verifyClusters(OutlierRemovedFolder, clusterNames, "OutlierRemovedClusters", NumThreads)
+    elif missing:
+        # clusters are processed independently: on a restart the script only gets the
+        # missing clusters (and their atlas clusters), linked into a staging folder
+        StagingFolder = os.path.join(FiberClusteringOutlierRemFolder, ".staging")
+        shutil.rmtree(StagingFolder, ignore_errors=True)
+        inputFolder, atlasFolder = InitialClustersFolder, FCAtlasFolder
+        if len(missing) < len(clusterNames):
+            print(f" - {len(clusterNames) - len(missing)} clusters were done, removing the outliers of the {len(missing)} others.")
+            inputFolder = os.path.join(StagingFolder, "input", FCcaseID)
+            atlasFolder = os.path.join(StagingFolder, "atlas")
+            self.linkFiles(InitialClustersFolder, inputFolder, missing)
+            self.linkFiles(FCAtlasFolder, atlasFolder, missing + [n for n in os.listdir(FCAtlasFolder) if not n.startswith("cluster_")])
+        wm_cluster_remove_outliers = self._wmaScriptPath('wm_cluster_remove_outliers.py')
         commandLine = [
                       pythonSlicerExecutablePath,
                       wm_cluster_remove_outliers,
                       '-j', NumThreads,                      
-                      os.path.join(FiberClusteringInitialFolder, FCcaseID),
-                      FCAtlasFolder,
-                      FiberClusteringOutlierRemFolder,
+                      inputFolder,
+                      atlasFolder,
+                      os.path.join(StagingFolder, "output"),
                   ]
-        proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-        slicer.util.logProcessOutput(proc) 
+        self._runStage("outlier_removal", commandLine, LogFolder,
+                       **({"resumed": len(missing)} if len(missing) < len(clusterNames) else {}))
+        self.commitClusters(os.path.join(StagingFolder, "output", f"{FCcaseID}_outlier_removed"), OutlierRemovedFolder, missing)
+        shutil.rmtree(StagingFolder, ignore_errors=True)
+        missing = self.verifyClusters(OutlierRemovedFolder, clusterNames, "OutlierRemovedClusters", NumThreads)
     else:
         print(" - outlier fiber removal has been done.")
     print("")
 
-    numfiles = len([f for f in glob.glob(f"{FiberClusteringOutlierRemFolder}/{FCcaseID}_outlier_removed/*vtp")])
-    if numfiles < 800:
+    numfiles = len(clusterNames) - len(missing)
+    if missing:
         logging.error("")
         logging.error(f"ERROR: Outlier removal failed. There should be 800 resulting fiber clusters, but only {numfiles} generated.")
         logging.error("")
+        raise RuntimeError(f"Outlier removal is missing {len(missing)} clusters, run again to resume")
         
-    print("<wm_apply_ORG_atlas_to_subject> Hemisphere location assessment in the atlas space.")
-    if not os.path.isfile(os.path.join(FiberClusteringOutlierRemFolder, f"{FCcaseID}_outlier_removed/cluster_location_by_hemisphere.log")):
-        wm_assess_cluster_location_by_hemisphere = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_assess_cluster_location_by_hemisphere.py" in str(p)][0]
-        wm_assess_cluster_location_by_hemisphere = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_assess_cluster_location_by_hemisphere.py')
-        commandLine = [pythonSlicerExecutablePath, wm_assess_cluster_location_by_hemisphere, '-clusterLocationFile', os.path.join(FCAtlasFolder, "cluster_hemisphere_location.txt"), os.path.join(FiberClusteringOutlierRemFolder, f"{FCcaseID}_outlier_removed")]
-        proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-        slicer.util.logProcessOutput(proc)
-        
-    else:
-        print(" - hemisphere location assessment has been done.")
-    print("")
+    # Label-only output: the input fibers labeled once, without per-cluster and per-tract files
+    if LabelOnly and not isPreview:
+      print("<wm_apply_ORG_atlas_to_subject> Label the input fibers with their cluster, hemisphere and anatomical tract.")
+      if not os.path.isfile(os.path.join(outputFolderPath, FIBER_LABELS_INDEX)):
+        try:
+          with self.timedStage("fiber_labels"):
+            self.labelTractography(originalInput, InitialClustersFolder, OutlierRemovedFolder,
+                                   FCAtlasFolder, outputFolderPath, NumThreads, blockSize=int(ChunkFibers) or PREPROCESS_BLOCK_FIBERS)
+        except Exception as e:
+          logging.error(f"Labeling the input fibers failed: {e}")
+      else:
+        print(" - labeling has been done.")
+      if os.path.isfile(os.path.join(outputFolderPath, FIBER_LABELS_INDEX)):
+        for folder in ("FiberClustering", "Chunks", "Preprocessed"):
+          shutil.rmtree(os.path.join(outputFolderPath, folder), ignore_errors=True)
+        if not CleanMode:
+          os.system(f"rm -rf {outputFolderPath}/TractRegistration/*/output_tractography/*vtk")
+          os.system(f"rm -rf {outputFolderPath}/TractRegistration/*/iteration*")
+      return not self.finishRunReport() and subjectDone()
 
-    if not os.path.isfile(f"{FiberClusteringOutlierRemFolder}/{FCcaseID}_outlier_removed/cluster_location_by_hemisphere.log"):
-        print("")
-        print("ERROR: Hemisphere location assessment failed. There should be a cluster_location_by_hemisphere.log file, stating: \"<wm_assess_cluster_location_by_hemisphere.py> Done!!!\" ")
-        print("")
-        
     # Set input and output paths
     FiberClustersInTractographySpace = os.path.join(outputFolderPath, 'FiberClustering', 'TransformedClusters', f"{caseID}")
     tfm_rig = os.path.join(RegistrationFolder, f"{caseID}", 'output_tractography', f"itk_txform_{caseID}.tfm")
@@ -1059,130 +5023,118 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
     FiberClustersInTractographySpace_tmp = os.path.join(FiberClustersInTractographySpace, 'tmp')
     FCcaseID_outlier_removed = os.path.join(FiberClusteringOutlierRemFolder, f"{FCcaseID}_outlier_removed")
     
-    # Apply transforms
-    if RegMode == "affine":
+    # Apply transforms, or take the subject-space fibers of the clusters from the input
+    # (the original fibers when their geometry is restored, the pre-processed ones otherwise)
+    backProjected = BackProject and not isPreview
+    if backProjected:
+        if not os.path.exists(os.path.join(FiberClustersInTractographySpace, 'cluster_00800.vtp')):
+            with self.timedStage("back_projection"):
+                self.backProjectClusters(FCcaseID_outlier_removed, originalInput if RestoreGeometry else input_tractography_path,
+                                         FiberClustersInTractographySpace, NumThreads)
+        else:
+            print(" - back-projection has been done.")
+    elif RegMode == "affine":
         if not os.path.exists(os.path.join(FiberClustersInTractographySpace, 'cluster_00800.vtp')):  
-            self.python_harden_transform(FCcaseID_outlier_removed, FiberClustersInTractographySpace, tfm_rig, NumThreads)            
+            with self.timedStage("harden_transform"):
+                self.python_harden_transform(FCcaseID_outlier_removed, FiberClustersInTractographySpace, tfm_rig, NumThreads)            
         else: 
             print(" - transform has been done.")
     elif RegMode == "affine + nonlinear":
         if not os.path.exists(os.path.join(FiberClustersInTractographySpace_tmp, 'cluster_00800.vtp')):  
-            self.python_harden_transform(FCcaseID_outlier_removed, FiberClustersInTractographySpace_tmp, tfm_nonrig, NumThreads)     
+            with self.timedStage("harden_transform_nonrigid"):
+                self.python_harden_transform(FCcaseID_outlier_removed, FiberClustersInTractographySpace_tmp, tfm_nonrig, NumThreads)     
         else:
             print(" - transform has been done.")
         if not os.path.exists(os.path.join(FiberClustersInTractographySpace, 'cluster_00800.vtp')):           
-            self.python_harden_transform(FiberClustersInTractographySpace_tmp, FiberClustersInTractographySpace, tfm_rig, NumThreads)
+            with self.timedStage("harden_transform"):
+                self.python_harden_transform(FiberClustersInTractographySpace_tmp, FiberClustersInTractographySpace, tfm_rig, NumThreads)
         else:
             print(" - transform has been done.")
             
     print("")
 
-    numfiles = len(glob.glob(f"{FiberClustersInTractographySpace}/*vtp"))
+    numfiles = self.stageFileCount(FiberClustersInTractographySpace)
     if numfiles < 800:
         print("")
         print(f"ERROR: Transforming fiber clusters failed. There should be 800 resulting fiber clusters, but only {numfiles} generated.")
         print("")
+        self.recordStage({"stage": "transform_check", "error": f"{numfiles} of 800 transformed clusters"})
     
-    # Start separation
+    # Start separation: hemisphere location is assessed in the atlas space and
+    # used to separate the clusters in the tractography space, in one pass
     print("<wm_apply_ORG_atlas_to_subject> Separate fiber clusters by hemisphere.")
     SeparatedClustersFolder = os.path.join(outputFolderPath, 'FiberClustering', 'SeparatedClusters')
-    if not os.path.exists(os.path.join(SeparatedClustersFolder, 'tracts_commissural', 'cluster_00800.vtp')):
-        wm_separate_clusters_by_hemisphere = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_separate_clusters_by_hemisphere.py" in str(p)][0]
-        wm_separate_clusters_by_hemisphere = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_separate_clusters_by_hemisphere.py')
-        commandLine = [pythonSlicerExecutablePath, wm_separate_clusters_by_hemisphere, FiberClustersInTractographySpace, SeparatedClustersFolder]
-        proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-        slicer.util.logProcessOutput(proc)       
+    separated = None
+    if not self._logReportsDone(os.path.join(SeparatedClustersFolder, 'cluster_location_by_hemisphere.log')):
+        with self.timedStage("separation"):
+            separated = self.separateClustersByHemisphere(FCcaseID_outlier_removed, FiberClustersInTractographySpace,
+                                                          os.path.join(FCAtlasFolder, "cluster_hemisphere_location.txt"),
+                                                          SeparatedClustersFolder, NumThreads, keepInMemory=not ChunkFibers)
     else:
         print(" - separation has been done.")
     print("")
 
-    numfiles = len(os.listdir(f"{SeparatedClustersFolder}/tracts_commissural"))
+    numfiles = self.stageFileCount(os.path.join(SeparatedClustersFolder, HEMISPHERE_FOLDERS[HEMISPHERE_COMMISSURAL]))
     if numfiles < 800:
         print(f"\nERROR: Separating fiber clusters failed. There should be 800 resulting fiber clusters in each folder, but only {numfiles} generated.\n")
+        self.recordStage({"stage": "separation_check", "error": f"{numfiles} of 800 separated clusters"})
     
     # Start append    
     print("<wm_apply_ORG_atlas_to_subject> Append clusters into anatomical tracts.")
     AnatomicalTractsFolder = os.path.join(outputFolderPath, "AnatomicalTracts")
-    if not os.path.exists(os.path.join(AnatomicalTractsFolder, "T_UF_right.vtp")):
-        wm_append_clusters_to_anatomical_tracts = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_append_clusters_to_anatomical_tracts.py" in str(p)][0]
-        wm_append_clusters_to_anatomical_tracts = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_append_clusters_to_anatomical_tracts.py')
-        commandLine = [pythonSlicerExecutablePath, wm_append_clusters_to_anatomical_tracts, SeparatedClustersFolder, FCAtlasFolder, AnatomicalTractsFolder]
-        proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-        slicer.util.logProcessOutput(proc)
+    tracts = None
+    if not self._logReportsDone(os.path.join(AnatomicalTractsFolder, "append_clusters_to_anatomical_tracts.log")):
+        # stream the clusters separated above from memory, if that stage ran now
+        with self.timedStage("append"):
+            tracts = self.appendClustersToTracts(SeparatedClustersFolder, FCAtlasFolder, AnatomicalTractsFolder, NumThreads, separated, keepInMemory=not ChunkFibers)
     else:
         print(" - Appending clusters into anatomical tracts has been done.")
     print("")
 
-    numfiles = len(glob.glob(f"{AnatomicalTractsFolder}/*.vtp"))
+    # Put the input fibers back into the tracts computed on resampled fibers
+    if preprocess and RestoreGeometry and not backProjected:
+      print("<wm_apply_ORG_atlas_to_subject> Restore the original fiber geometry of the anatomical tracts.")
+      if not self._logReportsDone(os.path.join(AnatomicalTractsFolder, "restore_original_geometry.log")):
+        with self.timedStage("restore_geometry"):
+          tracts = self.restoreOriginalGeometry(AnatomicalTractsFolder, originalInput, NumThreads, tracts)
+      else:
+        print(" - restoring the original fiber geometry has been done.")
+      print("")
+
+    numfiles = self.stageFileCount(AnatomicalTractsFolder)
     if numfiles < 73:
         print("")
-        print("ERROR: Appending clusters into anatomical tracts failed. There should be 73 resulting fiber clusters, but only $numfiles generated.")
+        print(f"ERROR: Appending clusters into anatomical tracts failed. There should be 73 resulting fiber clusters, but only {numfiles} generated.")
         print("")
+        self.recordStage({"stage": "append_check", "error": f"{numfiles} of 73 anatomical tracts"})
     
     # Start diffusion
-    FiberTractMeasurementsCLI = slicer.modules.fibertractmeasurements.path #find and store the path of cli-module "FiberTractMeasurements"
-    if platform.system() == 'Windows':
-      slicerlauncher = os.path.join(os.path.dirname(os.path.dirname(slicer.app.slicerHome)), "Slicer.exe")
-      FiberTractMeasurementsCLI = f'"{slicerlauncher} --launch {FiberTractMeasurementsCLI}"'
-    if platform.system() == 'Linux':
-      slicerlauncher = os.path.join(os.path.dirname(os.path.dirname(slicer.app.slicerHome)), "Slicer")
-      FiberTractMeasurementsCLI = f'{slicerlauncher} --launch {FiberTractMeasurementsCLI}'
-    wm_diffusion_measurements = [str(p) for p in importlib.metadata.files('whitematteranalysis') if "wm_diffusion_measurements.py" in str(p)][0]
-    wm_diffusion_measurements = os.path.join(os.path.dirname(pythonSlicerExecutablePath), '..', 'lib', 'Python', location, 'wm_diffusion_measurements.py')
     print("<wm_apply_ORG_atlas_to_subject> Report diffusion measurements of fiber clusters.")
-    if not os.path.isfile(os.path.join(SeparatedClustersFolder, "diffusion_measurements_commissural.csv")):
-        commandLine = [pythonSlicerExecutablePath, wm_diffusion_measurements, os.path.join(SeparatedClustersFolder, "tracts_commissural"), os.path.join(SeparatedClustersFolder, "diffusion_measurements_commissural.csv"), FiberTractMeasurementsCLI]
-        try:
-            proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-            slicer.util.logProcessOutput(proc)
-        except subprocess.CalledProcessError as e:
-            print("Error executing command:")
-            print(e.cmd)
-            print("Error output:")
-            print(e.output)
-    else:
-        print(" - diffusion measurements of commissural clusters has been done.")
-    if not os.path.isfile(os.path.join(SeparatedClustersFolder, "diffusion_measurements_left_hemisphere.csv")):
-        commandLine = [pythonSlicerExecutablePath, wm_diffusion_measurements, os.path.join(SeparatedClustersFolder, "tracts_left_hemisphere"), os.path.join(SeparatedClustersFolder, "diffusion_measurements_left_hemisphere.csv"), FiberTractMeasurementsCLI]
-        try:
-            proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-            slicer.util.logProcessOutput(proc)
-        except subprocess.CalledProcessError as e:
-            print("Error executing command:")
-            print(e.cmd)
-            print("Error output:")
-            print(e.output)       
-    else:
-        print(" - diffusion measurements of left hemisphere clusters has been done.")
-    if not os.path.isfile(os.path.join(SeparatedClustersFolder, "diffusion_measurements_right_hemisphere.csv")):
-        commandLine = [pythonSlicerExecutablePath, wm_diffusion_measurements, os.path.join(SeparatedClustersFolder, "tracts_right_hemisphere"), os.path.join(SeparatedClustersFolder, "diffusion_measurements_right_hemisphere.csv"), FiberTractMeasurementsCLI]
-        try:
-            proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-            slicer.util.logProcessOutput(proc)
-        except subprocess.CalledProcessError as e:
-            print("Error executing command:")
-            print(e.cmd)
-            print("Error output:")
-            print(e.output)      
-    else:
-        print(" - diffusion measurements of right hemisphere clusters has been done.")
-    if not os.path.isfile(os.path.join(SeparatedClustersFolder, "diffusion_measurements_right_hemisphere.csv")):
+    for label, folder in HEMISPHERE_FOLDERS.items():
+        group = folder.replace("tracts_", "")
+        csv = os.path.join(SeparatedClustersFolder, f"diffusion_measurements_{group}.csv")
+        if not os.path.isfile(csv):
+            try:
+                with self.timedStage(f"measurements_{group}"):
+                    self.computeDiffusionMeasurements(os.path.join(SeparatedClustersFolder, folder), csv, NumThreads,
+                                                      separated[folder] if separated is not None else None)
+            except Exception as e:
+                logging.error(f"Diffusion measurements of {folder} failed: {e}")
+        else:
+            print(f" - diffusion measurements of {group.replace('_', ' ')} clusters has been done.")
+    if not all(os.path.isfile(os.path.join(SeparatedClustersFolder, f"diffusion_measurements_{folder.replace('tracts_', '')}.csv")) for folder in HEMISPHERE_FOLDERS.values()):
         print("\nERROR: Reporting diffusion measurements of fiber clusters failed. No diffusion measurement (.csv) files generated.\n")
-          
+
     print("")
 
     print("<wm_apply_ORG_atlas_to_subject> Report diffusion measurements of the anatomical tracts.")
     csv_path = os.path.join(AnatomicalTractsFolder, "diffusion_measurements_anatomical_tracts.csv")
     if not os.path.isfile(csv_path):
-      commandLine = [pythonSlicerExecutablePath, wm_diffusion_measurements, AnatomicalTractsFolder, csv_path, FiberTractMeasurementsCLI]
       try:
-            proc = slicer.util.launchConsoleProcess(commandLine, useStartupEnvironment=True)
-            slicer.util.logProcessOutput(proc)
-      except subprocess.CalledProcessError as e:
-            print("Error executing command:")
-            print(e.cmd)
-            print("Error output:")
-            print(e.output)    
+          with self.timedStage("measurements_tracts"):
+              self.computeDiffusionMeasurements(AnatomicalTractsFolder, csv_path, NumThreads, tracts)
+      except Exception as e:
+          logging.error(f"Diffusion measurements of anatomical tracts failed: {e}")
     else:
       print(" - diffusion measurements of anatomical tracts has been done.")
 
@@ -1190,10 +5142,42 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
       print("")
       print("ERROR: Reporting diffusion measurements of fiber clusters. failed. No diffusion measurement (.csv) files generated.")
       print("")
-      
+
+    print("")
+
+    # Single-file bundle of the tracts, colors and measurements for fast reopening
+    bundlePath = os.path.join(outputFolderPath, RESULT_BUNDLE)
+    if not os.path.isfile(bundlePath):
+      try:
+          with self.timedStage("result_bundle"):
+              self.writeResultBundle(AnatomicalTractsFolder, bundlePath, tracts)
+      except Exception as e:
+          logging.error(f"Writing the result bundle failed: {e}")
+
+    # Incremental cohort table of the measurements of all processed subjects
+    if CohortFolder and not isPreview:
+      try:
+          with self.timedStage("cohort_store"):
+              self.addSubjectToCohort(CohortFolder, caseID, outputFolderPath)
+      except Exception as e:
+          logging.error(f"Adding {caseID} to the cohort store failed: {e}")
+      print("")
+
+    # Spatial index of the tracts and clusters, for ROI queries
+    print("<wm_apply_ORG_atlas_to_subject> Build the spatial index of tracts and clusters.")
+    if not os.path.isfile(os.path.join(outputFolderPath, SPATIAL_INDEX)):
+      try:
+          with self.timedStage("spatial_index"):
+              self.buildSpatialIndex(outputFolderPath, NumThreads, tracts, separated)
+      except Exception as e:
+          logging.error(f"Building the spatial index failed: {e}")
+    else:
+      print(" - spatial index has been built.")
+
     print("")
 
-    # Clear unnecessary intermediate results based on selection
+    # Clear unnecessary intermediate results based on selection; the converted input
+    # (CONVERTED_FOLDER) is kept, as it is a cache reused by later runs of the subject
     if not CleanMode:
         print("<wm_apply_ORG_atlas_to_subject> Clean files using maximal removal.")
         os.system(f"rm -rf {outputFolderPath}/TractRegistration/*/output_tractography/*vtk")
@@ -1204,10 +5188,14 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
         print("<wm_apply_ORG_atlas_to_subject> Clean files using minimal removal.")
         os.system(f"rm -rf {outputFolderPath}/FiberClustering/InitialClusters")
         os.system(f"rm -rf {outputFolderPath}/FiberClustering/TransformedClusters")
+        os.system(f"rm -rf {outputFolderPath}/Chunks")
+        os.system(f"rm -rf {outputFolderPath}/Preprocessed")
     else:
         print("<wm_apply_ORG_atlas_to_subject> Clean files using minimal removal.")
         os.system(f"rm -rf {outputFolderPath}/FiberClustering/InitialClusters")
         os.system(f"rm -rf {outputFolderPath}/FiberClustering/TransformedClusters")
+        os.system(f"rm -rf {outputFolderPath}/Chunks")
+        os.system(f"rm -rf {outputFolderPath}/Preprocessed")
 
     scene = slicer.mrmlScene
     for node in scene.GetNodesByClass('vtkMRMLNode'):
@@ -1216,114 +5204,261 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
             # Remove nodes from the scene
             scene.RemoveNode(node)
 
+    failed = self.finishRunReport()
+
+    if isPreview:
+      print("<wm_apply_ORG_atlas_to_subject> PREVIEW result computed on subsampled fibers. Tracts are loaded with the 'Preview_' prefix.")
+
     if loadmode == "localdirectory":
       pass
-    else:  
-      # Load the generated anatomical tracts back into Slicer
-      # Iterate over files in the AnatomicalTractsFolder
-      for file_name in os.listdir(AnatomicalTractsFolder):
-          if file_name.endswith(".vtp"):
-              file_path = os.path.join(AnatomicalTractsFolder, file_name)
-              try:
-                  self.loadVTPFile(file_path)
-              except Exception as e:
-                  print(f"Error loading VTP file: {file_path}")
-                  print(f"Error message: {str(e)}")
-      mrml_filename = "scene_colored.mrml"
-
-      # Make sure slicer loads the scene correctly, normalizing the file name
-      for filename in os.listdir(AnatomicalTractsFolder):
-        file_path = os.path.join(AnatomicalTractsFolder, filename)
-        new_filename = filename.replace("&", "_")
-        new_file_path = os.path.join(AnatomicalTractsFolder, new_filename)
-        os.rename(file_path, new_file_path)
-    
-      input_polydatas = self.list_vtk_files(AnatomicalTractsFolder)
-
-      # Color chart
-      colors = [
-              self.hex_to_rgb("#ff0029"),
-              self.hex_to_rgb("#ff0029"),
-              self.hex_to_rgb("#ffa400"),
-              self.hex_to_rgb("#ffa400"),
-              self.hex_to_rgb("#241155"),
-              self.hex_to_rgb("#58137c"),
-              self.hex_to_rgb("#9a2c7f"),
-              self.hex_to_rgb("#da4669"),
-              self.hex_to_rgb("#fa825e"),
-              self.hex_to_rgb("#fec589"),
-              self.hex_to_rgb("#fdefb1"),
-              self.hex_to_rgb("#460d5f"),
-              self.hex_to_rgb("#460d5f"),
-              self.hex_to_rgb("#10256c"),
-              self.hex_to_rgb("#10256c"),
-              self.hex_to_rgb("#225ea8"),
-              self.hex_to_rgb("#225ea8"),
-              self.hex_to_rgb("#2a9dc0"),
-              self.hex_to_rgb("#2a9dc0"),
-              self.hex_to_rgb("#ff0fee"),
-              self.hex_to_rgb("#ff0fee"),
-              self.hex_to_rgb("#6000ff"),
-              self.hex_to_rgb("#6000ff"),
-              self.hex_to_rgb("#3b518a"),
-              self.hex_to_rgb("#3b518a"),
-              self.hex_to_rgb("#00ff05"),
-              self.hex_to_rgb("#00ff05"),
-              self.hex_to_rgb("#1c978a"),
-              self.hex_to_rgb("#1c978a"),
-              self.hex_to_rgb("#82d34c"),
-              self.hex_to_rgb("#82d34c"),
-              self.hex_to_rgb("#00fffd"),
-              self.hex_to_rgb("#00fffd"),
-              self.hex_to_rgb("#efe51b"),
-              self.hex_to_rgb("#00aaff"),
-              self.hex_to_rgb("#00aaff"),
-              self.hex_to_rgb("#9ed8b7"),
-              self.hex_to_rgb("#9ed8b7"),
-              self.hex_to_rgb("#ff7984"),
-              self.hex_to_rgb("#ff7984"),
-              self.hex_to_rgb("#0012ff"),
-              self.hex_to_rgb("#0012ff"),
-              self.hex_to_rgb("#ffea00"),
-              self.hex_to_rgb("#ffea00"),
-              self.hex_to_rgb("#c200ff"),
-              self.hex_to_rgb("#c200ff"),
-              self.hex_to_rgb("#ffaf4e"),
-              self.hex_to_rgb("#ffaf4e"),
-              self.hex_to_rgb("#ffed11"),
-              self.hex_to_rgb("#ffed11"),
-              self.hex_to_rgb("#e41a1b"),
-              self.hex_to_rgb("#e41a1b"),
-              self.hex_to_rgb("#377eb7"),
-              self.hex_to_rgb("#377eb7"),
-              self.hex_to_rgb("#4daf4a"),
-              self.hex_to_rgb("#4daf4a"),
-              self.hex_to_rgb("#984ea3"),
-              self.hex_to_rgb("#984ea3"),
-              self.hex_to_rgb("#ff7f00"),
-              self.hex_to_rgb("#ff7f00"),
-              self.hex_to_rgb("#feff33"),
-              self.hex_to_rgb("#feff33"),
-              self.hex_to_rgb("#f880bf"),
-              self.hex_to_rgb("#f880bf"),
-              self.hex_to_rgb("#999999"),
-              self.hex_to_rgb("#999999"),
-              self.hex_to_rgb("#c7e9b4"),
-              self.hex_to_rgb("#c7e9b4"),
-              self.hex_to_rgb("#f0f9b7"),
-              self.hex_to_rgb("#f0f9b7"),
-              self.hex_to_rgb("#feffd9"),
-              self.hex_to_rgb("#feffd9"),
-              self.hex_to_rgb("#ff00bf"),
-              self.hex_to_rgb("#ff00bf"), 
-              ]
-      colors = np.array(list(colors))
-      mrml_file_path = os.path.join(AnatomicalTractsFolder, mrml_filename)
-      self.write(input_polydatas, colors, mrml_file_path)
-      slicer.util.loadScene(mrml_file_path)
+    else:
+      self.loadAnatomicalTracts(AnatomicalTractsFolder, namePrefix)
+
+    # success: no stage of the run report failed and the final stage is done
+    return not failed and subjectDone()
+
+  @profiledMethod
+  def loadAnatomicalTracts(self, AnatomicalTractsFolder, namePrefix=""):
+    # Load the generated anatomical tracts back into Slicer
+    # Iterate over files in the AnatomicalTractsFolder
+    for file_name in os.listdir(AnatomicalTractsFolder):
+        if file_name.endswith(".vtp"):
+            file_path = os.path.join(AnatomicalTractsFolder, file_name)
+            try:
+                self.loadVTPFile(file_path, namePrefix)
+            except Exception as e:
+                print(f"Error loading VTP file: {file_path}")
+                print(f"Error message: {str(e)}")
+    mrml_filename = "scene_colored.mrml"
+
+    # Make sure slicer loads the scene correctly, normalizing the file name
+    for filename in os.listdir(AnatomicalTractsFolder):
+      file_path = os.path.join(AnatomicalTractsFolder, filename)
+      new_filename = filename.replace("&", "_")
+      new_file_path = os.path.join(AnatomicalTractsFolder, new_filename)
+      os.rename(file_path, new_file_path)
+  
+    input_polydatas = self.list_vtk_files(AnatomicalTractsFolder)
 
-      
-  def run(self, loadmode, inputFilePath, inputFolderPath, selectedNodeName, polydata, outputFolderPath, RegMode, CleanMode, NumThreads):
+    # Color chart
+    colors = np.array([self.hex_to_rgb(color) for color in TRACT_COLORS])
+    mrml_file_path = os.path.join(AnatomicalTractsFolder, mrml_filename)
+    self.write(input_polydatas, colors, mrml_file_path, namePrefix=namePrefix)
+    slicer.util.loadScene(mrml_file_path)
+
+  @staticmethod
+  def subjectTask(listfile, outputFolderPath, RegMode, CleanMode, NumThreads, **options):
+    # Work queue task of a tractography file, the subject ID is the file name
+    file_name_without_ext = os.path.splitext(os.path.basename(listfile))[0]
+    task = {"input": os.path.abspath(listfile),
+            "output": os.path.abspath(os.path.join(outputFolderPath, file_name_without_ext)),
+            "options": dict(options, RegMode=RegMode, CleanMode=CleanMode, NumThreads=NumThreads)}
+    return file_name_without_ext, task
+
+  def enqueueSubjects(self, inputFolderPath, outputFolderPath, QueueFolder, RegMode, CleanMode, NumThreads, **options):
+    # Add every tractography file of a folder to the work queue, one subject per file
+    queue = SubjectWorkQueue(QueueFolder)
+    added = 0
+    for listfile in self.list_tractography_files(inputFolderPath):
+      subjectID, task = self.subjectTask(listfile, outputFolderPath, RegMode, CleanMode, NumThreads, **options)
+      added += queue.enqueue(subjectID, task)
+    print(f"<wm_apply_ORG_atlas_to_subject> {added} subjects added to the work queue {QueueFolder}:", queue.counts())
+    return queue
+
+  def runQueueWorker(self, QueueFolder, workerID=None, leaseTimeout=600, pollInterval=10, exitWhenIdle=True):
+    """Process subjects from a work queue until it is empty.
+
+    Any number of workers, on this or other hosts sharing the queue folder, can run
+    this concurrently (see workerCommandLine). The lease of the current subject is
+    renewed from a background thread; a worker that dies loses its lease after
+    leaseTimeout seconds and the subject is processed again by another worker. A
+    worker that finds its lease gone (e.g. after a long stall) aborts the subject
+    at its next stage, and does not mark it done or failed.
+    """
+    queue = SubjectWorkQueue(QueueFolder, leaseTimeout)
+    workerID = workerID or f"{socket.gethostname()}-{os.getpid()}"
+    print(f"<runQueueWorker> Worker {workerID} started on queue {QueueFolder}")
+    while True:
+      task = queue.lease(workerID)
+      if task is None:
+        counts = queue.counts()
+        # leased subjects may still come back if their worker dies
+        if exitWhenIdle and counts["leased"] == 0:
+          break
+        time.sleep(pollInterval)
+        continue
+      subjectID, lease = task["subject"], task["lease"]
+      print(f"<runQueueWorker> Worker {workerID} processing {subjectID}")
+      stopped = threading.Event()
+      self.abortEvent = threading.Event()
+      def heartbeat():
+        while not stopped.wait(leaseTimeout / 4.0):
+          try:
+            renewed = queue.heartbeat(subjectID, lease)
+          except OSError:
+            continue  # e.g. a network filesystem hiccup, the lease is still ours
+          if not renewed:
+            logging.error(f"<runQueueWorker> Lease of {subjectID} was lost, aborting its processing")
+            self.abortEvent.set()
+            return
+      heartbeatThread = threading.Thread(target=heartbeat, daemon=True)
+      heartbeatThread.start()
+      try:
+        options = dict(task["options"])
+        # stages log their errors and go on, runSubject returns False if any failed
+        done = self.runSubject("localdirectory", task["input"], task["output"],
+                               options.pop("RegMode"), options.pop("CleanMode"), options.pop("NumThreads"), **options)
+        error = None if done else f"processing did not finish, see {os.path.join(task['output'], RUN_REPORT)}"
+      except SubjectAborted as e:
+        # the subject belongs to another worker now, its run report too
+        self._runReport = None
+        error = e
+      except Exception as e:
+        logging.error(f"<runQueueWorker> {subjectID} failed: {e}")
+        error = e
+      finally:
+        stopped.set()
+        heartbeatThread.join()
+        self.abortEvent = None
+      try:
+        released = queue.complete(subjectID, lease, {"worker": workerID}) if error is None else queue.fail(subjectID, lease, error)
+      except OSError as e:
+        logging.warning(f"<runQueueWorker> Releasing {subjectID} failed: {e}")
+      else:
+        if not released:
+          logging.warning(f"<runQueueWorker> Lease of {subjectID} was lost while processing it, it is left to its current worker")
+    print(f"<runQueueWorker> Worker {workerID} finished, queue:", queue.counts())
+
+  @staticmethod
+  def workerCommandLine(QueueFolder, applicationPath=None, **workerOptions):
+    # Command starting a headless Slicer queue worker, on this or another host; the
+    # Slicer executable is looked up on the application unless given (main thread only)
+    arguments = ", ".join([repr(os.path.abspath(QueueFolder))] + [f"{k}={v!r}" for k, v in workerOptions.items()])
+    code = ("import slicer; from AnatomicalTractParcellation import AnatomicalTractParcellationLogic; "
+            f"AnatomicalTractParcellationLogic().runQueueWorker({arguments}); slicer.app.exit(0)")
+    return [applicationPath or slicer.app.applicationFilePath(), "--no-splash", "--no-main-window", "--python-code", code]
+
+  def launchQueueWorker(self, QueueFolder, workerID, applicationPath=None, **workerOptions):
+    # Start one local worker process; its output goes to <queue>/logs/<workerID>.log
+    os.makedirs(os.path.join(QueueFolder, "logs"), exist_ok=True)
+    log = open(os.path.join(QueueFolder, "logs", f"{workerID}.log"), "a")
+    commandLine = self.workerCommandLine(QueueFolder, applicationPath, workerID=workerID, **workerOptions)
+    process = subprocess.Popen(commandLine, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    return process
+
+  def launchQueueWorkers(self, QueueFolder, numberOfWorkers, **workerOptions):
+    # Start local worker processes; their output goes to <queue>/logs/worker-<n>.log
+    processes = []
+    for index in range(int(numberOfWorkers)):
+      workerID = f"{socket.gethostname()}-worker{index + 1}"
+      processes.append(self.launchQueueWorker(QueueFolder, workerID, **workerOptions))
+    print(f"<wm_apply_ORG_atlas_to_subject> Started {len(processes)} local queue workers. Workers on other hosts can be started with:")
+    print(" ".join(f'"{a}"' if " " in a or ";" in a else a for a in self.workerCommandLine(QueueFolder)))
+    return processes
+
+  def watchFolder(self, inputFolderPath, outputFolderPath, QueueFolder, RegMode, CleanMode, NumThreads, QueueWorkers=1,
+                  pollInterval=WATCH_POLL_SECONDS, settleTime=WATCH_SETTLE_SECONDS, stopEvent=None, applicationPath=None, **options):
+    """Process the tractography files of a folder as they arrive, until stopped.
+
+    A file is added to the work queue once its size and modification time have not
+    changed for settleTime seconds and its header lists fibers, so files still being
+    written are left alone. Subjects already queued or processed are skipped, unless
+    their input file changed since: then the subject folder is moved aside and the
+    subject queued again, after its current processing if it is running. While subjects are pending, up to QueueWorkers
+    local workers are kept running; workers on other hosts can share the queue too.
+    The watcher stops when stopEvent is set or a STOP file appears in the queue folder,
+    running workers finish their subjects. When run off the main thread, the Slicer
+    executable the workers are started with must be given as applicationPath.
+    """
+    applicationPath = applicationPath or slicer.app.applicationFilePath()
+    queue = SubjectWorkQueue(QueueFolder)
+    stopEvent = stopEvent or threading.Event()
+    stopFile = os.path.join(queue.folder, WATCH_STOP_FILE)
+    seen = {}     # file -> (size, mtime) at the previous listing
+    handled = {}  # file -> (size, mtime) when it was enqueued or found unreadable
+    workers = []
+    print(f"<watchFolder> Watching {inputFolderPath} every {pollInterval} s, work queue {QueueFolder}")
+    while not stopEvent.is_set() and not os.path.exists(stopFile):
+      listing = {}
+      for listfile in self.list_tractography_files(inputFolderPath):
+        try:
+          stat = os.stat(listfile)
+        except OSError:
+          continue  # removed meanwhile
+        listing[listfile] = (stat.st_size, stat.st_mtime)
+      now = time.time()
+      added = 0
+      for listfile, stamp in listing.items():
+        if seen.get(listfile) != stamp or now - stamp[1] < settleTime or handled.get(listfile) == stamp:
+          continue
+        handled[listfile] = stamp
+        try:
+          readable = self.tractographyHeader(listfile)["fibers"] > 0
+        except Exception:
+          readable = False
+        if not readable:
+          logging.warning(f"<watchFolder> Skipping {listfile} until it changes, no fibers can be read from its header")
+          continue
+        subjectID, task = self.subjectTask(listfile, outputFolderPath, RegMode, CleanMode, NumThreads, **options)
+        task["inputStamp"] = list(stamp)
+        previous = queue.task(subjectID)
+        changed = previous is not None and previous.get("inputStamp") not in (None, list(stamp))
+        if changed and queue.state(subjectID) == "leased":
+          # the previous input is being processed: the new one is enqueued once it is finished
+          del handled[listfile]
+          continue
+        if changed and os.path.isdir(task["output"]):
+          # the stages would reuse the results of the previous input, they are kept aside
+          replaced = f"{task['output']}.replaced-{time.strftime('%Y%m%d-%H%M%S')}"
+          os.replace(task["output"], replaced)
+          print(f"<watchFolder> Results of the previous input of {subjectID} moved to {replaced}")
+        if queue.enqueue(subjectID, task, force=changed):
+          added += 1
+          print(f"<watchFolder> {subjectID} added to the work queue" + (" (input changed)" if changed else ""))
+      seen = listing
+      workers = [p for p in workers if p.poll() is None]
+      pending = queue.counts()["pending"]
+      for index in range(min(pending, int(QueueWorkers) - len(workers))):
+        workerID = f"{socket.gethostname()}-watch{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}-{index + 1}"
+        workers.append(self.launchQueueWorker(QueueFolder, workerID, applicationPath))
+      if added:
+        print(f"<watchFolder> {len(workers)} local workers running, queue:", queue.counts())
+      stopEvent.wait(pollInterval)
+    if os.path.exists(stopFile):
+      os.remove(stopFile)
+    print(f"<watchFolder> Stopped watching {inputFolderPath}, {len(workers)} local workers finishing, queue:", queue.counts())
+
+  def runSubject(self, loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads, **options):
+    # Mainoperation for one subject: an error is logged and recorded in the run report of
+    # the subject instead of being raised, so a batch goes on; returns whether it finished
+    try:
+      return self.Mainoperation(loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads, **options)
+    except Exception as e:
+      logging.exception(f"<wm_apply_ORG_atlas_to_subject> Processing {input_tractography_path} failed: {e}")
+      self.recordStage({"stage": "subject", "error": f"{type(e).__name__}: {e}"})
+      self.finishRunReport()
+      return False
+
+  def run(self, loadmode, inputFilePath, inputFolderPath, selectedNodeName, polydata, outputFolderPath, RegMode, CleanMode, NumThreads, **options):
+
+      # work queue options only apply to "From Directory" batches
+      QueueFolder = options.pop("QueueFolder", None)
+      QueueWorkers = options.pop("QueueWorkers", 0)
+      # the panel profiling option applies to this process, workers use the environment variable
+      self.profileMode = options.pop("Profile", None)
+      Watch = options.pop("Watch", False)
+
+      if options.pop("DryRun", False):
+        # Estimate the cost from the input headers and previous run reports, without processing
+        if loadmode == 'slicer':
+          inputs = [(selectedNodeName, {"fibers": polydata.GetNumberOfLines(), "points": polydata.GetNumberOfPoints(),
+                                        "bytes": polydata.GetNumberOfPoints() * 12 + polydata.GetLines().GetNumberOfConnectivityIds() * 8})]
+        else:
+          files = [inputFilePath] if loadmode == 'localfile' else self.list_tractography_files(inputFolderPath)
+          inputs = [(os.path.splitext(os.path.basename(f))[0], self.tractographyHeader(f)) for f in files]
+        reports = glob.glob(os.path.join(outputFolderPath, "**", RUN_REPORT), recursive=True)
+        return self.planRun(inputs, NumThreads, reports, QueueWorkers if loadmode == "localdirectory" and QueueFolder else 0)
 
       if loadmode == 'slicer':
         filename = os.path.join(outputFolderPath, selectedNodeName + ".vtp")
@@ -1336,17 +5471,41 @@ class AnatomicalTractParcellationLogic(ScriptedLoadableModuleLogic):
         self.write_polydata(polydata, filename)
         input_tractography_path = filename
         print(input_tractography_path)
-        self.Mainoperation(loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads)
+        return self.runSubject(loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads, **options)
 
       elif loadmode == 'localfile':
         input_tractography_path = inputFilePath
         print(input_tractography_path)
-        self.Mainoperation(loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads)
+        return self.runSubject(loadmode, input_tractography_path, outputFolderPath, RegMode, CleanMode, NumThreads, **options)
+
+      elif loadmode == "localdirectory" and Watch:
+        # Continuous ingestion in a background thread, stopped by setting the returned event;
+        # the application is only queried here, on the main thread
+        QueueFolder = QueueFolder or os.path.join(outputFolderPath, "Queue")
+        stopEvent = threading.Event()
+        watcher = threading.Thread(target=self.watchFolder, daemon=True,
+                                   args=(inputFolderPath, outputFolderPath, QueueFolder, RegMode, CleanMode, NumThreads),
+                                   kwargs=dict(options, QueueWorkers=QueueWorkers, stopEvent=stopEvent,
+                                               applicationPath=slicer.app.applicationFilePath()))
+        watcher.start()
+        return stopEvent
+
+      elif loadmode == "localdirectory" and QueueFolder:
+        # Distributed batch: enqueue the subjects and let queue workers process them
+        self.enqueueSubjects(inputFolderPath, outputFolderPath, QueueFolder, RegMode, CleanMode, NumThreads, **options)
+        if QueueWorkers:
+          self.launchQueueWorkers(QueueFolder, QueueWorkers)
 
       elif loadmode == "localdirectory":
-        listfiles = self.list_vtk_files(inputFolderPath)
+        listfiles = self.list_tractography_files(inputFolderPath)
+        failed = []
         for listfile in listfiles:
           file_name = os.path.basename(listfile)
           file_name_without_ext, file_ext = os.path.splitext(file_name)
           newoutputFolder = os.path.join(outputFolderPath, file_name_without_ext)
-          self.Mainoperation(loadmode, listfile, newoutputFolder, RegMode, CleanMode, NumThreads)
+          if not self.runSubject(loadmode, listfile, newoutputFolder, RegMode, CleanMode, NumThreads, **options):
+            failed.append(file_name_without_ext)
+        if failed:
+          logging.error(f"<wm_apply_ORG_atlas_to_subject> {len(failed)} of {len(listfiles)} subjects did not finish,"
+                        f" see their {RUN_REPORT}: {', '.join(failed)}")
+        return not failed
@@ -0,0 +1,287 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from AnatomicalTractParcellation import (AnatomicalTractParcellationLogic, FiberArrays, LegacyFiberFile, LegacyFiberWriter,
+                                         SubjectWorkQueue, TckFiberFile, TrkFiberFile)
+
+#
+# Tests of the parts of the module that do not need a Slicer scene: the fiber arrays,
+# the streaming fiber file readers and writer, the fiber pre-processing and the
+# subject work queue.
+#
+
+
+def makeFibers(counts, first=0, seed=0):
+  # FiberArrays of len(counts) random fibers, with point, tensor and cell data
+  rng = np.random.default_rng(seed)
+  offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+  numberOfPoints = int(offsets[-1])
+  return FiberArrays(rng.random((numberOfPoints, 3)).astype(np.float32) * 100, offsets,
+                     {"FA": rng.random(numberOfPoints).astype(np.float32),
+                      "tensors": rng.random((numberOfPoints, 9)),
+                      "FiberIndex": np.repeat(np.arange(first, first + len(counts), dtype=np.int32), counts)},
+                     {"Weight": np.arange(first, first + len(counts), dtype=np.int64)},
+                     {"Scalars": "FA", "Tensors": "tensors"})
+
+
+def writeTrk(filename, fibers, scalars):
+  # TrackVis version 2 file with identity vox_to_ras, 1 mm voxels and one scalar per point
+  header = np.zeros(1, np.dtype([
+    ("id_string", "S6"), ("dim", "<i2", 3), ("voxel_size", "<f4", 3), ("origin", "<f4", 3),
+    ("n_scalars", "<i2"), ("scalar_name", "S20", 10), ("n_properties", "<i2"), ("property_name", "S20", 10),
+    ("vox_to_ras", "<f4", (4, 4)), ("reserved", "S444"), ("voxel_order", "S4"), ("pad2", "S4"),
+    ("image_orientation_patient", "<f4", 6), ("pad1", "S2"), ("flags", "u1", 6),
+    ("n_count", "<i4"), ("version", "<i4"), ("hdr_size", "<i4")]))
+  header["id_string"] = b"TRACK"
+  header["dim"] = (100, 100, 100)
+  header["voxel_size"] = (1, 1, 1)
+  header["n_scalars"] = 1
+  header["scalar_name"][0, 0] = b"FA" + b"\0" * 17 + b"\x01"
+  header["vox_to_ras"] = np.eye(4)
+  header["voxel_order"] = b"RAS"
+  header["n_count"] = len(fibers)
+  header["version"] = 2
+  header["hdr_size"] = 1000
+  with open(filename, "wb") as f:
+    f.write(header.tobytes())
+    for points, values in zip(fibers, scalars):
+      f.write(np.int32(len(points)).tobytes())
+      f.write(np.column_stack([points, values]).astype("<f4").tobytes())
+
+
+def writeTck(filename, fibers):
+  # MRtrix tracks file: fibers separated by a NaN point, ended by an Inf point
+  text = "mrtrix tracks\ndatatype: Float32LE\ncount: {}\nfile: . {:08d}\nEND\n"
+  offset = len(text.format(len(fibers), 0))
+  with open(filename, "wb") as f:
+    f.write(text.format(len(fibers), offset).encode())
+    for points in fibers:
+      f.write(np.asarray(points, "<f4").tobytes())
+      f.write(np.full(3, np.nan, "<f4").tobytes())
+    f.write(np.full(3, np.inf, "<f4").tobytes())
+
+
+def leaseAndComplete(folder, workerID, processedFolder):
+  # queue worker process: record every leased subject and mark it done
+  queue = SubjectWorkQueue(folder, leaseTimeout=60)
+  while True:
+    task = queue.lease(workerID)
+    if task is None:
+      return
+    with open(os.path.join(processedFolder, f"{task['subject']}.{workerID}"), "w") as f:
+      f.write(task["lease"])
+    time.sleep(0.005)
+    queue.complete(task["subject"], task["lease"], {"worker": workerID})
+
+
+class TemporaryFolderTestCase(unittest.TestCase):
+  def setUp(self):
+    self.folder = tempfile.mkdtemp(prefix="AnatomicalTractParcellationTest")
+
+  def tearDown(self):
+    shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class FiberArraysTest(unittest.TestCase):
+  def test_subset_and_concatenate(self):
+    fibers = makeFibers([3, 5, 2, 4])
+    subset = fibers.subset([2, 0])
+    np.testing.assert_array_equal(subset.pointCounts(), [2, 3])
+    np.testing.assert_array_equal(subset.points[:2], fibers.points[8:10])
+    np.testing.assert_array_equal(subset.cellData["Weight"], [2, 0])
+    joined = FiberArrays.concatenate([fibers.subset([0, 1]), fibers.subset([2, 3])])
+    np.testing.assert_array_equal(joined.offsets, fibers.offsets)
+    np.testing.assert_array_equal(joined.points, fibers.points)
+    np.testing.assert_array_equal(joined.pointData["FiberIndex"], fibers.pointData["FiberIndex"])
+
+  def test_fiber_lengths(self):
+    points = np.array([[0, 0, 0], [3, 4, 0], [3, 4, 12], [10, 0, 0], [11, 0, 0]], np.float32)
+    fibers = FiberArrays(points, [0, 3, 5])
+    np.testing.assert_allclose(fibers.fiberLengths(), [17.0, 1.0])
+
+  def test_resample(self):
+    points = np.array([[0, 0, 0], [10, 0, 0], [10, 10, 0]], np.float32)
+    fibers = FiberArrays(points, [0, 3], {"Index": np.arange(3)})
+    resampled = fibers.resample(5)
+    np.testing.assert_array_equal(resampled.pointCounts(), [5])
+    np.testing.assert_allclose(resampled.points[[0, -1]], points[[0, -1]])
+    np.testing.assert_allclose(resampled.points[2], [10, 0, 0], atol=1e-5)
+    self.assertEqual(resampled.points.dtype, np.float32)
+    self.assertAlmostEqual(float(resampled.fiberLengths()[0]), 20.0, places=4)
+    np.testing.assert_array_equal(fibers.resample(spacing=2.0).pointCounts(), [11])
+
+  def test_duplicate_keys(self):
+    fibers = makeFibers([4, 4])
+    reversed = FiberArrays(fibers.points[3::-1].copy(), [0, 4])
+    keys = FiberArrays.concatenate([FiberArrays(fibers.points, fibers.offsets), reversed]).duplicateKeys(0.5)
+    self.assertEqual(keys[0], keys[2])
+    self.assertNotEqual(keys[0], keys[1])
+
+  def test_duplicate_keys_empty_fibers(self):
+    fibers = makeFibers([4, 0, 4, 0])
+    keys = fibers.duplicateKeys(0.5)
+    np.testing.assert_array_equal(keys[[1, 3]], [0, 0])
+    np.testing.assert_array_equal(keys[[0, 2]], FiberArrays(fibers.points, [0, 4, 8]).duplicateKeys(0.5))
+
+
+class FiberFileTest(TemporaryFolderTestCase):
+  def test_legacy_writer_round_trip(self):
+    blocks = [makeFibers([3, 5, 2], 0, 1), makeFibers([], 3, 2), makeFibers([4, 2], 3, 3)]
+    filename = os.path.join(self.folder, "fibers.vtk")
+    with LegacyFiberWriter(filename) as writer:
+      for block in blocks:
+        writer.write(block)
+    self.assertFalse(os.path.exists(filename + ".sections"))
+    expected = FiberArrays.concatenate(blocks)
+    fiberFile = LegacyFiberFile(filename)
+    self.assertEqual(fiberFile.numberOfFibers, 5)
+    self.assertEqual(fiberFile.activeArrays, {"Scalars": "FA", "Tensors": "tensors"})
+    fibers = FiberArrays.concatenate(list(fiberFile.blocks(2)))
+    np.testing.assert_array_equal(fibers.offsets, expected.offsets)
+    np.testing.assert_array_equal(fibers.points, expected.points)
+    for name, values in expected.pointData.items():
+      np.testing.assert_array_equal(fibers.pointData[name], values)
+    np.testing.assert_array_equal(fibers.cellData["Weight"], expected.cellData["Weight"])
+    taken = fiberFile.take([4, 1])
+    np.testing.assert_array_equal(taken.points, expected.subset([4, 1]).points)
+
+  def test_legacy_writer_64bit_offsets(self):
+    filename = os.path.join(self.folder, "fibers.vtk")
+    with LegacyFiberWriter(filename) as writer:
+      writer.write(makeFibers([3, 5]))
+      writer.write(makeFibers([2], 2))
+    # 5.1 layout: 64-bit offsets and connectivity, so that point ids do not wrap at 2^31
+    with open(filename, "rb") as f:
+      content = f.read()
+    self.assertIn(b"LINES 4 10\nOFFSETS vtktypeint64\n", content)
+    self.assertIn(b"CONNECTIVITY vtktypeint64\n", content)
+    fiberFile = LegacyFiberFile(filename)
+    layout, offsets, connectivity = fiberFile.lines
+    self.assertEqual(layout, "5")
+    self.assertEqual(offsets.dtype, np.dtype(">i8"))
+    np.testing.assert_array_equal(offsets, [0, 3, 8, 10])
+    np.testing.assert_array_equal(connectivity, np.arange(10))
+
+  def test_legacy_writer_vtk_reader(self):
+    import vtk
+    filename = os.path.join(self.folder, "fibers.vtk")
+    expected = makeFibers([3, 5, 2])
+    with LegacyFiberWriter(filename) as writer:
+      writer.write(expected)
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    fibers = FiberArrays.fromPolyData(reader.GetOutput())
+    np.testing.assert_array_equal(fibers.offsets, expected.offsets)
+    np.testing.assert_allclose(fibers.points, expected.points)
+    np.testing.assert_allclose(fibers.pointData["tensors"], expected.pointData["tensors"])
+    self.assertEqual(fibers.activeArrays["Tensors"], "tensors")
+
+  def test_trk_blocks(self):
+    rng = np.random.default_rng(0)
+    points = [rng.random((n, 3)).astype(np.float32) * 50 for n in (3, 6, 2, 4)]
+    scalars = [rng.random(len(p)).astype(np.float32) for p in points]
+    filename = os.path.join(self.folder, "fibers.trk")
+    writeTrk(filename, points, scalars)
+    fiberFile = TrkFiberFile(filename)
+    self.assertEqual((fiberFile.numberOfFibers, fiberFile.numberOfPoints), (4, 15))
+    blocks = list(fiberFile.blocks(3))
+    self.assertEqual([block.numberOfFibers for block in blocks], [3, 1])
+    fibers = FiberArrays.concatenate(blocks)
+    # voxmm coordinates are voxel corners, RAS ones voxel centers
+    np.testing.assert_allclose(fibers.points, np.concatenate(points) - 0.5, atol=1e-5)
+    np.testing.assert_allclose(fibers.pointData["FA"], np.concatenate(scalars))
+
+  def test_tck_blocks(self):
+    rng = np.random.default_rng(0)
+    points = [rng.random((n, 3)).astype(np.float32) for n in (3, 6, 2, 4, 5)]
+    filename = os.path.join(self.folder, "fibers.tck")
+    writeTck(filename, points)
+    # windows smaller than a fiber: fibers are carried over windows
+    fiberFile = TckFiberFile(filename, windowSize=4)
+    self.assertEqual((fiberFile.numberOfFibers, fiberFile.numberOfPoints), (5, 20))
+    blocks = list(fiberFile.blocks(2))
+    self.assertEqual([block.numberOfFibers for block in blocks], [2, 2, 1])
+    fibers = FiberArrays.concatenate(blocks)
+    np.testing.assert_array_equal(fibers.pointCounts(), [3, 6, 2, 4, 5])
+    np.testing.assert_array_equal(fibers.points, np.concatenate(points))
+
+
+class PrepareTractographyTest(TemporaryFolderTestCase):
+  def test_short_fibers_are_not_kept_duplicates(self):
+    # on a 1 m grid all fibers are duplicates: the first long fiber is kept, not the short one before it
+    line = np.linspace([0, 0, 0], [50, 0, 0], 6).astype(np.float32)
+    points = np.concatenate([line[:2] / 10, line, line + 1]).astype(np.float32)
+    inputPath = os.path.join(self.folder, "input.vtk")
+    with LegacyFiberWriter(inputPath) as writer:
+      writer.write(FiberArrays(points, [0, 2, 2, 8, 14]))
+    outputPath = os.path.join(self.folder, "Preprocessed", "input.vtk")
+    removed = AnatomicalTractParcellationLogic().prepareTractography(inputPath, outputPath, 0, 0.0, minimumLength=10.0,
+                                                                     duplicateTolerance=1000.0)
+    self.assertEqual(removed, {"fibers": 4, "short": 2, "duplicates": 1})
+    fibers = LegacyFiberFile(outputPath).read(0, 1)
+    np.testing.assert_array_equal(fibers.points, line)
+    np.testing.assert_array_equal(fibers.pointData["FiberIndex"], np.full(6, 2))
+
+
+class SubjectWorkQueueTest(TemporaryFolderTestCase):
+  def enqueue(self, queue, count):
+    for index in range(count):
+      queue.enqueue(f"s{index}", {"input": f"s{index}.vtk"})
+
+  def test_expired_lease_cannot_release(self):
+    queue = SubjectWorkQueue(self.folder, leaseTimeout=0.05)
+    self.enqueue(queue, 1)
+    first = queue.lease("A")
+    time.sleep(0.1)
+    # A stalled: its lease expires and B leases the subject again
+    second = queue.lease("B")
+    self.assertEqual(second["subject"], "s0")
+    self.assertEqual(second["attempts"], 1)
+    self.assertNotEqual(first["lease"], second["lease"])
+    self.assertFalse(queue.heartbeat("s0", first["lease"]))
+    self.assertFalse(queue.complete("s0", first["lease"]))
+    self.assertFalse(queue.fail("s0", first["lease"], "stale"))
+    self.assertEqual(queue.state("s0"), "leased")
+    self.assertTrue(queue.heartbeat("s0", second["lease"]))
+    self.assertTrue(queue.complete("s0", second["lease"], {"worker": "B"}))
+    self.assertEqual(queue.state("s0"), "done")
+    self.assertEqual(queue.task("s0")["result"], {"worker": "B"})
+
+  def test_fail_requeues_until_max_attempts(self):
+    queue = SubjectWorkQueue(self.folder, maxAttempts=2)
+    self.enqueue(queue, 1)
+    self.assertTrue(queue.fail("s0", queue.lease("A")["lease"], "first"))
+    self.assertEqual(queue.state("s0"), "pending")
+    self.assertTrue(queue.fail("s0", queue.lease("A")["lease"], "second"))
+    self.assertEqual(queue.state("s0"), "failed")
+    self.assertIsNone(queue.lease("A"))
+
+  @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "worker processes are forked")
+  def test_multiple_worker_processes(self):
+    queueFolder = os.path.join(self.folder, "Queue")
+    processedFolder = os.path.join(self.folder, "Processed")
+    os.makedirs(processedFolder)
+    self.enqueue(SubjectWorkQueue(queueFolder), 40)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=leaseAndComplete, args=(queueFolder, f"worker{index}", processedFolder))
+               for index in range(4)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join(60)
+      self.assertEqual(worker.exitcode, 0)
+    # every subject is processed exactly once
+    processed = sorted(name.split(".")[0] for name in os.listdir(processedFolder))
+    self.assertEqual(processed, sorted(f"s{index}" for index in range(40)))
+    self.assertEqual(SubjectWorkQueue(queueFolder).counts(), {"pending": 0, "leased": 0, "done": 40, "failed": 0})
+
+
+if __name__ == "__main__":
+  unittest.main()